@@ -6,8 +6,10 @@ config_path=scripts/config/config_train.yaml
 train_output_dir=$exp_name/train
 
 python scripts/quantize_audio.py $train_output_dir --config $config_path
-python scripts/deduplicate.py --output $train_output_dir --max_units 6144 --convert
-python scripts/form_convert.py --file_name $train_output_dir/quantized_outputs.txt --output $train_output_dir/converted_not_dedup.txt
+python scripts/deduplicate.py --output $train_output_dir --max_units 6144 --artifacts converted deleted not_dedup --workers $num_workers
+# or, to keep the longer utterances as overlapping windows (listed in windows.tsv)
+# and train with a shorter max_positions:
+# python scripts/deduplicate.py --output $train_output_dir --max_units 1024 --split_long --window_stride 512 --artifacts converted deleted not_dedup --workers $num_workers
 
 # quantize dev set (3 sets)
 config_path=scripts/config/config_dev.yaml
@@ -20,16 +22,14 @@ config_path=scripts/config/config_test.yaml
 test_output_dir=$exp_name/test/
 
 python scripts/quantize_audio.py $test_output_dir --config $config_path
-python scripts/deduplicate.py --output $test_output_dir --max_units 512 --convert
-python scripts/deduplicate.py --output $test_output_dir --max_units 512
+python scripts/deduplicate.py --output $test_output_dir --max_units 512 --artifacts converted named deleted
 
 # quantize test correct set (3 sets)
 config_path=scripts/config/config_test_correct.yaml
 test_output_correct_dir=$exp_name/test_cs/correct
 
 python scripts/quantize_audio.py $test_output_correct_dir --config $config_path
-python scripts/deduplicate.py --output $test_output_correct_dir --max_units 512 --convert
-python scripts/deduplicate.py --output $test_output_correct_dir --max_units 512
+python scripts/deduplicate.py --output $test_output_correct_dir --max_units 512 --artifacts converted named deleted
 
 # quantize test wrong set (3 sets)
 config_path=scripts/config/config_test_wrong.yaml
@@ -38,8 +38,16 @@ test_output_wrong_dir=$exp_name/test_cs/wrong
 python scripts/quantize_audio.py $test_output_wrong_dir --config $config_path
 python scripts/deduplicate.py --output $test_output_wrong_dir --max_units 512
 
+# optionally, shorten the sequences with a unit BPE learned on the train set, then
+# binarize the *.bpe.txt files instead (and score $test_output_dir/dedup_not_converted.bpe.txt
+# with --input_format named)
+# python scripts/unit_bpe.py learn --input $train_output_dir/dedup_converted.txt --merges $exp_name/bpe_merges.txt --num_merges 10000
+# for dir in $train_output_dir $dev_output_dir $test_output_dir; do
+#     python scripts/unit_bpe.py encode --merges $exp_name/bpe_merges.txt --input $dir/dedup_converted.txt --output $dir/dedup_converted.bpe.txt --workers $num_workers
+# done
+
 # preprocess data
-fairseq-preprocess --only-source \
+python scripts/binarize_units.py \
     --trainpref $train_output_dir/dedup_converted.txt \
     --validpref $dev_output_dir/dedup_converted.txt \
     --testpref $test_output_dir/dedup_converted.txt \
@@ -0,0 +1,104 @@
+r"""
+Compare the directory scan of findAllSeqs_Mix (dir_scanner.py) with the
+single-threaded os.walk it replaced. Without pathDB, a synthetic tree is
+built in a temporary directory.
+
+    python benchmarks/bench_dir_scan.py [pathDB ...] --nThreads 16
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dir_scanner import listFiles, SCAN_CACHE_NAME
+
+
+def legacyScan(dirName, extension, speaker_level=1):
+    # findAllSeqs_Mix before the threaded scanner, without the cache
+    if dirName[-1] != os.sep:
+        dirName += os.sep
+    prefixSize = len(dirName)
+    speakersTarget = {}
+    outSequences = []
+    for root, dirs, filenames in os.walk(dirName):
+        for ex in extension:
+            filtered_files = [f for f in filenames if f.endswith(ex)]
+            if len(filtered_files) > 0:
+                speakerStr = (os.sep).join(
+                    root[prefixSize:].split(os.sep)[:speaker_level])
+                if speakerStr not in speakersTarget:
+                    speakersTarget[speakerStr] = len(speakersTarget)
+                speaker = speakersTarget[speakerStr]
+                for filename in filtered_files:
+                    full_path = os.path.join(dirName + root[prefixSize:], filename)
+                    outSequences.append((speaker, full_path))
+    return outSequences
+
+
+def buildTree(root, nSpeakers, nChapters, nFiles):
+    for speaker in range(nSpeakers):
+        for chapter in range(nChapters):
+            pathDir = os.path.join(root, f'{speaker}', f'{chapter}')
+            os.makedirs(pathDir)
+            for index in range(nFiles):
+                ext = '.flac' if index % 2 == 0 else '.wav'
+                open(os.path.join(pathDir, f'{speaker}-{chapter}-{index}{ext}'), 'w').close()
+
+
+def timeIt(function, nRepeat):
+    best = float('inf')
+    for _ in range(nRepeat):
+        start = time.perf_counter()
+        out = function()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the corpus directory scan.')
+    parser.add_argument('pathDB', type=str, nargs='*')
+    parser.add_argument('--extension', type=str, nargs='+', default=['.flac', '.wav'])
+    parser.add_argument('--nThreads', type=int, default=16)
+    parser.add_argument('--nRepeat', type=int, default=3)
+    parser.add_argument('--nSpeakers', type=int, default=100)
+    parser.add_argument('--nChapters', type=int, default=10)
+    parser.add_argument('--nFiles', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    tmpDir = None
+    pathDB = args.pathDB
+    if len(pathDB) == 0:
+        tmpDir = tempfile.mkdtemp()
+        buildTree(tmpDir, args.nSpeakers, args.nChapters, args.nFiles)
+        pathDB = [tmpDir]
+
+    try:
+        for dirName in pathDB:
+            pathCache = os.path.join(dirName, SCAN_CACHE_NAME)
+            if os.path.exists(pathCache):
+                os.remove(pathCache)
+            legacy, legacyOut = timeIt(lambda: legacyScan(dirName, args.extension),
+                                       args.nRepeat)
+            cold, coldOut = timeIt(lambda: listFiles(dirName, args.extension,
+                                                     loadCache=False,
+                                                     nThreads=args.nThreads),
+                                   args.nRepeat)
+            warm, warmOut = timeIt(lambda: listFiles(dirName, args.extension,
+                                                     loadCache=True,
+                                                     nThreads=args.nThreads),
+                                   args.nRepeat)
+            assert len(legacyOut) == len(coldOut) == len(warmOut)
+            print(f'{dirName}: {len(legacyOut)} files')
+            print(f'  os.walk          {legacy:.3f} s')
+            print(f'  threaded scandir {cold:.3f} s ({legacy / cold:.1f}x)')
+            print(f'  incremental      {warm:.3f} s ({legacy / warm:.1f}x)')
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+r"""
+Compare span scoring with and without sequence packing on the sentences of
+a quantized units file (eg. the test set, for its length distribution):
+throughput of each mode and largest difference between their scores.
+
+    python benchmarks/bench_packing.py $exp/test_cs/correct/dedup_not_converted.txt \
+        $exp/checkpoints/checkpoint_best.pt --dict $exp/bin/dict.txt --pack_size 1024
+"""
+import sys
+import time
+import random
+import argparse
+from os.path import abspath, dirname
+
+import torch
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from utils_functions import loadRobertaCheckpoint
+from lm_scoring import compute_proba_BERT_mlm_span
+
+
+def time_scoring(sequences, roberta, gpu, **kwargs):
+    if gpu:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    scores = compute_proba_BERT_mlm_span(sequences, roberta, tokenized=True, gpu=gpu, **kwargs)
+    if gpu:
+        torch.cuda.synchronize()
+    return scores, time.perf_counter() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark packed span scoring.')
+    parser.add_argument('pathQuantizedUnits', type=str,
+                        help='Quantized units, file_name[tab]pseudo_units on each line.')
+    parser.add_argument('pathBERTCheckpoint', type=str)
+    parser.add_argument('--dict', type=str, default=None,
+                        help='dict.txt of the model (default: in the model directory).')
+    parser.add_argument('--n_sentences', type=int, default=512,
+                        help='Number of sentences drawn from the file (default: 512).')
+    parser.add_argument('--pack_size', type=int, default=1024)
+    parser.add_argument('--batchsen_size', type=int, default=128)
+    parser.add_argument('--inner_batch_size', type=int, default=128,
+                        help='Masked sequences per batch without packing.')
+    parser.add_argument('--pack_batch_size', type=int, default=16,
+                        help='Packed rows per batch.')
+    parser.add_argument('--n_warmup', type=int, default=32,
+                        help='Sentences scored in both modes before timing (CUDA/cuDNN warmup).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args(argv)
+
+    with open(args.pathQuantizedUnits, 'r') as f:
+        sequences = [line.strip().split("\t")[1].replace(",", " ") for line in f if line.strip()]
+    random.Random(args.seed).shuffle(sequences)
+    sequences = sequences[:args.n_sentences]
+    lengths = sorted(len(x.split()) for x in sequences)
+    print(f"{len(sequences)} sentences, lengths min {lengths[0]}, "
+          f"median {lengths[len(lengths) // 2]}, max {lengths[-1]}")
+
+    pathData = dirname(abspath(args.dict)) if args.dict is not None \
+        else dirname(abspath(args.pathBERTCheckpoint))
+    roberta = loadRobertaCheckpoint(abspath(args.pathBERTCheckpoint), pathData, from_pretrained=False)
+    roberta.eval()
+    gpu = not args.cpu
+
+    # Same batches of sentences in both modes, masked head in both
+    common = dict(batchsen_size=args.batchsen_size, masked_head=True)
+    padded_kwargs = dict(inner_batch_size=args.inner_batch_size, **common)
+    packed_kwargs = dict(inner_batch_size=args.pack_batch_size, pack_size=args.pack_size, **common)
+
+    # Untimed warmup of both modes, so that neither pays for the CUDA context and the cuDNN setup
+    for kwargs in [padded_kwargs, packed_kwargs]:
+        time_scoring(sequences[:args.n_warmup], roberta, gpu, **kwargs)
+
+    padded, padded_time = time_scoring(sequences, roberta, gpu, **padded_kwargs)
+    packed, packed_time = time_scoring(sequences, roberta, gpu, **packed_kwargs)
+
+    n_units = sum(lengths)
+    for name, elapsed in [('padded', padded_time), (f'packed ({args.pack_size})', packed_time)]:
+        print(f"{name:16s} {elapsed:8.2f} s, {len(sequences) / elapsed:8.2f} sentences/s, "
+              f"{n_units / elapsed:10.1f} units/s")
+    diff = max(abs(a - b) for a, b in zip(padded, packed))
+    print(f"Speedup x{padded_time / packed_time:.2f}, largest score difference {diff:.3e}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
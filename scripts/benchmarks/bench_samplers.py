@@ -0,0 +1,181 @@
+r"""
+Compare the AudioBatchData samplers with the list based ones they replaced,
+on a synthetic pack (only its size and its speaker boundaries are needed,
+except with --gather where the int16 pack is allocated and the windows of
+each batch are gathered).
+
+    python benchmarks/bench_samplers.py --packSize 4000000000 --nSpeakers 2000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from collections import Counter
+import torch
+from torch.utils.data.sampler import BatchSampler
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset import UniformAudioSampler, SequentialSampler, SameSpeakerSampler
+
+
+class LegacyUniformAudioSampler(object):
+
+    def __init__(self, dataSize, sizeWindow, offset):
+        self.len = dataSize // sizeWindow
+        self.sizeWindow = sizeWindow
+        self.offset = offset
+        if self.offset > 0:
+            self.len -= 1
+
+    def __iter__(self):
+        return iter((self.offset
+                     + self.sizeWindow * torch.randperm(self.len)).tolist())
+
+    def __len__(self):
+        return self.len
+
+
+class LegacySequentialSampler(object):
+
+    def __init__(self, dataSize, sizeWindow, offset, batchSize):
+        self.len = (dataSize // sizeWindow) // batchSize
+        self.sizeWindow = sizeWindow
+        self.offset = offset
+        self.startBatches = [x * (dataSize // batchSize)
+                             for x in range(batchSize)]
+        if self.offset > 0:
+            self.len -= 1
+
+    def __iter__(self):
+        for idx in range(self.len):
+            yield [self.offset + self.sizeWindow * idx
+                   + start for start in self.startBatches]
+
+
+class LegacySameSpeakerSampler(object):
+
+    def __init__(self, batchSize, samplingIntervals, sizeWindow, offset):
+        self.samplingIntervals = samplingIntervals
+        self.sizeWindow = sizeWindow
+        self.batchSize = batchSize
+        self.offset = offset
+        nWindows = len(self.samplingIntervals) - 1
+        self.sizeSamplers = [(self.samplingIntervals[i+1] -
+                              self.samplingIntervals[i]) // self.sizeWindow
+                             for i in range(nWindows)]
+        if self.offset > 0:
+            self.sizeSamplers = [max(0, x - 1) for x in self.sizeSamplers]
+        order = [(x, torch.randperm(val).tolist())
+                 for x, val in enumerate(self.sizeSamplers) if val > 0]
+        self.batches = []
+        for indexSampler, randperm in order:
+            indexStart, sizeSampler = 0, self.sizeSamplers[indexSampler]
+            while indexStart < sizeSampler:
+                indexEnd = min(sizeSampler, indexStart + self.batchSize)
+                locBatch = [self.getIndex(x, indexSampler)
+                            for x in randperm[indexStart:indexEnd]]
+                indexStart = indexEnd
+                self.batches.append(locBatch)
+
+    def getIndex(self, x, iInterval):
+        return self.offset + x * self.sizeWindow \
+            + self.samplingIntervals[iInterval]
+
+    def __iter__(self):
+        random.shuffle(self.batches)
+        return iter(self.batches)
+
+
+def speakerIntervals(packSize, nSpeakers, generator):
+    cuts = torch.randint(packSize, (nSpeakers - 1,), generator=generator).sort().values
+    return [0] + cuts.tolist() + [packSize]
+
+
+def timeSampler(build, consume=None):
+    start = time.perf_counter()
+    sampler = build()
+    built = time.perf_counter()
+    nBatches = 0
+    for batch in sampler:
+        if consume is not None:
+            consume(torch.as_tensor(batch))
+        nBatches += 1
+    return built - start, time.perf_counter() - built, nBatches
+
+
+def checkSamplers(name, legacy, vectorized):
+    r"""
+    Both samplers must yield batches of the same sizes and, except for the
+    uniform one (a random subset of the windows each epoch), the same
+    windows.
+    """
+    oldBatches = [torch.as_tensor(batch).tolist() for batch in legacy()]
+    newBatches = [torch.as_tensor(batch).tolist() for batch in vectorized()]
+    assert Counter(map(len, oldBatches)) == Counter(map(len, newBatches)), \
+        f"{name}: the batch sizes differ"
+    if name != 'uniform':
+        assert Counter(x for batch in oldBatches for x in batch) \
+            == Counter(x for batch in newBatches for x in batch), \
+            f"{name}: the windows differ"
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the AudioBatchData samplers.')
+    parser.add_argument('--packSize', type=int, default=4000000000,
+                        help='Number of int16 samples in the pack (default: 8 GB).')
+    parser.add_argument('--nSpeakers', type=int, default=2000)
+    parser.add_argument('--sizeWindow', type=int, default=10240)
+    parser.add_argument('--batchSize', type=int, default=80)
+    parser.add_argument('--offset', type=int, default=128)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gather', action='store_true',
+                        help='Allocate the pack and gather the windows of each batch.')
+    parser.add_argument('--check', action='store_true',
+                        help='Also check that each sampler yields the same batches as the legacy one.')
+    args = parser.parse_args(argv)
+
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
+    intervals = speakerIntervals(args.packSize, args.nSpeakers, generator)
+
+    consume = None
+    if args.gather:
+        pack = torch.zeros(args.packSize, dtype=torch.int16)
+        windows = pack.unfold(0, args.sizeWindow, 1)
+
+        def consume(indices):
+            windows[indices].float().div_(32768)
+
+    samplers = {
+        'uniform': (
+            lambda: BatchSampler(LegacyUniformAudioSampler(args.packSize, args.sizeWindow, args.offset),
+                                 args.batchSize, True),
+            lambda: UniformAudioSampler(args.packSize, args.sizeWindow, args.offset,
+                                        args.batchSize, generator)),
+        'sequential': (
+            lambda: LegacySequentialSampler(args.packSize, args.sizeWindow, args.offset,
+                                            args.batchSize),
+            lambda: SequentialSampler(args.packSize, args.sizeWindow, args.offset,
+                                      args.batchSize)),
+        'samespeaker': (
+            lambda: LegacySameSpeakerSampler(args.batchSize, intervals, args.sizeWindow,
+                                             args.offset),
+            lambda: SameSpeakerSampler(args.batchSize, intervals, args.sizeWindow,
+                                       args.offset, generator)),
+    }
+
+    print(f"Pack of {args.packSize} samples ({2 * args.packSize / 1e9:.1f} GB), "
+          f"{args.nSpeakers} speakers, windows of {args.sizeWindow}, "
+          f"batches of {args.batchSize}")
+    for name, (legacy, vectorized) in samplers.items():
+        if args.check:
+            checkSamplers(name, legacy, vectorized)
+        for label, build in [('legacy', legacy), ('vectorized', vectorized)]:
+            buildTime, iterTime, nBatches = timeSampler(build, consume)
+            print(f"{name:12s} {label:10s} build {buildTime:.3f} s, "
+                  f"iterate {iterTime:.3f} s, {nBatches} batches")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
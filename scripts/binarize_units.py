@@ -0,0 +1,121 @@
+import argparse
+import os
+import shutil
+import tempfile
+from collections import Counter
+from multiprocessing import Pool
+
+import torch
+from fairseq.data import Dictionary, indexed_dataset
+
+from deduplicate import deduplicate, shard_ranges
+
+SPLITS = ['train', 'valid', 'test']
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Binarize unit sequences into fairseq mmap datasets, '
+        'as fairseq-preprocess --only-source would.')
+    parser.add_argument('--destdir', required=True)
+    parser.add_argument('--trainpref', required=True)
+    parser.add_argument('--validpref', default=None)
+    parser.add_argument('--testpref', default=None)
+    parser.add_argument('--input_format', default='converted', choices=['converted', 'quantized'],
+                        help='converted: space separated units (dedup_converted.txt), '
+                        'quantized: quantizer output (name<tab>comma separated units)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='with quantized inputs, merge the repeated units')
+    parser.add_argument('--max_units', type=int, default=None,
+                        help='with quantized inputs, drop the longer sequences (as deduplicate.py)')
+    parser.add_argument('--workers', type=int, default=1)
+    return parser.parse_args()
+
+def read_units(file_name, start, end, input_format, dedup=False, max_units=None):
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline().decode('utf-8')
+            if input_format == 'converted':
+                yield line.split()
+                continue
+            if not line.strip():
+                continue
+            units = line.split('\t')[1].strip().split(',')
+            if dedup:
+                units = deduplicate(units)
+            if max_units is not None and len(units) > max_units:
+                continue
+            yield units
+
+def count_range(job):
+    file_name, start, end, options = job
+    counter = Counter()
+    n_lines = 0
+    for units in read_units(file_name, start, end, **options):
+        counter.update(units)
+        n_lines += 1
+    return counter, n_lines
+
+def binarize_range(job):
+    file_name, start, end, options, vocab, out_prefix = job
+    builder = indexed_dataset.make_builder(indexed_dataset.data_file_path(out_prefix),
+                                           impl='mmap', vocab_size=len(vocab))
+    n_seqs, n_tokens, n_unk = 0, 0, 0
+    for units in read_units(file_name, start, end, **options):
+        ids = [vocab.index(x) for x in units] + [vocab.eos()]
+        n_unk += sum(x == vocab.unk() for x in ids)
+        builder.add_item(torch.IntTensor(ids))
+        n_seqs += 1
+        n_tokens += len(ids)
+    builder.finalize(indexed_dataset.index_file_path(out_prefix))
+    return n_seqs, n_tokens, n_unk
+
+def build_dictionary(file_name, options, workers):
+    vocab = Dictionary()
+    jobs = [(file_name, start, end, options) for start, end in shard_ranges(file_name, workers)]
+    with Pool(workers) as pool:
+        results = pool.map(count_range, jobs)
+    counter = Counter()
+    for shard_counter, n_lines in results:
+        counter.update(shard_counter)
+        counter[vocab.eos_word] += n_lines
+    # Same order and thresholds as fairseq-preprocess
+    for word, count in sorted(counter.items()):
+        vocab.add_symbol(word, n=count)
+    vocab.finalize(threshold=-1, nwords=-1, padding_factor=8)
+    return vocab
+
+def binarize(file_name, out_prefix, vocab, options, workers):
+    ranges = shard_ranges(file_name, workers)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(out_prefix))
+    try:
+        jobs = [(file_name, start, end, options, vocab, os.path.join(tmp_dir, str(i)))
+                for i, (start, end) in enumerate(ranges)]
+        with Pool(workers) as pool:
+            results = pool.map(binarize_range, jobs)
+        builder = indexed_dataset.make_builder(indexed_dataset.data_file_path(out_prefix),
+                                               impl='mmap', vocab_size=len(vocab))
+        for job in jobs:
+            builder.merge_file_(job[-1])
+        builder.finalize(indexed_dataset.index_file_path(out_prefix))
+    finally:
+        shutil.rmtree(tmp_dir)
+    n_seqs, n_tokens, n_unk = [sum(x) for x in zip(*results)] if results else (0, 0, 0)
+    print(f"{file_name}: {n_seqs} sents, {n_tokens} tokens, "
+          f"{100 * n_unk / max(1, n_tokens):.3f}% replaced by {vocab.unk_word}")
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.makedirs(args.destdir, exist_ok=True)
+    options = {'input_format': args.input_format, 'dedup': args.dedup, 'max_units': args.max_units}
+    workers = max(1, args.workers)
+
+    vocab = build_dictionary(args.trainpref, options, workers)
+    vocab.save(os.path.join(args.destdir, 'dict.txt'))
+    print(f"Dictionary: {len(vocab)} types")
+
+    prefixes = {'train': args.trainpref, 'valid': args.validpref, 'test': args.testpref}
+    for split in SPLITS:
+        if prefixes[split] is not None:
+            binarize(prefixes[split], os.path.join(args.destdir, split), vocab, options, workers)
+    print(f"Wrote {args.destdir}")
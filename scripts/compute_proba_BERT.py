@@ -35,6 +35,20 @@ def parseArgs(argv):
                         help='For each sentence, the model has to compute the outputs of many different'
                         'masked sequences. This parameter controls the size of the inner batches for'
                         'each outer batch (defaut: 128). Decrease this for longer sentences (BLIMP).')
+    parser.add_argument('--max_tokens', type=int, default=None,
+                        help='If specified, group the masked sequences of sentences of similar lengths in inner '
+                        'batches of at most max_tokens padded tokens (inner_batch_size is then ignored).')
+    parser.add_argument('--pack_size', type=int, default=None,
+                        help='If specified, pack the masked sequences into rows of at most pack_size tokens '
+                        'with block diagonal attention (worth it for short sentences, inner_batch_size then counts '
+                        'rows and max_tokens the padded tokens of the rows).')
+    parser.add_argument('--masked_head', action='store_true',
+                        help='Compute the LM head at the masked positions only instead of every position. '
+                        'Faster, but the scores only match the default ones up to the rounding of the head, '
+                        'so existing score files are not reproduced bit for bit.')
+    parser.add_argument('--unit_vocab_only', action='store_true',
+                        help='Project the masked positions on the unit vocabulary only, the probabilities '
+                        'being renormalized without the special symbols.')
     parser.add_argument('--cpu', action='store_true',
                         help="Run on a cpu machine.")
     parser.add_argument('--resume', action='store_true',
@@ -125,7 +139,9 @@ def main(argv):
                             span_overlap=not args.no_overlap,
                             batchsen_size=args.batchsen_size, inner_batch_size = args.inner_batch_size,
                             gpu=not args.cpu, print_tokens=False, verbose=False, print_shape_statistics=False,
-                            save_to=args.pathOutputFile, file_names=input_file_names)
+                            save_to=args.pathOutputFile, file_names=input_file_names,
+                            masked_head=args.masked_head, unit_vocab_only=args.unit_vocab_only,
+                            max_tokens=args.max_tokens, pack_size=args.pack_size)
 
 if __name__ == "__main__":
     args = sys.argv[1:]
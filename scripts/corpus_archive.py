@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import soundfile as sf
+import torch
+from functools import lru_cache
+from multiprocessing import Pool
+
+DATA_NAME = 'data.pcm'
+INDEX_NAME = 'index.tsv'
+INDEX_HEADER = ['path', 'speaker', 'offset', 'length', 'sample_rate']
+
+
+class CorpusArchive(object):
+    r"""
+    A corpus decoded once into a single int16 PCM file, memory-mapped, with
+    a tab separated index (path, speaker, offset, length, sample_rate).
+    Sequences are read by slicing the mapping, without decoding nor copying.
+    """
+
+    def __init__(self, pathArchive):
+        self.pathArchive = pathArchive
+        self.seqs = []
+        self.index = {}
+        with open(os.path.join(pathArchive, INDEX_NAME), 'r') as f:
+            header = f.readline().rstrip('\n').split('\t')
+            assert header == INDEX_HEADER, \
+                f"Invalid archive index in {pathArchive}"
+            for line in f:
+                path, speaker, offset, length, sampleRate = line.rstrip('\n').split('\t')
+                self.index[seqKey(path)] = (int(offset), int(length), int(sampleRate))
+                self.seqs.append((int(speaker), path))
+        self.data = None
+
+    def __getstate__(self):
+        # The mapping is reopened in each process rather than pickled
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def getData(self):
+        if self.data is None:
+            # copy-on-write so that torch gets a writable view
+            self.data = np.memmap(os.path.join(self.pathArchive, DATA_NAME),
+                                  dtype=np.int16, mode='c')
+        return self.data
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return seqKey(path) in self.index
+
+    def getLength(self, path):
+        return self.index[seqKey(path)][1]
+
+    def getSampleRate(self, path):
+        return self.index[seqKey(path)][2]
+
+    def read(self, path):
+        r"""
+        Int16 view of the given sequence in the archive.
+        """
+        offset, length, _ = self.index[seqKey(path)]
+        return torch.from_numpy(self.getData()[offset:offset + length])
+
+    def readFloat(self, path):
+        r"""
+        The given sequence as a float tensor in [-1, 1], as sf.read would
+        return it.
+        """
+        return self.read(path).float() / 32768
+
+    def getSeqNames(self):
+        r"""
+        The archived sequences as (speaker index, path) couples, in the
+        order given by findAllSeqs_Mix when the archive was packed.
+        """
+        return list(self.seqs)
+
+
+def seqKey(path):
+    return os.path.normpath(str(path))
+
+
+@lru_cache(maxsize=None)
+def loadArchive(pathArchive):
+    r"""
+    Open the archive at pathArchive, once per process.
+    """
+    return CorpusArchive(pathArchive)
+
+
+def getFrames(path):
+    return sf.info(path).frames
+
+
+def writeSeq(args):
+    pathData, path, offset, length = args
+    seq, sampleRate = sf.read(path, dtype='int16')
+    if seq.ndim == 2:
+        seq = np.round(seq.mean(axis=1)).astype(np.int16)
+    data = np.memmap(pathData, dtype=np.int16, mode='r+',
+                     offset=2 * offset, shape=(length,))
+    seq = seq[:length]
+    data[:len(seq)] = seq
+    data.flush()
+    del data
+    return sampleRate
+
+
+def packCorpus(pathArchive, seqNames, nProcess=16):
+    r"""
+    Decode all the given sequences into a new archive at pathArchive.
+    Args:
+        - pathArchive (string): output directory
+        - seqNames (list): (speaker index, path) couples, as returned by
+                           findAllSeqs_Mix
+        - nProcess (int): number of processes decoding the audio
+    """
+    os.makedirs(pathArchive, exist_ok=True)
+    pathData = os.path.join(pathArchive, DATA_NAME)
+    paths = [seqKey(path) for _, path in seqNames]
+
+    start_time = time.time()
+    with Pool(nProcess) as pool:
+        lengths = pool.map(getFrames, paths, chunksize=64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+        totSize = offsets[-1]
+        print(f"{len(paths)} sequences, {totSize} samples to decode")
+        with open(pathData, 'wb') as f:
+            f.truncate(2 * totSize)
+        sampleRates = pool.map(writeSeq,
+                               [(pathData, path, offset, length)
+                                for path, offset, length
+                                in zip(paths, offsets, lengths)],
+                               chunksize=16)
+
+    with open(os.path.join(pathArchive, INDEX_NAME), 'w') as f:
+        f.write('\t'.join(INDEX_HEADER) + '\n')
+        for (speaker, _), path, offset, length, sampleRate \
+                in zip(seqNames, paths, offsets, lengths, sampleRates):
+            f.write(f"{path}\t{speaker}\t{offset}\t{length}\t{sampleRate}\n")
+    print(f"Archive written at {pathArchive} "
+          f"in {time.time() - start_time:.2f} seconds")
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Decode a corpus once into a memory-mapped int16 archive.')
+    parser.add_argument('pathArchive', type=str,
+                        help='Output directory of the archive.')
+    parser.add_argument('pathDB', type=str, nargs='+',
+                        help='Directories of the corpus.')
+    parser.add_argument('--extension', type=str, nargs='+',
+                        default=['.flac', '.wav'])
+    parser.add_argument('--speaker_level', type=int, default=1)
+    parser.add_argument('--nProcess', type=int, default=16)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parseArgs(argv)
+    pathDB = [os.path.abspath(x) for x in args.pathDB]
+    # dataset imports this module
+    from dataset import findAllSeqs_Mix
+    seqNames, _ = findAllSeqs_Mix(pathDB,
+                                  extension=args.extension,
+                                  speaker_level=args.speaker_level,
+                                  loadCache=True)
+    packCorpus(args.pathArchive, seqNames, nProcess=args.nProcess)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
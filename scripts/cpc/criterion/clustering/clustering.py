@@ -10,34 +10,132 @@ import torch.nn as nn
 from os.path import join, exists
 from os import remove
 from time import time
-import whisper
+
+
+PRECISIONS = {'fp32_gemm': torch.float32,
+              'bf16': torch.bfloat16,
+              'fp16': torch.float16}
+
+
+def clusterDistances(features, Ck, precision='fp32'):
+    r"""
+    Squared euclidean distances between features (N x D) and centroids
+    (k x D), as a N x k float32 tensor.
+    precision == 'fp32' computes the differences directly (reference path).
+    Otherwise the distances are expanded as |x|^2 - 2 x.c + |c|^2: the cross
+    term is a GEMM in the given precision ('fp32_gemm', 'bf16' or 'fp16')
+    while the norms are accumulated in float32.
+    """
+    if precision == 'fp32':
+        return ((features.unsqueeze(1) - Ck.unsqueeze(0))**2).sum(dim=2)
+    features, Ck = features.float(), Ck.float()
+    dtype = PRECISIONS[precision]
+    cross = (features.to(dtype) @ Ck.to(dtype).t()).float()
+    return (features**2).sum(dim=1, keepdim=True) - 2 * cross \
+        + (Ck**2).sum(dim=1).view(1, -1)
+
+
+def unitAgreement(features, Ck, precision, chunkSize=256):
+    r"""
+    Fraction of the features (N x D) assigned to the same centroid (k x D)
+    with the given precision as with the fp32 reference.
+    """
+    same = 0
+    for start in range(0, features.size(0), chunkSize):
+        chunk = features[start:start + chunkSize]
+        ref = clusterDistances(chunk, Ck, 'fp32').argmin(dim=1)
+        same += (clusterDistances(chunk, Ck, precision).argmin(dim=1)
+                 == ref).sum().item()
+    return same / max(features.size(0), 1)
+
+
+def selectPrecision(features, Ck, minAgreement=0.99, nRepeat=3):
+    r"""
+    Measure the speed and the unit-agreement rate against fp32 of each
+    precision on a sample of features (N x D) and return the fastest one
+    keeping the agreement above minAgreement.
+    """
+    def timeit(precision):
+        best = float('inf')
+        for _ in range(nRepeat):
+            if features.is_cuda:
+                torch.cuda.synchronize()
+            start_time = time()
+            for start in range(0, features.size(0), 256):
+                clusterDistances(features[start:start + 256], Ck,
+                                 precision).argmin(dim=1)
+            if features.is_cuda:
+                torch.cuda.synchronize()
+            best = min(best, time() - start_time)
+        return best
+
+    print(f"Selecting the assignment precision on {features.size(0)} items "
+          f"(min agreement {minAgreement})")
+    bestPrecision, bestTime = 'fp32', timeit('fp32')
+    print(f"fp32: {bestTime*1000:.2f} ms, agreement 1.0000")
+    with torch.no_grad():
+        for precision in PRECISIONS:
+            try:
+                agreement = unitAgreement(features, Ck, precision)
+                elapsed = timeit(precision)
+            except RuntimeError as err:
+                # e.g. fp16 matmul not implemented on this device
+                print(f"{precision}: not available ({err})")
+                continue
+            print(f"{precision}: {elapsed*1000:.2f} ms, agreement {agreement:.4f}")
+            if agreement >= minAgreement and elapsed < bestTime:
+                bestPrecision, bestTime = precision, elapsed
+    print(f"Using {bestPrecision} for the cluster assignment")
+    return bestPrecision
+
+
+def resolvePrecision(precision, dataLoader, computeFeature, Ck, minAgreement):
+    r"""
+    Run the agreement check on the first batch of the dataLoader when
+    precision == 'auto', otherwise return precision unchanged.
+    """
+    if precision != 'auto':
+        return precision
+    D = Ck.size(-1)
+    with torch.no_grad():
+        sample = computeFeature(next(iter(dataLoader))).reshape(-1, D)
+    return selectPrecision(sample, Ck.view(-1, D).to(sample.device), minAgreement)
 
 
 class kMeanCluster(nn.Module):
 
-    def __init__(self, Ck):
+    def __init__(self, Ck, precision='fp32'):
 
         super(kMeanCluster, self).__init__()
         self.register_buffer('Ck', Ck)
         self.k = Ck.size(1)
+        self.precision = precision
 
     def forward(self, features):
         B, S, D = features.size()
+        if self.precision != 'fp32':
+            return clusterDistances(features.reshape(B*S, D), self.Ck[0],
+                                    self.precision).view(-1, S, self.k)
         features = features.contiguous().view(B*S, 1, -1)
         return ((features - self.Ck)**2).sum(dim=2).view(-1, S, self.k)
 
 
 class kMeanClusterStep(torch.nn.Module):
 
-    def __init__(self, k, D):
+    def __init__(self, k, D, precision='fp32'):
 
         super(kMeanClusterStep, self).__init__()
         self.k = k
+        self.precision = precision
         self.register_buffer('Ck', torch.zeros(1, k, D))
 
     def forward(self, locF):
         #print("Start step")
-        index = ((locF - self.Ck)**2).mean(dim=2).min(dim=1)[1]
+        if self.precision != 'fp32':
+            index = clusterDistances(locF.view(locF.size(0), -1), self.Ck[0],
+                                     self.precision).min(dim=1)[1]
+        else:
+            index = ((locF - self.Ck)**2).mean(dim=2).min(dim=1)[1]
         Ck1 = torch.cat([locF[index == p].sum(dim=0, keepdim=True)
                          for p in range(self.k)], dim=1)
         nItems = torch.cat([(index == p).sum(dim=0, keepdim=True)
@@ -46,121 +144,55 @@ class kMeanClusterStep(torch.nn.Module):
         return Ck1, nItems
 
 
-def kMeanGPU(dataLoader, featureMaker, k, n_group=1,
-             MAX_ITER=100, EPSILON=1e-4,
-             perIterSize=-1, start_clusters=None,
-             save=False, load=False, save_dir=None,
-             save_last=5, layer=-1):
-
-    print(f"Start Kmean clustering with {k} clusters and {n_group} groups...")
-
-    if save or load:
-        assert save_dir is not None
-
-    if start_clusters is None:
-        if load and exists(join(save_dir, "checkpoint_last.pt")):
-            print("Loading from last checkpoint")
-            state_dict = torch.load(join(save_dir, "checkpoint_last.pt"))
-            Ck = state_dict["state_dict"]["Ck"]
-            D = Ck.size(2)
-        else:
-            Ck = []
-            with torch.no_grad():
-                for index, data in enumerate(dataLoader):
-                    cFeature = featureMaker(data)
-                    cFeature = cFeature.contiguous().view(-1, cFeature.size(2)//n_group)
-                    Ck.append(cFeature)
-                    if index > k:
-                        break
-            Ck = torch.cat(Ck, dim=0)
-            N, D = Ck.size()
-            indexes = torch.randperm(N)[:k]
-            Ck = Ck[indexes].view(1, k, D)
-    else:
-        Ck = start_clusters
-        D = Ck.size(2)
-
-    if perIterSize < 0:
-        perIterSize = len(dataLoader)
-
-    clusterStep = kMeanClusterStep(k, D).cuda()
-    clusterStep = torch.nn.DataParallel(clusterStep)
-    clusterStep.module.Ck.copy_(Ck)
-
-    bar = progressbar.ProgressBar(maxval=MAX_ITER)
-    bar.start()
-    iter, stored = 0, 0
-    if load and start_clusters is None and exists(join(save_dir, "checkpoint_last.pt")):
-        iter = state_dict["iteration"]
-        lastDiff = state_dict["lastDiff"]
-        print(f"Continuing training from iteration {iter}. lastDiff: {lastDiff}")
+def fitDimReduction(dataLoader, computeFeature, dimReduction):
+    r"""
+    Fit the dimensionality reduction with one pass over the dataLoader.
+    computeFeature must return the features before any reduction.
+    """
+    print(f"Fitting the dimensionality reduction on {len(dataLoader)} batches...")
+    start_time = time()
     with torch.no_grad():
-        while iter < MAX_ITER:
-            start_time = time()
-            Ck1 = torch.zeros(Ck.size()).cuda()
-            nItemsClusters = torch.zeros(Ck.size(1),
-                                         dtype=torch.long).cuda()
-            for index, data in enumerate(dataLoader):
-                cFeature = featureMaker(data).contiguous().view(-1, 1, D)
-                locC, locN = clusterStep(cFeature)
-                Ck1 += locC.sum(dim=0, keepdim=True)
-                nItemsClusters += locN.sum(dim=0)
-                ### If the training set is too big and we want to redude the number of item per iteration
-                # stored += 1
-                # if stored >= perIterSize:
-                #     bar.update(iter)
-                #     iter += 1
-                #     stored = 0
-                #     if iter >= MAX_ITER:
-                #         break
+        for data in dataLoader:
+            dimReduction.update(computeFeature(data))
+    dimReduction.fit()
+    print(f"Dimensionality reduction fitted in {time()-start_time:.2f} seconds")
+
+
+def checkResumedReductions(pathCheckpoint, state_dict, dimReduction, frameReduction):
+    r"""
+    The clusters of a checkpoint live in the space of the reductions it was
+    saved with: raise an error if they differ from the configured ones, in
+    either direction (eg. a pca saved but none configured).
+    """
+    savedDim = state_dict.get("dimReduction")
+    if savedDim is not None:
+        savedDim = (savedDim["type"], savedDim["dim"])
+    configDim = None
+    if dimReduction is not None:
+        configDim = ("whitening" if dimReduction.whiten else "pca", dimReduction.outDim)
+    savedFrame = state_dict.get("frameReduction")
+    configFrame = frameReduction.getState() if frameReduction is not None else None
+    for name, saved, configured in [("dimensionality reduction", savedDim, configDim),
+                                    ("frame reduction", savedFrame, configFrame)]:
+        if saved != configured:
+            raise ValueError(f"{pathCheckpoint} was saved with the {name} {saved}, but {configured} "
+                             "is configured: remove the checkpoint or change the config to resume")
 
-            iter += 1
-            bar.update(iter)
 
-            nItemsClusters = nItemsClusters.float().view(1, -1, 1) + 1e-8
-            Ck1 /= nItemsClusters
-            lastDiff = (clusterStep.module.Ck - Ck1).norm(dim=2).max().item()
-            nItems = int(nItemsClusters.sum().cpu().detach().item())
-            info=f"ITER {iter} done in {time()-start_time:.2f} seconds. nItems: {nItems}. Difference with last checkpoint: {lastDiff}"
-            print(info)
-            with open(join(save_dir, "training_logs.txt"), "a") as f:
-                f.write(info+"\n")
-            if save:
-                info=f"Saving last checkpoint to {join(save_dir, 'checkpoint_last.pt')}"
-                print(info)
-                with open(join(save_dir, "training_logs.txt"), "a") as f:
-                    f.write(info+"\n")
-                out_state_dict = {}
-                clusterModule = kMeanCluster(Ck1)
-                out_state_dict["state_dict"] = clusterModule.state_dict()
-                out_state_dict["n_clusters"] = Ck1.size(1)
-                out_state_dict['dim'] = Ck1.size(2)
-                out_state_dict["iteration"] = iter
-                out_state_dict["lastDiff"] = lastDiff
-                torch.save(out_state_dict, join(save_dir, "checkpoint_last.pt"))
-                torch.save(out_state_dict, join(save_dir, f"checkpoint_{iter}.pt"))
-                if exists(join(save_dir, f"checkpoint_{iter-save_last}.pt")):
-                    remove(join(save_dir, f"checkpoint_{iter-save_last}.pt"))
-            if lastDiff < EPSILON:
-                print(
-                    f"Clustering ended in {iter} iterations out of {MAX_ITER}")
-                break
-            clusterStep.module.Ck.copy_(Ck1)
-
-    bar.finish()
-
-    print(f"Clustering ended in {MAX_ITER} iterations out of {MAX_ITER}")
-    print(f"Last diff {lastDiff}")
-    if start_clusters is not None:
-        nEmptyClusters = (nItemsClusters < 1).sum().item()
-        print(f"{nEmptyClusters} empty clusters out of {k}")
-    return clusterStep.module.Ck
-
-def kMeanGPU_S3PRL(dataLoader, featureMaker, k, n_group=1,
+def kMeanGPU(dataLoader, featureMaker, k, n_group=1,
              MAX_ITER=100, EPSILON=1e-4,
              perIterSize=-1, start_clusters=None,
              save=False, load=False, save_dir=None,
-             save_last=5, layer=-1):
+             save_last=5, device_ids=None, dimReduction=None,
+             precision='fp32', minAgreement=0.99, frameReduction=None):
+    r"""
+    Kmeans clustering of the features computed by featureMaker on the batches
+    of dataLoader. featureMaker is any module mapping a (batch, label) couple
+    to a B x S x D tensor of features, e.g. an EncoderAdapter for the fairseq,
+    s3prl and whisper backends (see feature_loader.py). The features go
+    through frameReduction (see frame_reduction.py), then dimReduction,
+    when given.
+    """
 
     print(f"Start Kmean clustering with {k} clusters and {n_group} groups...")
 
@@ -168,133 +200,15 @@ def kMeanGPU_S3PRL(dataLoader, featureMaker, k, n_group=1,
         assert save_dir is not None
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     featureMaker.eval()
-    if start_clusters is None:
-        if load and exists(join(save_dir, "checkpoint_last.pt")):
-            print("Loading from last checkpoint")
-            state_dict = torch.load(join(save_dir, "checkpoint_last.pt"))
-            print(f"Successful loaded from {join(save_dir, 'checkpoint_last.pt')}")
-            Ck = state_dict["state_dict"]["Ck"]
-            D = Ck.size(2)
-        else:
-            Ck = []
-            with torch.no_grad():
-                for index, data in enumerate(dataLoader): # (batch size, 1, seqlen)
-                    exact_data, _ = data
-                    #print(len(data), type(data), type(data[0]), data[0].shape, type(data[1]), data[1].shape)
-                    #return
-                    s3prl_data = []
-                    for idx in range(exact_data.shape[0]):
-                        wavs = exact_data[idx]
-                        s3prl_data.append(wavs.squeeze().float().to(device))
-                    cFeature = featureMaker(s3prl_data)['hidden_states'][layer]  # (batch size, max length of the encoded seq, 768) 
-                    cFeature = cFeature.contiguous().view(-1, cFeature.size(2)//n_group)
-                    Ck.append(cFeature)
-                    if index > k:
-                        break
-            Ck = torch.cat(Ck, dim=0)
-            N, D = Ck.size()
-            indexes = torch.randperm(N)[:k]
-            Ck = Ck[indexes].view(1, k, D)
-    else:
-        Ck = start_clusters
-        D = Ck.size(2)
-
-    if perIterSize < 0:
-        perIterSize = len(dataLoader)
-
-    clusterStep = kMeanClusterStep(k, D).cuda()
-    clusterStep = torch.nn.DataParallel(clusterStep)
-    clusterStep.module.Ck.copy_(Ck)
-
-    bar = progressbar.ProgressBar(maxval=MAX_ITER)
-    bar.start()
-    iter, stored = 0, 0
-    if load and start_clusters is None and exists(join(save_dir, "checkpoint_last.pt")):
-        iter = state_dict["iteration"]
-        lastDiff = state_dict["lastDiff"]
-        print(f"Continuing training from iteration {iter}. lastDiff: {lastDiff}")
-    with torch.no_grad():
-        while iter < MAX_ITER:
-            start_time = time()
-            Ck1 = torch.zeros(Ck.size()).cuda()
-            nItemsClusters = torch.zeros(Ck.size(1),
-                                         dtype=torch.long).cuda()
-            for index, data in enumerate(dataLoader):
-                exact_data, _ = data
-
-                s3prl_data = []
-                for idx in range(exact_data.shape[0]):
-                    wavs = exact_data[idx]
-                    s3prl_data.append(wavs.squeeze().float().to(device))
-                cFeature = featureMaker(s3prl_data)['hidden_states'][layer]  # (batch size, max length of the encoded seq, 768) 
-                cFeature = cFeature.contiguous().view(-1, 1, D)
-                locC, locN = clusterStep(cFeature)
-                Ck1 += locC.sum(dim=0, keepdim=True)
-                nItemsClusters += locN.sum(dim=0)
-                ### If the training set is too big and we want to redude the number of item per iteration
-                # stored += 1
-                # if stored >= perIterSize:
-                #     bar.update(iter)
-                #     iter += 1
-                #     stored = 0
-                #     if iter >= MAX_ITER:
-                #         break
 
-            iter += 1
-            bar.update(iter)
+    def computeFeature(data):
+        cFeature = featureMaker(data)  # (batch size, max length of the encoded seq, dim)
+        if frameReduction is not None:
+            cFeature = frameReduction(cFeature)
+        if dimReduction is not None and dimReduction.isFitted():
+            cFeature = dimReduction(cFeature)
+        return cFeature
 
-            nItemsClusters = nItemsClusters.float().view(1, -1, 1) + 1e-8
-            Ck1 /= nItemsClusters
-            lastDiff = (clusterStep.module.Ck - Ck1).norm(dim=2).max().item()
-            nItems = int(nItemsClusters.sum().cpu().detach().item())
-            info=f"ITER {iter} done in {time()-start_time:.2f} seconds. nItems: {nItems}. Difference with last checkpoint: {lastDiff}"
-            print(info)
-            with open(join(save_dir, "training_logs.txt"), "a") as f:
-                f.write(info+"\n")
-            if save:
-                info=f"Saving last checkpoint to {join(save_dir, 'checkpoint_last.pt')}"
-                print(info)
-                with open(join(save_dir, "training_logs.txt"), "a") as f:
-                    f.write(info+"\n")
-                out_state_dict = {}
-                clusterModule = kMeanCluster(Ck1)
-                out_state_dict["state_dict"] = clusterModule.state_dict()
-                out_state_dict["n_clusters"] = Ck1.size(1)
-                out_state_dict['dim'] = Ck1.size(2)
-                out_state_dict["iteration"] = iter
-                out_state_dict["lastDiff"] = lastDiff
-                torch.save(out_state_dict, join(save_dir, "checkpoint_last.pt"))
-                torch.save(out_state_dict, join(save_dir, f"checkpoint_{iter}.pt"))
-                if exists(join(save_dir, f"checkpoint_{iter-save_last}.pt")):
-                    remove(join(save_dir, f"checkpoint_{iter-save_last}.pt"))
-            if lastDiff < EPSILON:
-                print(
-                    f"Clustering ended in {iter} iterations out of {MAX_ITER}")
-                break
-            clusterStep.module.Ck.copy_(Ck1)
-
-    bar.finish()
-
-    print(f"Clustering ended in {MAX_ITER} iterations out of {MAX_ITER}")
-    print(f"Last diff {lastDiff}")
-    if start_clusters is not None:
-        nEmptyClusters = (nItemsClusters < 1).sum().item()
-        print(f"{nEmptyClusters} empty clusters out of {k}")
-    return clusterStep.module.Ck
-
-
-def kMeanGPU_fairseq(dataLoader, featureMaker, k, n_group=1,
-             MAX_ITER=100, EPSILON=1e-4,
-             perIterSize=-1, start_clusters=None,
-             save=False, load=False, save_dir=None,
-             save_last=5, device_ids=[0,1,2,3], layer=-1):
-
-    print(f"Start Kmean clustering with {k} clusters and {n_group} groups...")
-
-    if save or load:
-        assert save_dir is not None
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    featureMaker.eval()
     if start_clusters is None:
         if load and exists(join(save_dir, "checkpoint_last.pt")):
             print("Loading from last checkpoint")
@@ -302,18 +216,18 @@ def kMeanGPU_fairseq(dataLoader, featureMaker, k, n_group=1,
             print(f"Successful loaded from {join(save_dir, 'checkpoint_last.pt')}")
             Ck = state_dict["state_dict"]["Ck"]
             D = Ck.size(2)
+            checkResumedReductions(join(save_dir, "checkpoint_last.pt"), state_dict,
+                                   dimReduction, frameReduction)
+            if dimReduction is not None:
+                dimReduction.loadState(state_dict["dimReduction"])
+                dimReduction.to(device)
         else:
-            
+            if dimReduction is not None:
+                fitDimReduction(dataLoader, computeFeature, dimReduction)
             Ck = []
             with torch.no_grad():
                 for index, data in enumerate(dataLoader): # (batch size, 1, seqlen)
-                    #print(index)
-                    exact_data, _ = data
-                    exact_data = torch.squeeze(exact_data, 1).to(device) # B x Seqlen?
-                    if layer != -1:
-                        cFeature = featureMaker(exact_data, features_only=True, mask=False, layer=layer)['x']
-                    else:
-                        cFeature = featureMaker(exact_data, features_only=True, mask=False)['x']
+                    cFeature = computeFeature(data)
                     cFeature = cFeature.contiguous().view(-1, cFeature.size(2)//n_group)
                     Ck.append(cFeature)
                     if index > k:
@@ -329,7 +243,9 @@ def kMeanGPU_fairseq(dataLoader, featureMaker, k, n_group=1,
     if perIterSize < 0:
         perIterSize = len(dataLoader)
 
-    clusterStep = kMeanClusterStep(k, D).cuda()
+    precision = resolvePrecision(precision, dataLoader, computeFeature, Ck,
+                                 minAgreement)
+    clusterStep = kMeanClusterStep(k, D, precision).cuda()
     clusterStep = torch.nn.DataParallel(clusterStep, device_ids=device_ids)
     clusterStep.module.Ck.copy_(Ck)
 
@@ -342,28 +258,12 @@ def kMeanGPU_fairseq(dataLoader, featureMaker, k, n_group=1,
         print(f"Continuing training from iteration {iter}. lastDiff: {lastDiff}")
     with torch.no_grad():
         while iter < MAX_ITER:
-            #print("Iter: ", iter)
             start_time = time()
             Ck1 = torch.zeros(Ck.size()).cuda()
             nItemsClusters = torch.zeros(Ck.size(1),
                                          dtype=torch.long).cuda()
             for index, data in enumerate(dataLoader):
-                #print(index)
-                exact_data, _ = data
-
-                    #print(len(data), type(data), type(data[0]), data[0].shape, type(data[1]), data[1].shape)
-                    #return
-                    #s3prl_data = []
-                    #for idx in range(exact_data.shape[0]):
-                    #    wavs = exact_data[idx]
-                    #    s3prl_data.append(wavs.squeeze().float().to(device))
-                    #cFeature = featureMaker(s3prl_data)['hidden_states'][-1]  # (batch size, max length of the encoded seq, 768) 
-                exact_data = torch.squeeze(exact_data, 1).to(device) # B x Seqlen?
-                if layer != -1:
-                    cFeature = featureMaker(exact_data, features_only=True, mask=False, layer=layer)['x']
-                else:
-                    cFeature = featureMaker(exact_data, features_only=True, mask=False)['x']
-                #cFeature = output['x'].contiguous().view(-1, cFeature.size(2)//n_group)
+                cFeature = computeFeature(data)
                 cFeature = cFeature.contiguous().view(-1, 1, D)
                 locC, locN = clusterStep(cFeature)
                 Ck1 += locC.sum(dim=0, keepdim=True)
@@ -400,6 +300,10 @@ def kMeanGPU_fairseq(dataLoader, featureMaker, k, n_group=1,
                 out_state_dict['dim'] = Ck1.size(2)
                 out_state_dict["iteration"] = iter
                 out_state_dict["lastDiff"] = lastDiff
+                if dimReduction is not None:
+                    out_state_dict["dimReduction"] = dimReduction.getState()
+                if frameReduction is not None:
+                    out_state_dict["frameReduction"] = frameReduction.getState()
                 torch.save(out_state_dict, join(save_dir, "checkpoint_last.pt"))
                 torch.save(out_state_dict, join(save_dir, f"checkpoint_{iter}.pt"))
                 if exists(join(save_dir, f"checkpoint_{iter-save_last}.pt")):
@@ -418,137 +322,3 @@ def kMeanGPU_fairseq(dataLoader, featureMaker, k, n_group=1,
         nEmptyClusters = (nItemsClusters < 1).sum().item()
         print(f"{nEmptyClusters} empty clusters out of {k}")
     return clusterStep.module.Ck
-
-def kMeanGPU_whisper(dataLoader, featureMaker, k, n_group=1,
-             MAX_ITER=100, EPSILON=1e-4,
-             perIterSize=-1, start_clusters=None,
-             save=False, load=False, save_dir=None,
-             save_last=5, layer=-1):
-
-    print(f"Start Kmean clustering with {k} clusters and {n_group} groups...")
-
-    if save or load:
-        assert save_dir is not None
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    featureMaker.eval()
-    if start_clusters is None:
-        if load and exists(join(save_dir, "checkpoint_last.pt")):
-            print("Loading from last checkpoint")
-            state_dict = torch.load(join(save_dir, "checkpoint_last.pt"))
-            print(f"Successful loaded from {join(save_dir, 'checkpoint_last.pt')}")
-            Ck = state_dict["state_dict"]["Ck"]
-            D = Ck.size(2)
-        else:
-            
-            Ck = []
-            with torch.no_grad():
-                for index, data in enumerate(dataLoader): # (batch size, 1, seqlen)
-                    exact_data, _ = data
-                    exact_data = torch.squeeze(exact_data, 1).to(device) # B x Seqlen
-                    size = exact_data.shape[-1]
-                    exact_data = whisper.pad_or_trim(exact_data)
-                    mel = whisper.log_mel_spectrogram(exact_data).to(device) # B, 80, 3000
-                    cFeature = featureMaker.embed_audio(mel) # B, 1500, Dim
-                    
-                    feature_len = int(size / 16000 * 50)  # 16000 is sample rate
-                    cFeature = cFeature[:, :feature_len, :]
-                    
-                    cFeature = cFeature.contiguous().view(-1, cFeature.size(2)//n_group)
-                    Ck.append(cFeature)
-                    if index > k:
-                        break
-            Ck = torch.cat(Ck, dim=0)
-            N, D = Ck.size()
-            indexes = torch.randperm(N)[:k]
-            Ck = Ck[indexes].view(1, k, D)
-    else:
-        Ck = start_clusters
-        D = Ck.size(2)
-
-    if perIterSize < 0:
-        perIterSize = len(dataLoader)
-
-    clusterStep = kMeanClusterStep(k, D).cuda()
-    clusterStep = torch.nn.DataParallel(clusterStep)
-    clusterStep.module.Ck.copy_(Ck)
-
-    bar = progressbar.ProgressBar(maxval=MAX_ITER)
-    bar.start()
-    iter, stored = 0, 0
-    if load and start_clusters is None and exists(join(save_dir, "checkpoint_last.pt")):
-        iter = state_dict["iteration"]
-        lastDiff = state_dict["lastDiff"]
-        print(f"Continuing training from iteration {iter}. lastDiff: {lastDiff}")
-        
-    with torch.no_grad():
-        while iter < MAX_ITER:
-            #print("Iter: ", iter)
-            start_time = time()
-            Ck1 = torch.zeros(Ck.size()).cuda()
-            nItemsClusters = torch.zeros(Ck.size(1),
-                                         dtype=torch.long).cuda()
-            for index, data in enumerate(dataLoader):
-                #print(index)
-                exact_data, _ = data
-                exact_data = torch.squeeze(exact_data, 1).to(device) # B x Seqlen?
-                size = exact_data.shape[-1]
-                exact_data = whisper.pad_or_trim(exact_data)
-                mel = whisper.log_mel_spectrogram(exact_data).to(device) # B, 80, 3000
-                cFeature = featureMaker.embed_audio(mel) # B, 1500, Dim
-                feature_len = int(size / 16000 * 50) # 16000 is sample rate
-                cFeature = cFeature[:, :feature_len, :]
-                cFeature = cFeature.contiguous().view(-1, 1, D)
-
-                locC, locN = clusterStep(cFeature)
-                Ck1 += locC.sum(dim=0, keepdim=True)
-                nItemsClusters += locN.sum(dim=0)
-                ### If the training set is too big and we want to redude the number of item per iteration
-                # stored += 1
-                # if stored >= perIterSize:
-                #     bar.update(iter)
-                #     iter += 1
-                #     stored = 0
-                #     if iter >= MAX_ITER:
-                #         break
-
-            iter += 1
-            bar.update(iter)
-
-            nItemsClusters = nItemsClusters.float().view(1, -1, 1) + 1e-8
-            Ck1 /= nItemsClusters
-            lastDiff = (clusterStep.module.Ck - Ck1).norm(dim=2).max().item()
-            nItems = int(nItemsClusters.sum().cpu().detach().item())
-            info=f"ITER {iter} done in {time()-start_time:.2f} seconds. nItems: {nItems}. Difference with last checkpoint: {lastDiff}"
-            print(info)
-            with open(join(save_dir, "training_logs.txt"), "a") as f:
-                f.write(info+"\n")
-            if save:
-                info=f"Saving last checkpoint to {join(save_dir, 'checkpoint_last.pt')}"
-                print(info)
-                with open(join(save_dir, "training_logs.txt"), "a") as f:
-                    f.write(info+"\n")
-                out_state_dict = {}
-                clusterModule = kMeanCluster(Ck1)
-                out_state_dict["state_dict"] = clusterModule.state_dict()
-                out_state_dict["n_clusters"] = Ck1.size(1)
-                out_state_dict['dim'] = Ck1.size(2)
-                out_state_dict["iteration"] = iter
-                out_state_dict["lastDiff"] = lastDiff
-                torch.save(out_state_dict, join(save_dir, "checkpoint_last.pt"))
-                torch.save(out_state_dict, join(save_dir, f"checkpoint_{iter}.pt"))
-                if exists(join(save_dir, f"checkpoint_{iter-save_last}.pt")):
-                    remove(join(save_dir, f"checkpoint_{iter-save_last}.pt"))
-            if lastDiff < EPSILON:
-                print(
-                    f"Clustering ended in {iter} iterations out of {MAX_ITER}")
-                break
-            clusterStep.module.Ck.copy_(Ck1)
-
-    bar.finish()
-
-    print(f"Clustering ended in {MAX_ITER} iterations out of {MAX_ITER}")
-    print(f"Last diff {lastDiff}")
-    if start_clusters is not None:
-        nEmptyClusters = (nItemsClusters < 1).sum().item()
-        print(f"{nEmptyClusters} empty clusters out of {k}")
-    return clusterStep.module.Ck
\ No newline at end of file
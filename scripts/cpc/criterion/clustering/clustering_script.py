@@ -10,12 +10,15 @@ import sys
 import os
 import json
 from random import shuffle
-from clustering import kMeanCluster, kMeanGPU_fairseq, kMeanGPU_S3PRL, kMeanGPU_whisper
+from clustering import kMeanCluster, kMeanGPU
+from dim_reduction import buildDimReduction
+from frame_reduction import buildFrameReduction
 from pathlib import Path
-import fairseq
 import yaml
-import s3prl.hub as hub
-import whisper
+sys.path.append(str(Path(__file__).resolve().parents[3]))
+from feature_loader import loadEncoder
+from manifest import loadManifests
+from selection import selectSeqs
 
 def getQuantile(sortedData, percent):
     return sortedData[int(percent * len(sortedData))]
@@ -87,7 +90,7 @@ if __name__ == "__main__":
 
     import os
     #from cpc.feature_loader import loadModel, FeatureModule
-    from dataset import findAllSeqs, filterSeqs, AudioBatchData, findAllSeqs_Mix
+    from dataset import findAllSeqs, filterSeqs, AudioBatchData, findAllSeqs_Mix, RandomWindowDataset
 
     args = parseArgs(sys.argv[1:])
 
@@ -118,13 +121,24 @@ if __name__ == "__main__":
             f"Found last_checkpoint.pt in the output directory, please check the option --load !"
     recursionLevel = config['data']['recursionLevel']
     extension = config['data']['extension']
-    seqNames, speakers = findAllSeqs_Mix(pathDB,
-                                    speaker_level=recursionLevel,
-                                    extension=extension,
-                                    loadCache=True)
-    seqList = config['data']['seqList']
-    if seqList is not None:
-        seqNames = filterSeqs(seqList, seqNames)
+    seqLengths = None
+    manifest = config['data'].get('manifest')
+    if manifest is not None:
+        seqNames, speakers, seqLengths = loadManifests(pathDB,
+                                                       extension=extension,
+                                                       speaker_level=recursionLevel,
+                                                       refresh=manifest == 'refresh')
+    else:
+        seqNames, speakers = findAllSeqs_Mix(pathDB,
+                                        speaker_level=recursionLevel,
+                                        extension=extension,
+                                        loadCache=True)
+    seqNames = selectSeqs(seqNames,
+                          include=config['data']['seqList'],
+                          exclude=config['data'].get('excludeSeq'),
+                          glob=config['data'].get('glob'),
+                          regex=config['data'].get('regex'),
+                          matchStem=config['data'].get('matchStem', False))
 
     debug = config['runner']['debug']
     #print(seqNames)
@@ -140,23 +154,32 @@ if __name__ == "__main__":
         shuffle(seqNames)
         seqNames = seqNames[:5000]
 
+    batchSizeGPU = config['data']['batchSizeGPU']
+    nGPUs = torch.cuda.device_count()
+    batchSize = batchSizeGPU * nGPUs
+    sizeWindow = config['data']['sizeWindow']
+
     print("")
     print(f'Loading audio data at {pathDB}')
     start_time = time.time()
-    sizeWindow = config['data']['sizeWindow']
-    dataset = AudioBatchData(pathDB,
-                             sizeWindow,
-                             seqNames,
-                             None,
-                             len(speakers))
+    if config['data'].get('randomWindows', False):
+        trainLoader = RandomWindowDataset(seqNames,
+                                          sizeWindow,
+                                          batchSize,
+                                          seqLengths=seqLengths,
+                                          pathArchive=config['data'].get('pathArchive'))
+    else:
+        dataset = AudioBatchData(pathDB,
+                                 sizeWindow,
+                                 seqNames,
+                                 None,
+                                 len(speakers),
+                                 pathArchive=config['data'].get('pathArchive'),
+                                 seqLengths=seqLengths)
+        trainLoader = dataset.getDataLoader(batchSize, "uniform", False)
     print(f"Dataset loaded in {time.time()-start_time} seconds !")
     print("")
 
-    batchSizeGPU = config['data']['batchSizeGPU']
-    nGPUs = torch.cuda.device_count()
-    batchSize = batchSizeGPU * nGPUs
-    trainLoader = dataset.getDataLoader(batchSize, "uniform",
-                                        False, numWorkers=16)
     device_ids = list(range(nGPUs))
     print(f"Length of dataLoader: {len(trainLoader)}")
     print("")
@@ -172,38 +195,12 @@ if __name__ == "__main__":
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     # featureMaker = getattr(hub, args.model_type)().to(device).eval()
     
-    model_name = None
-    flag = None
-    if config['runner']['cp_path'] is not None:
-        cp_path = config['runner']['cp_path']
-        flag = 'fairseq'
-        model_name = cp_path
-        model, cfg, task = fairseq.checkpoint_utils.load_model_ensemble_and_task([cp_path])
-        #featureMaker = torch.nn.DataParallel(model[0]).to(device)
-        featureMaker = model[0].to(device)
-
-    elif config['runner']['s3prl'] is not None:
-        flag = 's3prl'
-        model_name = config['runner']['s3prl']
-        featureMaker = getattr(hub, config['runner']['s3prl'])().to(device)
-    
-    elif config['runner']['whisper'] is not None:
-        flag = 'whisper'
-        model_name = f'whisper-{config["runner"]["whisper"]}'
-        featureMaker = whisper.load_model(config['runner']['whisper']).to(device)
-        print(featureMaker)
-    else:
-        print("Please specify the speech encoder in the config file.")
-        raise
-    
-    featureMaker.eval()
-    print(f"Feature maker {model_name} loaded!")
+    featureMaker = loadEncoder(config['runner'], device)
+    print(f"Feature maker {featureMaker.name} loaded!")
     print("")
 
-    
-    if not config['runner']['train_mode']:
-        featureMaker.eval()
-    featureMaker.cuda()
+    if config['runner']['train_mode']:
+        featureMaker.train()
 
     # Check if dir exists
     if not os.path.exists(os.path.dirname(pathOutput)) and os.path.dirname(pathOutput):
@@ -215,46 +212,28 @@ if __name__ == "__main__":
     with open(pathConfig, 'w') as file:
         documents = yaml.dump(config, file)
 
+    dimReduction = buildDimReduction(config['runner']['dimReduction'],
+                                     config['runner'].get('dimReductionSize'))
+    frameReduction = buildFrameReduction(config['runner'].get('frameRate'),
+                                         config['runner'].get('frameReduction', 'mean'))
+
     out_state_dict = {}
     print("Starting the clustering...")
     start_time = time.time()
 
-    assert flag in ['fairseq', 's3prl', 'whisper'], "Currently only supported speech encoder from s3prl, fairseq and whisper."
-    
-    if flag == 'fairseq':
-        clusters = kMeanGPU_fairseq(trainLoader, featureMaker.eval(), config['runner']['nClusters'], config['runner']['nGroups'],
-                                perIterSize=config['runner']['perIterSize'],
-                                MAX_ITER=config['runner']['MAX_ITER'],
-                                save=config['runner']['save'], load=load, 
-                                save_dir=os.path.dirname(pathOutput),
-                                save_last=config['runner']['save_last'],
-                                EPSILON=config['runner']['epsilon'],
-                                device_ids=device_ids,
-                                layer=config['runner']['layer']
-                                ).cpu()
-    
-    elif flag == 's3prl':
-        clusters = kMeanGPU_S3PRL(trainLoader, featureMaker.eval(), config['runner']['nClusters'], config['runner']['nGroups'],
-                                perIterSize=config['runner']['perIterSize'],
-                                MAX_ITER=config['runner']['MAX_ITER'],
-                                save=config['runner']['save'], load=load, 
-                                save_dir=os.path.dirname(pathOutput),
-                                save_last=config['runner']['save_last'],
-                                EPSILON=config['runner']['epsilon'],
-                                layer=config['runner']['layer']
-                                ).cpu()
-    
-    elif flag == 'whisper':
-        clusters = kMeanGPU_whisper(trainLoader, featureMaker.eval(), config['runner']['nClusters'], config['runner']['nGroups'],
-                                perIterSize=config['runner']['perIterSize'],
-                                MAX_ITER=config['runner']['MAX_ITER'],
-                                save=config['runner']['save'], load=load, 
-                                save_dir=os.path.dirname(pathOutput),
-                                save_last=config['runner']['save_last'],
-                                EPSILON=config['runner']['epsilon'],
-                                layer=config['runner']['layer']
-                                ).cpu()
-
+    clusters = kMeanGPU(trainLoader, featureMaker, config['runner']['nClusters'], config['runner']['nGroups'],
+                        perIterSize=config['runner']['perIterSize'],
+                        MAX_ITER=config['runner']['MAX_ITER'],
+                        save=config['runner']['save'], load=load,
+                        save_dir=os.path.dirname(pathOutput),
+                        save_last=config['runner']['save_last'],
+                        EPSILON=config['runner']['epsilon'],
+                        device_ids=device_ids,
+                        dimReduction=dimReduction,
+                        precision=config['runner'].get('precision', 'fp32'),
+                        minAgreement=config['runner'].get('minAgreement', 0.99),
+                        frameReduction=frameReduction
+                        ).cpu()
 
     print(f'Ran clustering '
           f'in {time.time() - start_time:.2f} seconds')
@@ -264,6 +243,10 @@ if __name__ == "__main__":
     out_state_dict["encoder_layer"] = config['runner']['encoder_layer']
     out_state_dict["n_clusters"] = config['runner']['nClusters']
     out_state_dict['dim'] = clusters.size(2)
+    if dimReduction is not None:
+        out_state_dict["dimReduction"] = dimReduction.getState()
+    if frameReduction is not None:
+        out_state_dict["frameReduction"] = frameReduction.getState()
     torch.save(out_state_dict, pathOutput)
     with open(pathConfig, 'w') as file:
         documents = yaml.dump(config, file)
\ No newline at end of file
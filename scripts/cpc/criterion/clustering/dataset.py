@@ -3,19 +3,28 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 import os
+import bisect
 import random
 import time
 import tqdm
 import torch
+import numpy as np
 import soundfile as sf
 from pathlib import Path
 from copy import deepcopy
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from torch.multiprocessing import Pool
-from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.sampler import Sampler, BatchSampler
+from torch.utils.data import Dataset
+from torch.utils.data.sampler import Sampler
 
 import torchaudio
 
+from corpus_archive import loadArchive
+from dir_scanner import listFiles
+from manifest import isSubset, readSubset
+from selection import includeSeqs, readSeqList
+
 
 class AudioBatchData(Dataset):
 
@@ -26,7 +35,9 @@ class AudioBatchData(Dataset):
                  phoneLabelsDict,
                  nSpeakers,
                  nProcessLoader=50,
-                 MAX_SIZE_LOADED=4000000000):
+                 MAX_SIZE_LOADED=8000000000,
+                 pathArchive=None,
+                 seqLengths=None):
         """
         Args:
             - path (string): path to the training dataset
@@ -41,11 +52,20 @@ class AudioBatchData(Dataset):
            - nSpeakers (int): number of speakers to expect.
            - nProcessLoader (int): number of processes to call when loading the
                                    data from the disk
-           - MAX_SIZE_LOADED (int): target maximal size of the floating array
-                                    containing all loaded data.
+           - MAX_SIZE_LOADED (int): target maximal number of samples loaded
+                                    at once. Loaded data is stored as int16
+                                    and converted to float when batched.
+           - pathArchive (string): if not None, a corpus archive (see
+                                   corpus_archive.py) the sequences are read
+                                   from instead of being decoded
+           - seqLengths (dictionnary): if not None, the known number of
+                                       frames of the sequences (see
+                                       manifest.py), indexed by path
         """
         self.MAX_SIZE_LOADED = MAX_SIZE_LOADED
         self.nProcessLoader = nProcessLoader
+        self.pathArchive = pathArchive
+        self.seqLengths = {} if seqLengths is None else dict(seqLengths)
         #self.dbPath = Path(path)
         self.sizeWindow = sizeWindow
         #self.seqNames = [(s, self.dbPath / x) for s, x in seqNames]
@@ -89,17 +109,26 @@ class AudioBatchData(Dataset):
             del self.phoneLabels
         if 'seqLabel' in self.__dict__:
             del self.seqLabel
+        if 'speakerBounds' in self.__dict__:
+            del self.speakerBounds
 
     def prepare(self):
         random.shuffle(self.seqNames)
         start_time = time.time()
 
         print("Checking length...")
-        allLength = self.reload_pool.map(extractLength, self.seqNames)
+        # Lengths are only looked up once, not at every reshuffle
+        missing = [x for x in self.seqNames if str(x[1]) not in self.seqLengths]
+        if len(missing) > 0:
+            lengths = self.reload_pool.map(
+                partial(extractLength, pathArchive=self.pathArchive), missing)
+            for (_, path), length in zip(missing, lengths):
+                self.seqLengths[str(path)] = length
+        self.allLength = [self.seqLengths[str(x[1])] for x in self.seqNames]
 
         self.packageIndex, self.totSize = [], 0
         start, packageSize = 0, 0
-        for index, length in tqdm.tqdm(enumerate(allLength)):
+        for index, length in tqdm.tqdm(enumerate(self.allLength)):
             packageSize += length
             if packageSize > self.MAX_SIZE_LOADED:
                 self.packageIndex.append([start, index])
@@ -128,15 +157,30 @@ class AudioBatchData(Dataset):
             print('Joining pool')
             self.r.wait()
             print(f'Joined process, elapsed={time.time()-start_time:.3f} secs')
-            self.nextData = self.r.get()
+            self.r.get()
             self.parseNextDataBlock()
-            del self.nextData
+            del self.nextData, self.nextBuffer
         self.nextPack = (self.currentPack + 1) % len(self.packageIndex)
         seqStart, seqEnd = self.packageIndex[self.nextPack]
         if self.nextPack == 0 and len(self.packageIndex) > 1:
             self.prepare()
-        self.r = self.reload_pool.map_async(loadFile,
-                                            self.seqNames[seqStart:seqEnd])
+
+        # The workers decode each sequence straight to its final place in a
+        # shared buffer, sorted by speaker and sequence name
+        self.nextData, jobs, offset = [], [], 0
+        for index in sorted(range(seqStart, seqEnd),
+                            key=lambda i: (self.seqNames[i][0], self.seqNames[i][1].stem)):
+            speaker, fullPath = self.seqNames[index]
+            sizeSeq = self.allLength[index]
+            if self.phoneLabelsDict is not None:
+                sizeSeq = min(sizeSeq, len(self.phoneLabelsDict[fullPath.stem]) * self.phoneSize)
+            self.nextData.append((speaker, fullPath.stem, sizeSeq))
+            jobs.append((fullPath, offset, sizeSeq))
+            offset += sizeSeq
+        self.nextBuffer = torch.empty(offset, dtype=torch.int16).share_memory_()
+        self.r = self.reload_pool.map_async(
+            partial(loadFile, buffer=self.nextBuffer, pathArchive=self.pathArchive),
+            jobs)
 
     def parseNextDataBlock(self):
 
@@ -147,11 +191,9 @@ class AudioBatchData(Dataset):
         speakerSize = 0
         indexSpeaker = 0
 
-        # To accelerate the process a bit
-        self.nextData.sort(key=lambda x: (x[0], x[1]))
-        tmpData = []
+        self.data = self.nextBuffer
 
-        for speaker, seqName, seq in self.nextData:
+        for speaker, seqName, sizeSeq in self.nextData:
             while self.speakers[indexSpeaker] < speaker:
                 indexSpeaker += 1
                 self.speakerLabel.append(speakerSize)
@@ -160,26 +202,20 @@ class AudioBatchData(Dataset):
 
             if self.phoneLabelsDict is not None:
                 self.phoneLabels += self.phoneLabelsDict[seqName]
-                newSize = len(self.phoneLabelsDict[seqName]) * self.phoneSize
-                seq = seq[:newSize]
 
-            sizeSeq = seq.size(0)
-            tmpData.append(seq)
             self.seqLabel.append(self.seqLabel[-1] + sizeSeq)
             speakerSize += sizeSeq
-            del seq
 
         self.speakerLabel.append(speakerSize)
-        self.data = torch.cat(tmpData, dim=0)
+        self.speakerBounds = torch.tensor(self.speakerLabel, dtype=torch.long)
+        self.phoneLabels = torch.tensor(self.phoneLabels, dtype=torch.long)
 
     def getPhonem(self, idx):
         idPhone = idx // self.phoneSize
         return self.phoneLabels[idPhone:(idPhone + self.phoneStep)]
 
     def getSpeakerLabel(self, idx):
-        idSpeaker = next(x[0] for x in enumerate(
-            self.speakerLabel) if x[1] > idx) - 1
-        return idSpeaker
+        return bisect.bisect_right(self.speakerLabel, idx) - 1
 
     def __len__(self):
         return self.totSize // self.sizeWindow
@@ -189,10 +225,10 @@ class AudioBatchData(Dataset):
         if idx < 0 or idx >= len(self.data) - self.sizeWindow - 1:
             print(idx)
 
-        outData = self.data[idx:(self.sizeWindow + idx)].view(1, -1)
+        outData = self.data[idx:(self.sizeWindow + idx)].float().div_(32768).view(1, -1)
         label = torch.tensor(self.getSpeakerLabel(idx), dtype=torch.long)
         if self.phoneSize > 0:
-            label_phone = torch.tensor(self.getPhonem(idx), dtype=torch.long)
+            label_phone = self.getPhonem(idx)
             if not self.doubleLabels:
                 label = label_phone
         else:
@@ -203,6 +239,27 @@ class AudioBatchData(Dataset):
 
         return outData, label
 
+    def getBatch(self, indices):
+        r"""
+        Batched version of __getitem__, gathering all the windows starting at
+        the given indices (LongTensor) at once.
+        """
+        outData = self.data.unfold(0, self.sizeWindow, 1)[indices]
+        outData = outData.float().div_(32768).view(-1, 1, self.sizeWindow)
+        label = torch.searchsorted(self.speakerBounds, indices, right=True) - 1
+        if self.phoneSize > 0:
+            label_phone = self.phoneLabels.unfold(0, self.phoneStep, 1)[
+                indices // self.phoneSize]
+            if not self.doubleLabels:
+                label = label_phone
+        else:
+            label_phone = torch.zeros(indices.size(0), 1)
+
+        if self.doubleLabels:
+            return outData, label, label_phone
+
+        return outData, label
+
     def getNSpeakers(self):
         return len(self.speakers)
 
@@ -212,22 +269,21 @@ class AudioBatchData(Dataset):
     def getNLoadsPerEpoch(self):
         return len(self.packageIndex)
 
-    def getBaseSampler(self, type, batchSize, offset):
+    def getBaseSampler(self, type, batchSize, offset, generator=None):
         if type == "samespeaker":
             return SameSpeakerSampler(batchSize, self.speakerLabel,
-                                      self.sizeWindow, offset)
+                                      self.sizeWindow, offset, generator)
         if type == "samesequence":
             return SameSpeakerSampler(batchSize, self.seqLabel,
-                                      self.sizeWindow, offset)
+                                      self.sizeWindow, offset, generator)
         if type == "sequential":
             return SequentialSampler(len(self.data), self.sizeWindow,
                                      offset, batchSize)
-        sampler = UniformAudioSampler(len(self.data), self.sizeWindow,
-                                      offset)
-        return BatchSampler(sampler, batchSize, True)
+        return UniformAudioSampler(len(self.data), self.sizeWindow,
+                                   offset, batchSize, generator)
 
-    def getDataLoader(self, batchSize, type, randomOffset, numWorkers=0,
-                      onLoop=-1):
+    def getDataLoader(self, batchSize, type, randomOffset, onLoop=-1,
+                      seed=None):
         r"""
         Get a batch sampler for the current dataset.
         Args:
@@ -243,6 +299,8 @@ class AudioBatchData(Dataset):
                 vector
             - randomOffset (bool): if True add a random offset to the sampler
                                    at the begining of each iteration
+            - seed (int): if not None, seed of the samplers, making the
+                          sequence of batches reproducible
         """
         nLoops = len(self.packageIndex)
         totSize = self.totSize // (self.sizeWindow * batchSize)
@@ -251,24 +309,45 @@ class AudioBatchData(Dataset):
             self.loadNextPack()
             nLoops = 1
 
+        generator = None
+        if seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+
         def samplerCall():
-            offset = random.randint(0, self.sizeWindow // 2) \
-                if randomOffset else 0
-            return self.getBaseSampler(type, batchSize, offset)
+            if not randomOffset:
+                offset = 0
+            elif generator is not None:
+                offset = int(torch.randint(self.sizeWindow // 2 + 1, (1,),
+                                           generator=generator))
+            else:
+                offset = random.randint(0, self.sizeWindow // 2)
+            return self.getBaseSampler(type, batchSize, offset, generator)
 
         return AudioLoader(self, samplerCall, nLoops, self.loadNextPack,
-                           totSize, numWorkers)
+                           totSize)
 
 
-def loadFile(data):
-    speaker, fullPath = data
-    seqName = fullPath.stem
-    # Due to some issues happening when combining torchaudio.load
-    # with torch.multiprocessing we use soundfile to load the data
-    seq = torch.tensor(sf.read(str(fullPath))[0]).float()
-    if len(seq.size()) == 2:
-        seq = seq.mean(dim=1)
-    return speaker, seqName, seq
+def loadFile(data, buffer, pathArchive=None):
+    r"""
+    Decode the sequence fullPath into buffer[offset:offset + size].
+    """
+    fullPath, offset, size = data
+    if pathArchive is not None and fullPath in loadArchive(pathArchive):
+        seq = loadArchive(pathArchive).read(fullPath)[:size]
+    else:
+        # Due to some issues happening when combining torchaudio.load
+        # with torch.multiprocessing we use soundfile to load the data
+        with sf.SoundFile(str(fullPath)) as f:
+            if f.channels == 1:
+                # Mono files are decoded straight into the pack, zero padded
+                f.read(dtype='int16', out=buffer[offset:offset + size].numpy(), fill_value=0)
+                return
+            seq = f.read(frames=size, dtype='int16')
+        seq = torch.from_numpy(np.round(seq.mean(axis=1)).astype(np.int16))
+    buffer[offset:offset + seq.size(0)] = seq
+    if seq.size(0) < size:
+        buffer[offset + seq.size(0):offset + size] = 0
 
 
 class AudioLoader(object):
@@ -277,14 +356,15 @@ class AudioLoader(object):
     In order to handle big datasets AudioBatchData works with big chunks of
     audio it loads sequentially in memory: once all batches have been sampled
     on a chunk, the AudioBatchData loads the next one.
+    Batches are gathered in-process from the loaded chunk, the samplers
+    yielding index tensors (see AudioBatchData.getBatch).
     """
     def __init__(self,
                  dataset,
                  samplerCall,
                  nLoop,
                  updateCall,
-                 size,
-                 numWorkers):
+                 size):
         r"""
         Args:
             - dataset (AudioBatchData): target dataset
@@ -292,14 +372,12 @@ class AudioLoader(object):
             - nLoop (int): number of chunks to load
             - updateCall (function): function loading the next chunk
             - size (int): total number of batches
-            - numWorkers (int): see torch.utils.data.DataLoader
         """
         self.samplerCall = samplerCall
         self.updateCall = updateCall
         self.nLoop = nLoop
         self.size = size
         self.dataset = dataset
-        self.numWorkers = numWorkers
 
     def __len__(self):
         return self.size
@@ -308,34 +386,141 @@ class AudioLoader(object):
 
         for i in range(self.nLoop):
             sampler = self.samplerCall()
-            dataloader = DataLoader(self.dataset,
-                                    batch_sampler=sampler,
-                                    num_workers=self.numWorkers)
-            for x in dataloader:
-                yield x
+            for indices in sampler:
+                yield self.dataset.getBatch(indices)
             if i < self.nLoop - 1:
                 self.updateCall()
 
 
+class RandomWindowDataset(object):
+    r"""
+    An alternative to AudioBatchData for when only random windows are
+    needed (codebook training). Each window is drawn uniformly among all
+    the windows of the corpus and only its frames are read, by seeking in
+    the audio file or by slicing a corpus archive, so that the memory used
+    does not depend on the size of the corpus.
+    Iterating over it yields (batch, speaker label) couples like the
+    AudioLoader.
+    """
+
+    def __init__(self,
+                 seqNames,
+                 sizeWindow,
+                 batchSize,
+                 seqLengths=None,
+                 nBatches=None,
+                 nThreads=16,
+                 pathArchive=None,
+                 seed=None):
+        r"""
+        Args:
+            - seqNames (list): (speaker, path) couples to sample from
+            - sizeWindow (int): size of a window
+            - batchSize (int): number of windows in a batch
+            - seqLengths (dictionnary): known number of frames of the
+                                        sequences indexed by path (see
+                                        manifest.py), the others are read
+                                        from the file headers
+            - nBatches (int): number of batches per iteration, by default as
+                              many as AudioBatchData would give
+            - nThreads (int): number of threads reading the windows
+            - pathArchive (string): if not None, a corpus archive to read
+                                    the archived sequences from
+            - seed (int): if not None, seed of the window sampling
+        """
+        self.sizeWindow = sizeWindow
+        self.batchSize = batchSize
+        self.pathArchive = pathArchive
+        self.pool = ThreadPoolExecutor(nThreads)
+
+        seqLengths = {} if seqLengths is None else seqLengths
+        missing = [(s, x) for s, x in seqNames if str(x) not in seqLengths]
+        lengths = dict(zip((str(x) for _, x in missing),
+                           self.pool.map(partial(extractLength, pathArchive=pathArchive),
+                                         missing)))
+        lengths.update(seqLengths)
+
+        seqNames = [(s, str(x)) for s, x in seqNames if lengths[str(x)] >= sizeWindow]
+        self.paths = [x for _, x in seqNames]
+        self.speakers = torch.tensor([s for s, _ in seqNames], dtype=torch.long)
+        sizes = torch.tensor([lengths[x] for x in self.paths], dtype=torch.long)
+        # Number of possible windows in each sequence
+        self.nWindows = sizes - sizeWindow + 1
+        self.weights = self.nWindows.double()
+
+        if nBatches is None:
+            nBatches = int(sizes.sum()) // (sizeWindow * batchSize)
+        self.nBatches = nBatches
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        print(f"Sampling windows from {len(self.paths)} sequences")
+
+    def __len__(self):
+        return self.nBatches
+
+    def readWindow(self, path, offset):
+        if self.pathArchive is not None and path in loadArchive(self.pathArchive):
+            seq = loadArchive(self.pathArchive).read(path)[offset:offset + self.sizeWindow]
+        else:
+            with sf.SoundFile(path) as f:
+                f.seek(offset)
+                seq = f.read(self.sizeWindow, dtype='int16')
+            if seq.ndim == 2:
+                seq = np.round(seq.mean(axis=1)).astype(np.int16)
+            seq = torch.from_numpy(seq)
+        if seq.size(0) < self.sizeWindow:
+            # The header announced more frames than the file holds
+            seq = torch.cat([seq, seq.new_zeros(self.sizeWindow - seq.size(0))])
+        return seq
+
+    def submitBatch(self):
+        files = torch.multinomial(self.weights, self.batchSize,
+                                  replacement=True, generator=self.generator)
+        offsets = (torch.rand(self.batchSize, generator=self.generator,
+                              dtype=torch.float64)
+                   * self.nWindows[files]).long()
+        futures = [self.pool.submit(self.readWindow, self.paths[i], offset)
+                   for i, offset in zip(files.tolist(), offsets.tolist())]
+        return futures, self.speakers[files]
+
+    def __iter__(self):
+        # The next batch is read while the current one is used
+        pending = self.submitBatch() if self.nBatches > 0 else None
+        for index in range(self.nBatches):
+            futures, label = pending
+            if index < self.nBatches - 1:
+                pending = self.submitBatch()
+            outData = torch.stack([x.result() for x in futures])
+            yield outData.float().div_(32768).view(-1, 1, self.sizeWindow), label
+
+
 class UniformAudioSampler(Sampler):
 
     def __init__(self,
                  dataSize,
                  sizeWindow,
-                 offset):
+                 offset,
+                 batchSize,
+                 generator=None):
 
         self.len = dataSize // sizeWindow
         self.sizeWindow = sizeWindow
         self.offset = offset
+        self.batchSize = batchSize
+        self.generator = generator
         if self.offset > 0:
             self.len -= 1
 
     def __iter__(self):
-        return iter((self.offset
-                     + self.sizeWindow * torch.randperm(self.len)).tolist())
+        # Incomplete last batch dropped
+        order = torch.randperm(self.len, generator=self.generator)
+        for idx in range(len(self)):
+            yield self.offset + self.sizeWindow \
+                * order[idx * self.batchSize:(idx + 1) * self.batchSize]
 
     def __len__(self):
-        return self.len
+        return self.len // self.batchSize
 
 
 class SequentialSampler(Sampler):
@@ -345,73 +530,81 @@ class SequentialSampler(Sampler):
         self.len = (dataSize // sizeWindow) // batchSize
         self.sizeWindow = sizeWindow
         self.offset = offset
-        self.startBatches = [x * (dataSize // batchSize)
-                             for x in range(batchSize)]
+        self.startBatches = torch.arange(batchSize) * (dataSize // batchSize)
         self.batchSize = batchSize
         if self.offset > 0:
             self.len -= 1
 
     def __iter__(self):
         for idx in range(self.len):
-            yield [self.offset + self.sizeWindow * idx
-                   + start for start in self.startBatches]
+            yield self.offset + self.sizeWindow * idx + self.startBatches
 
     def __len__(self):
         return self.len
 
 
 class SameSpeakerSampler(Sampler):
+    r"""
+    Batches of windows sharing the same sampling interval (speaker or
+    sequence). The batches are not stored: at each iteration, the windows
+    are shuffled inside their interval with a single sort of random keys and
+    each batch is sliced out of that order when it is yielded.
+    """
 
     def __init__(self,
                  batchSize,
                  samplingIntervals,
                  sizeWindow,
-                 offset):
+                 offset,
+                 generator=None):
 
-        self.samplingIntervals = samplingIntervals
+        self.samplingIntervals = torch.as_tensor(samplingIntervals, dtype=torch.long)
         self.sizeWindow = sizeWindow
         self.batchSize = batchSize
         self.offset = offset
+        self.generator = generator
 
         if self.samplingIntervals[0] != 0:
             raise AttributeError("Sampling intervals should start at zero")
 
-        nWindows = len(self.samplingIntervals) - 1
-        self.sizeSamplers = [(self.samplingIntervals[i+1] -
-                              self.samplingIntervals[i]) // self.sizeWindow
-                             for i in range(nWindows)]
+        self.sizeSamplers = (self.samplingIntervals[1:]
+                             - self.samplingIntervals[:-1]) // self.sizeWindow
 
         if self.offset > 0:
-            self.sizeSamplers = [max(0, x - 1) for x in self.sizeSamplers]
-
-        order = [(x, torch.randperm(val).tolist())
-                 for x, val in enumerate(self.sizeSamplers) if val > 0]
-
-        # Build Batches
-        self.batches = []
-        for indexSampler, randperm in order:
-            indexStart, sizeSampler = 0, self.sizeSamplers[indexSampler]
-            while indexStart < sizeSampler:
-                indexEnd = min(sizeSampler, indexStart + self.batchSize)
-                locBatch = [self.getIndex(x, indexSampler)
-                            for x in randperm[indexStart:indexEnd]]
-                indexStart = indexEnd
-                self.batches.append(locBatch)
+            self.sizeSamplers = (self.sizeSamplers - 1).clamp(min=0)
+
+        # Windows and batches of each interval
+        nIntervals = self.sizeSamplers.size(0)
+        self.windowStart = torch.cumsum(self.sizeSamplers, 0) - self.sizeSamplers
+        nBatches = (self.sizeSamplers + self.batchSize - 1) // self.batchSize
+        self.batchInterval = torch.repeat_interleave(torch.arange(nIntervals), nBatches)
+        self.batchRank = torch.arange(self.batchInterval.size(0)) \
+            - (torch.cumsum(nBatches, 0) - nBatches)[self.batchInterval]
+        self.windowInterval = torch.repeat_interleave(torch.arange(nIntervals),
+                                                      self.sizeSamplers)
 
     def __len__(self):
-        return len(self.batches)
-
-    def getIndex(self, x, iInterval):
-        return self.offset + x * self.sizeWindow \
-            + self.samplingIntervals[iInterval]
+        return self.batchInterval.size(0)
 
     def __iter__(self):
-        random.shuffle(self.batches)
-        return iter(self.batches)
-
-
-def extractLength(couple):
+        nWindows = self.windowInterval.size(0)
+        keys = self.windowInterval.double() \
+            + torch.rand(nWindows, generator=self.generator, dtype=torch.float64)
+        order = torch.argsort(keys)
+        for batch in torch.randperm(len(self), generator=self.generator).tolist():
+            interval = self.batchInterval[batch]
+            start = self.windowStart[interval] + self.batchRank[batch] * self.batchSize
+            end = min(start + self.batchSize,
+                      self.windowStart[interval] + self.sizeSamplers[interval])
+            windows = order[start:end] - self.windowStart[interval]
+            yield self.offset + self.samplingIntervals[interval] \
+                + self.sizeWindow * windows
+
+
+def extractLength(couple, pathArchive=None):
     speaker, locPath = couple
+    if pathArchive is not None and locPath in loadArchive(pathArchive):
+        return loadArchive(pathArchive).getLength(locPath)
     try:
         info = torchaudio.info(str(locPath))[0]
         dur = info.length
@@ -423,56 +616,42 @@ def extractLength(couple):
 def findAllSeqs_Mix(dirNames,
                 extension=['.flac', '.wav'],
                 loadCache=False,
-                speaker_level=1):
-    
+                speaker_level=1,
+                nThreads=16):
+    r"""
+    findAllSeqs over several directories, each one with its own speaker
+    indexes. The directories are scanned by nThreads threads and, if
+    loadCache is True, only the subdirectories modified since the last scan
+    are listed again (see dir_scanner.py).
+    A subset file (see manifest.writeSubset) can be given instead of a
+    directory, its files being used as they are.
+    """
     outSequence = []
     outSpeaker = []
     for dirName in dirNames:
         print(f"Finding sequences in {dirName}")
-        cache_path = os.path.join(str(dirName), '_seqs_cache.txt')
-        if loadCache:
-            try:
-                outSequences, speakers = torch.load(cache_path)
-                print(f'Loaded from cache {cache_path} successfully')
-                outSequence.extend(outSequences)
-                outSpeaker.extend(speakers)
-                continue
-                #return outSequences, speakers
-            except OSError as err:
-                print(f'Ran in an error while loading {cache_path}: {err}')
-            print('Could not load cache, rebuilding')
-
-        if dirName[-1] != os.sep:
-            dirName += os.sep
-        prefixSize = len(dirName)
         speakersTarget = {}
         outSequences = []
-        for root, dirs, filenames in tqdm.tqdm(os.walk(dirName)):
-            for ex in extension:
-                filtered_files = [f for f in filenames if f.endswith(ex)]
-
-                if len(filtered_files) > 0:
-                    speakerStr = (os.sep).join(
-                        root[prefixSize:].split(os.sep)[:speaker_level])
-                    if speakerStr not in speakersTarget:
-                        speakersTarget[speakerStr] = len(speakersTarget)
-                    speaker = speakersTarget[speakerStr]
-                    for filename in filtered_files:
-                        full_path = os.path.join(dirName + root[prefixSize:], filename)
-                        outSequences.append((speaker, full_path))
+        if isSubset(dirName):
+            # Subsets may mix corpora, speakers are told apart by language
+            files = [(os.path.join(x.language, x.speaker), x.path)
+                     for x in readSubset(dirName)[0]]
+        else:
+            files = [((os.sep).join(relDir.split(os.sep)[:speaker_level]),
+                      os.path.join(dirName, relDir, filename))
+                     for relDir, filename in listFiles(dirName, extension,
+                                                       loadCache=loadCache,
+                                                       nThreads=nThreads)]
+        for speakerStr, path in files:
+            if speakerStr not in speakersTarget:
+                speakersTarget[speakerStr] = len(speakersTarget)
+            speaker = speakersTarget[speakerStr]
+            outSequences.append((speaker, path))
         outSpeakers = [None for x in speakersTarget]
         for key, index in speakersTarget.items():
             outSpeakers[index] = key
-        try:
-            torch.save((outSequences, outSpeakers), cache_path)
-            outSequence.extend(outSequences)
-            outSpeaker.extend(outSpeakers)
-            #print("inner:", len(outSequence))
-            print(f'Saved cache file at {cache_path}')
-        except OSError as err:
-            print(f'Ran in an error while saving {cache_path}: {err}')
-
-        
+        outSequence.extend(outSequences)
+        outSpeaker.extend(outSpeakers)
 
     return outSequence, outSpeaker
 
@@ -565,25 +744,7 @@ def parseSeqLabels(pathLabels):
 
 
 def filterSeqs(pathTxt, seqCouples):
-    with open(pathTxt, 'r') as f:
-        inSeqs = [p.replace('\n', '') for p in f.readlines()]
-
-    inSeqs.sort()
-    seqCouples.sort(key=lambda x: os.path.basename(os.path.splitext(x[1])[0]))
-    output, index = [], 0
-    '''
-    for x in seqCouples:
-        seq = os.path.basename(os.path.splitext(x[1])[0])
-        while index < len(inSeqs) and seq > inSeqs[index]:
-            index += 1
-        if index == len(inSeqs):
-            break
-        if seq == inSeqs[index]:
-            output.append(x)
-    '''
-    for inp in inSeqs:
-        for x in seqCouples:
-            if x[1]==inp:
-                output.append(x)
-                break
-    return output
+    r"""
+    Keep the sequences listed in pathTxt (see selection.py).
+    """
+    return includeSeqs(seqCouples, readSeqList(pathTxt))
@@ -0,0 +1,117 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+import torch
+import torch.nn as nn
+
+
+class PCAReduction(nn.Module):
+    r"""
+    Streaming PCA (or PCA whitening) fitted in a single pass over the features.
+    The mean and the co-moment matrix are accumulated batch by batch with the
+    pairwise update of Chan et al., in float64, so that the whole feature set
+    never has to be held in memory.
+    """
+
+    def __init__(self, outDim, whiten=False, eps=1e-5):
+        r"""
+        Args:
+            - outDim (int): number of principal components to keep
+            - whiten (bool): if True, scale each component to unit variance
+            - eps (float): added to the eigenvalues before whitening
+        """
+        super(PCAReduction, self).__init__()
+        self.outDim = outDim
+        self.whiten = whiten
+        self.eps = eps
+        self.count = 0
+        self.mean = None
+        self.comoment = None
+        self.register_buffer('center', None)
+        self.register_buffer('projection', None)
+        self.register_buffer('eigenvalues', None)
+
+    def isFitted(self):
+        return self.projection is not None
+
+    def update(self, features):
+        x = features.detach().reshape(-1, features.size(-1)).double()
+        n = x.size(0)
+        if n == 0:
+            return
+        if self.mean is None:
+            D = x.size(1)
+            self.mean = torch.zeros(D, dtype=torch.float64, device=x.device)
+            self.comoment = torch.zeros(D, D, dtype=torch.float64,
+                                        device=x.device)
+        batchMean = x.mean(dim=0)
+        centered = x - batchMean
+        total = self.count + n
+        delta = batchMean - self.mean
+        self.comoment += centered.t() @ centered \
+            + torch.outer(delta, delta) * (self.count * n / total)
+        self.mean += delta * (n / total)
+        self.count = total
+
+    def fit(self):
+        if self.count < 2:
+            raise RuntimeError("Not enough items to fit the PCA")
+        cov = self.comoment / (self.count - 1)
+        eigenvalues, eigenvectors = torch.linalg.eigh(cov)
+        # eigh returns the eigenvalues in ascending order
+        eigenvalues = eigenvalues.flip(0)[:self.outDim].clamp(min=0)
+        projection = eigenvectors.flip(1)[:, :self.outDim]
+        if self.whiten:
+            projection = projection / torch.sqrt(eigenvalues + self.eps)
+        explained = eigenvalues.sum() / torch.diagonal(cov).sum()
+        print(f"PCA fitted on {self.count} items, keeping {self.outDim} "
+              f"components out of {cov.size(0)} "
+              f"({100 * explained.item():.2f}% of the variance)")
+        self.center = self.mean.float()
+        self.projection = projection.float()
+        self.eigenvalues = eigenvalues.float()
+        self.mean, self.comoment = None, None
+
+    def forward(self, features):
+        return (features - self.center) @ self.projection
+
+    def loadState(self, state):
+        self.outDim = state["dim"]
+        self.whiten = state["type"] == "whitening"
+        self.eps = state["eps"]
+        self.center = state["center"]
+        self.projection = state["projection"]
+        self.eigenvalues = state["eigenvalues"]
+
+    def getState(self):
+        return {"type": "whitening" if self.whiten else "pca",
+                "dim": self.outDim,
+                "eps": self.eps,
+                "center": self.center.cpu(),
+                "projection": self.projection.cpu(),
+                "eigenvalues": self.eigenvalues.cpu()}
+
+
+def buildDimReduction(name, outDim):
+    r"""
+    Build an unfitted dimensionality reduction from the clustering config.
+    name should be None, "pca" or "whitening".
+    """
+    if name is None:
+        return None
+    if name not in ["pca", "whitening"]:
+        raise ValueError(f"Unknown dimensionality reduction {name}")
+    assert outDim is not None and outDim > 0, \
+        "dimReductionSize must be given when using a dimensionality reduction"
+    return PCAReduction(outDim, whiten=name == "whitening")
+
+
+def loadDimReduction(state):
+    r"""
+    Load a fitted dimensionality reduction from the state saved with the
+    clustering checkpoint (see PCAReduction.getState).
+    """
+    dimReduction = PCAReduction(state["dim"])
+    dimReduction.loadState(state)
+    return dimReduction
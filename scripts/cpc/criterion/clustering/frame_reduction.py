@@ -0,0 +1,101 @@
+import torch
+import torch.nn as nn
+
+# Frame rate of the fairseq, s3prl and whisper encoders (20 ms frames)
+ENCODER_FRAME_RATE = 50
+
+
+class FrameRateReduction(nn.Module):
+    r"""
+    Reduce the frame rate of encoder features (..., S, D) from inputRate to
+    outputRate Hz. Frame t falls into the output frame t * outputRate //
+    inputRate, so that any integer ratio works (eg. 50 -> 33 Hz), the last
+    output frame being the one of the last input frame. Each output frame is
+    the mean of its input frames ("mean") or its first input frame
+    ("stride").
+    """
+
+    def __init__(self, outputRate, inputRate=ENCODER_FRAME_RATE, mode="mean"):
+        r"""
+        Args:
+            - outputRate (int): frame rate of the reduced features, in Hz
+            - inputRate (int): frame rate of the encoder features, in Hz
+            - mode (string): "mean" or "stride"
+        """
+        super(FrameRateReduction, self).__init__()
+        if mode not in ["mean", "stride"]:
+            raise ValueError(f"Unknown frame reduction {mode}")
+        assert int(outputRate) == outputRate and int(inputRate) == inputRate, \
+            "The frame rates should be integers"
+        assert 0 < outputRate <= inputRate, \
+            f"The frame rate {outputRate} should be in (0, {inputRate}]"
+        self.outputRate = int(outputRate)
+        self.inputRate = int(inputRate)
+        self.mode = mode
+
+    def outputSize(self, size):
+        # Bin of the last frame, + 1: no bin is empty as outputRate <= inputRate
+        return (size - 1) * self.outputRate // self.inputRate + 1
+
+    def forward(self, features):
+        size = features.size(-2)
+        if self.outputRate == self.inputRate or size == 0:
+            return features
+        nOut = self.outputSize(size)
+        if self.mode == "stride":
+            starts = -((-torch.arange(nOut, device=features.device)
+                        * self.inputRate) // self.outputRate)
+            return features.index_select(-2, starts)
+        bins = torch.arange(size, device=features.device) \
+            * self.outputRate // self.inputRate
+        outShape = features.shape[:-2] + (nOut, features.size(-1))
+        sums = features.new_zeros(outShape).index_add_(-2, bins, features)
+        counts = torch.bincount(bins, minlength=nOut).to(features.dtype)
+        return sums / counts.view(-1, 1)
+
+    def getState(self):
+        return {"type": self.mode,
+                "inputRate": self.inputRate,
+                "outputRate": self.outputRate}
+
+
+def buildFrameReduction(frameRate, mode="mean"):
+    r"""
+    Build the frame rate reduction from the clustering config, None if
+    frameRate is None (every encoder frame is kept).
+    """
+    if frameRate is None:
+        return None
+    return FrameRateReduction(frameRate, mode=mode)
+
+
+def loadFrameReduction(state):
+    r"""
+    Load the frame rate reduction saved with the clustering checkpoint (see
+    FrameRateReduction.getState).
+    """
+    return FrameRateReduction(state["outputRate"], state["inputRate"],
+                              mode=state["type"])
+
+
+def checkFrameReduction(rates=(25, 33, 40), maxSize=200):
+    r"""
+    Run the reductions to the given frame rates on every length up to
+    maxSize, in both modes, and check that no output frame is empty (NaN)
+    and that the strided frames are taken from the input.
+    """
+    for rate in rates:
+        for mode in ["mean", "stride"]:
+            reduction = FrameRateReduction(rate, mode=mode)
+            for size in range(1, maxSize + 1):
+                # Frame t holds t, so that the output tells which frames were used
+                features = torch.arange(size, dtype=torch.float).view(1, size, 1)
+                out = reduction(features)
+                assert out.size(1) == reduction.outputSize(size), (rate, mode, size)
+                assert not torch.isnan(out).any(), (rate, mode, size)
+                assert out.min() >= 0 and out.max() <= size - 1, (rate, mode, size)
+    print(f"Frame reductions to {list(rates)} Hz checked up to {maxSize} frames")
+
+
+if __name__ == "__main__":
+    checkFrameReduction()
@@ -1,13 +1,20 @@
 import os
 import yaml
 import argparse
-import soundfile as sf
+import numpy as np
 
 from pathlib import Path
+from subset_sampling import MATERIALIZE_MODES, get_entries, durations, select_budget, materialize, write_subsets
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="data_config.yaml", help="data configuration")
+    parser.add_argument("--mode", type=str, default="auto", choices=MATERIALIZE_MODES,
+                        help="how to put the sampled files in the output directory (see subset_sampling.materialize)")
+    parser.add_argument("--workers", type=int, default=16, help="threads reading the headers and transcoding processes")
+    parser.add_argument("--subset", type=str, default=None,
+                        help="write the selection to this .tsv subset file, to give as pathDB, instead of "
+                        "putting the files in the output directory")
     args = parser.parse_args()
 
     with open(args.config, "r") as fp:
@@ -21,24 +28,25 @@ if __name__ == "__main__":
 
     total_seconds_list = [h*3600 for h in hr_list]
 
-    if not os.path.isdir(output_dir):
+    if not os.path.isdir(output_dir) and args.subset is None:
         os.mkdir(output_dir)
 
+    selections = []
+
     for lang, total_seconds in zip(lang_list, total_seconds_list):
         data_path = os.path.join(os.path.join(cs_data_root, lang), "train/correct/")
-        wav_files = list(map(str, list(Path(data_path).rglob("*.wav"))))
+        wav_files = sorted(map(str, list(Path(data_path).rglob("*.wav"))))
         assert len(wav_files) > 0
-        len_count = 0
-        idx = 0
-        while (True):
-            wav, sr = sf.read(wav_files[idx])
-            idx += 1
-            len_count += len(wav) / sr
+        speakers = [os.path.dirname(os.path.relpath(p, data_path)).split(os.sep)[0] for p in wav_files]
+        entries = get_entries(wav_files, speakers, lang, root=data_path, workers=args.workers)
+        selected, len_count = select_budget(np.arange(len(wav_files)), durations(entries), total_seconds)
+
+        if args.subset is not None:
+            selections.append((lang, total_seconds / 3600, [entries[i] for i in selected]))
+        else:
             output_path = os.path.join(os.path.join(output_dir, lang), "train/correct/")
-            if not os.path.exists(output_path):
-                Path(output_path).mkdir(parents=True, exist_ok=True)
-            sf.write(os.path.join(output_path, os.path.basename(wav_files[idx])), wav, sr)
-            if len_count >= total_seconds:
-                break
-            print(len_count)
-    
\ No newline at end of file
+            materialize([wav_files[i] for i in selected], output_path, mode=args.mode, workers=args.workers)
+        print(len_count)
+
+    if args.subset is not None:
+        write_subsets(args.subset, selections)
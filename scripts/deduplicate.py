@@ -1,68 +1,161 @@
 import argparse
 import os
+import shutil
+import tempfile
+from multiprocessing import Pool
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--output_dir')
-parser.add_argument('--convert', action='store_true')
-parser.add_argument('--max_units', type=int, default=512)
+# artifact -> output file name
+ARTIFACTS = {'named': 'dedup_not_converted.txt',
+             'converted': 'dedup_converted.txt',
+             'deleted': 'deleted.txt',
+             'not_dedup': 'converted_not_dedup.txt'}
+WINDOWS_NAME = 'windows.tsv'
 
-args = parser.parse_args()
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir')
+    parser.add_argument('--input', default=None,
+                        help='quantizer output, output_dir/quantized_outputs.txt by default')
+    parser.add_argument('--convert', action='store_true')
+    parser.add_argument('--max_units', type=int, default=512)
+    parser.add_argument('--artifacts', nargs='+', default=None, choices=list(ARTIFACTS),
+                        help='files to write in a single pass over the input: '
+                        'named (dedup_not_converted.txt), converted (dedup_converted.txt), '
+                        'deleted (deleted.txt) and not_dedup (converted_not_dedup.txt, '
+                        'as form_convert.py). By default converted or named depending '
+                        'on --convert, and deleted.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes, each one handling a byte range of the input')
+    parser.add_argument('--split_long', action='store_true',
+                        help='cut the sequences longer than max_units into overlapping windows '
+                        'instead of deleting them, the windows being listed in windows.tsv')
+    parser.add_argument('--window_size', type=int, default=None,
+                        help='with --split_long, size of the windows (max_units by default)')
+    parser.add_argument('--window_stride', type=int, default=None,
+                        help='with --split_long, stride of the windows (half the window size by default)')
+    return parser.parse_args()
 
-def preprocess(file_name, convert):
-    f = open(file_name, 'r')
-    names = []
-    lines = []
-    deleted = []
-    deleted_names = []
-    for line in f.readlines():
-        wav_name, line = line.split('\t')[0], line.split('\t')[1]
-        line = line.strip('\n').split(',')
-        new_line = []
-        for id in line:
-            if len(new_line) == 0:
-                new_line.append(id)
-            elif new_line[-1] != id:
-                new_line.append(id)
-        if len(new_line) <= args.max_units:
-            if not convert:
-                names.append(wav_name)
-            lines.append(new_line)
-        else:
-            deleted_names.append(wav_name)
-            deleted.append(new_line)
-    
-    if not convert:
-        return names, lines, deleted_names, deleted
-    
-    return None, lines, deleted_names, deleted
+def deduplicate(units):
+    new_line = []
+    for id in units:
+        if len(new_line) == 0 or new_line[-1] != id:
+            new_line.append(id)
+    return new_line
 
+def windows(length, size, stride):
+    # Starts of the windows covering [0, length), the last one ending at length
+    starts = list(range(0, max(1, length - size + 1), stride))
+    if starts[-1] + size < length:
+        starts.append(length - size)
+    return starts
 
+def shard_ranges(file_name, num_shards):
+    # Byte ranges of the input, cut at line starts
+    size = os.path.getsize(file_name)
+    bounds = [0]
+    with open(file_name, 'rb') as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(num_shards) if bounds[i] < bounds[i + 1]]
 
-def write_output(names, lines, output, convert):
-    if not convert:
-        with open(output, 'w') as f:
-            assert len(names)==len(lines)
-            for i in range(len(names)):
-                f.write(names[i]+'\t')
-                f.write(','.join(lines[i]) + '\n')
+def process_range(job):
+    file_name, start, end, outputs, max_units, window = job
+    files = {key: open(path, 'w') for key, path in outputs.items()}
+    stats = {'lines': 0, 'kept': 0, 'deleted': 0, 'windowed': 0, 'max_units': -1}
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline().decode('utf-8')
+            if not line.strip():
+                continue
+            wav_name, units = line.split('\t')[0], line.split('\t')[1]
+            units = units.strip().split(',')
+            stats['lines'] += 1
+            stats['max_units'] = max(stats['max_units'], len(units))
+            if 'not_dedup' in files:
+                files['not_dedup'].write(' '.join(units) + '\n')
+            new_line = deduplicate(units)
+            if len(new_line) <= max_units:
+                stats['kept'] += 1
+                if 'named' in files:
+                    files['named'].write(wav_name + '\t' + ','.join(new_line) + '\n')
+                if 'converted' in files:
+                    files['converted'].write(' '.join(new_line) + '\n')
+            elif window is not None:
+                stats['windowed'] += 1
+                size, stride = window
+                for i, start_unit in enumerate(windows(len(new_line), size, stride)):
+                    piece = new_line[start_unit:start_unit + size]
+                    name = f'{wav_name}#{i}'
+                    files['windows'].write(f'{name}\t{wav_name}\t{start_unit}\t{start_unit + len(piece)}\n')
+                    if 'named' in files:
+                        files['named'].write(name + '\t' + ','.join(piece) + '\n')
+                    if 'converted' in files:
+                        files['converted'].write(' '.join(piece) + '\n')
+            else:
+                stats['deleted'] += 1
+                if 'deleted' in files:
+                    files['deleted'].write(wav_name + '\t' + ','.join(new_line) + '\n')
+    for f in files.values():
+        f.close()
+    return stats
 
-    else:
-        with open(output, 'w') as f:
-            for line in lines:
-                f.write(' '.join(line) + '\n')
+def run(file_name, output_dir, artifacts, max_units, workers=1, window=None):
+    r"""
+    window: None to delete the sequences longer than max_units, or a
+    (size, stride) couple to cut them into windows (see windows.tsv)
+    """
+    outputs = {key: os.path.join(output_dir, ARTIFACTS[key]) for key in artifacts}
+    if window is not None:
+        outputs['windows'] = os.path.join(output_dir, WINDOWS_NAME)
+    ranges = shard_ranges(file_name, max(1, workers))
+    if len(ranges) <= 1:
+        return process_range((file_name, 0, os.path.getsize(file_name), outputs, max_units, window))
+
+    # Each shard writes its own part of every artifact, concatenated in order
+    tmp_dir = tempfile.mkdtemp(dir=output_dir)
+    try:
+        jobs = [(file_name, start, end,
+                 {key: os.path.join(tmp_dir, f'{key}.{i}') for key in outputs},
+                 max_units, window)
+                for i, (start, end) in enumerate(ranges)]
+        with Pool(workers) as pool:
+            all_stats = pool.map(process_range, jobs)
+        for key, path in outputs.items():
+            with open(path, 'wb') as out:
+                for job in jobs:
+                    with open(job[3][key], 'rb') as part:
+                        shutil.copyfileobj(part, out)
+    finally:
+        shutil.rmtree(tmp_dir)
+    stats = {key: sum(x[key] for x in all_stats) for key in ['lines', 'kept', 'deleted', 'windowed']}
+    stats['max_units'] = max(x['max_units'] for x in all_stats)
+    return stats
 
 if __name__ == '__main__':
-    file_name = os.path.join(args.output_dir, 'quantized_outputs.txt')
-    names, lines, deleted_names, deleted = preprocess(file_name, args.convert)
-    if args.convert:
-        dedup_path = os.path.join(args.output_dir, 'dedup_converted.txt')
-    else:
-        dedup_path = os.path.join(args.output_dir, 'dedup_not_converted.txt')
-        
-    deleted_path = os.path.join(args.output_dir, 'deleted.txt')
-    write_output(names, lines, dedup_path, args.convert)
-    write_output(deleted_names, deleted, deleted_path, False)
-    
+    args = parse_args()
+    file_name = args.input or os.path.join(args.output_dir, 'quantized_outputs.txt')
+    artifacts = args.artifacts
+    if artifacts is None:
+        artifacts = ['converted' if args.convert else 'named', 'deleted']
+    window = None
+    if args.split_long:
+        size = args.window_size or args.max_units
+        window = (size, args.window_stride or max(1, size // 2))
+        assert 0 < window[1] <= window[0], "The window stride should be in (0, window_size]"
+    stats = run(file_name, args.output_dir, artifacts, args.max_units, args.workers, window)
+
+    print('-'*100)
+    print(f"Finished deduplication: {stats['lines']} lines, {stats['kept']} kept, "
+          f"{stats['deleted']} longer than {args.max_units} units deleted.")
+    if window is not None:
+        print(f"{stats['windowed']} longer sequences cut into windows of {window[0]} units "
+              f"(stride {window[1]}), listed in {WINDOWS_NAME}.")
+    if 'not_dedup' in artifacts:
+        print("max units:", stats['max_units'])
     print('-'*100)
-    print('Finished deduplication.')
-    print('-'*100)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+SCAN_CACHE_NAME = '_scan_cache.json'
+
+
+def scanDir(root, relDir, cached):
+    r"""
+    List the directory root/relDir, unless its mtime is the one of the
+    cached entry. Entries are (mtime, files, subdirectories).
+    """
+    path = os.path.join(root, relDir)
+    mtime = os.stat(path).st_mtime_ns
+    if cached is not None and cached[0] == mtime:
+        return relDir, cached
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            # Like os.walk, symbolic links to directories are not followed
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif not entry.is_dir():
+                files.append(entry.name)
+    return relDir, [mtime, sorted(files), sorted(dirs)]
+
+
+def scanTree(root, cache=None, nThreads=16):
+    r"""
+    Scan the whole tree under root with a pool of threads, each directory
+    being listed again only if its mtime changed since cache was built.
+    Return:
+        the new cache, a dictionnary relative directory ->
+        (mtime, files, subdirectories)
+    """
+    cache = {} if cache is None else cache
+    out = {}
+    with ThreadPoolExecutor(nThreads) as pool:
+        pending = {pool.submit(scanDir, root, '', cache.get(''))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relDir, entry = future.result()
+                out[relDir] = entry
+                for subDir in entry[2]:
+                    relSub = os.path.join(relDir, subDir)
+                    pending.add(pool.submit(scanDir, root, relSub,
+                                            cache.get(relSub)))
+    return out
+
+
+def loadScanCache(root):
+    pathCache = os.path.join(root, SCAN_CACHE_NAME)
+    try:
+        with open(pathCache, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def saveScanCache(root, cache):
+    # Rewritten in place: creating a file would change the mtime of root and
+    # force its rescan next time. A truncated cache is simply ignored.
+    pathCache = os.path.join(root, SCAN_CACHE_NAME)
+    try:
+        with open(pathCache, 'w') as f:
+            json.dump(cache, f)
+    except OSError as err:
+        print(f'Ran in an error while saving {pathCache}: {err}')
+
+
+def listFiles(root, extension, loadCache=True, nThreads=16):
+    r"""
+    All the files under root ending with one of the given extensions, as
+    (relative directory, file name) couples sorted by directory then name.
+    Args:
+        - root (string): directory to scan
+        - extension (list): accepted extensions
+        - loadCache (bool): if True, only rescan the directories modified
+                            since the last scan of root
+        - nThreads (int): number of scanning threads
+    """
+    cache = loadScanCache(root) if loadCache else None
+    newCache = scanTree(root, cache, nThreads=nThreads)
+    if newCache != cache:
+        saveScanCache(root, newCache)
+    extension = tuple(extension)
+    return [(relDir, name) for relDir in sorted(newCache)
+            for name in newCache[relDir][1] if name.endswith(extension)]
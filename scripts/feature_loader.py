@@ -9,6 +9,7 @@ import json
 import argparse
 # from cpc_default_config import get_default_cpc_config
 from dataset import parseSeqLabels
+from corpus_archive import loadArchive
 import whisper
 #from model import CPCModel, ConcatenatedModel
 
@@ -269,51 +270,6 @@ def buildFeature(featureMaker, seqPath, strict=False,
     out = torch.cat(out, dim=1)
     return out
 
-def buildS3PRLFeature(featureMaker, seqPath, strict=False,
-                 maxSizeSeq=64000, seqNorm=False, layer=-1):
-
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    featureMaker.eval()
-    seq, sample_rate = torchaudio.load(seqPath) # (1, seq_length)
-    sizeSeq = seq.shape[1]
-    #print("sizeSeq:", sizeSeq)
-
-    seq = [seq.squeeze(0).float().to(device)]
-    #print("seq:", seq[0].shape, sizeSeq)
-    start = 0
-    out = []
-
-    while start < sizeSeq:
-        if strict and start + maxSizeSeq > sizeSeq:
-            break
-        end = min(sizeSeq, start + maxSizeSeq)
-
-        if len(seq)!=1:
-            raise ValueError
-        subseq = [seq[0][start:end]]
-
-        with torch.no_grad():
-            if start<end:
-                features = featureMaker(subseq)["hidden_states"][layer] # [1, a, 768]
-                if seqNorm:
-                    features = seqNormalization(features)
-                out.append(features.squeeze(0).detach().cpu())
-        start += maxSizeSeq
-
-    if strict and start < sizeSeq:
-        #subseq = (seq[:, -maxSizeSeq:]).view(1, 1, -1).cuda(device=0)
-        subseq = [seq[0][-maxSizeSeq:]]
-        with torch.no_grad():
-                features = featureMaker(subseq)["hidden_states"][layer]
-                if seqNorm:
-                    features = seqNormalization(features)
-        delta = (sizeSeq - start)*1000 // (sample_rate*20)
-        #delta = sizeSeq - start
-        out.append(features[:, -delta:, :].squeeze(0).detach().cpu())
-
-    out = torch.cat(out, dim=0)
-    return out
-
 def buildFeature_batch(featureMaker, seqPath, strict=False,
                  maxSizeSeq=8000, seqNorm=False, batch_size=8):
     r"""
@@ -379,113 +335,231 @@ def buildFeature_batch(featureMaker, seqPath, strict=False,
     out = torch.cat(out, dim=1)
     return out
 
-def buildXlsrFeature(featureMaker, seqPath, strict=False,
-                 maxSizeSeq=64000, seqNorm=False, layer=-1):
+class EncoderAdapter(torch.nn.Module):
+    r"""
+    Common interface over the speech encoders (fairseq, s3prl and whisper)
+    used for the clustering and the quantization. Subclasses implement
+    extract(), a batched forward over a padded batch of waveforms returning
+    the features of the selected layer.
+    """
+    sampleRate = 16000
+    frameRate = 50  # output frames per second
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    featureMaker.eval().to(device)
-    seq, sample_rate = torchaudio.load(seqPath) # (1, seq_length)
-    
-    sizeSeq = seq.shape[1]
-    #print("sizeSeq:", sizeSeq)
+    def __init__(self, model, layer=-1, name=None, truncate=False):
+        super(EncoderAdapter, self).__init__()
+        self.model = model
+        self.layer = layer
+        self.name = name
+        # Stop the forward after the selected layer (see truncatedLayer)
+        self.truncate = truncate
 
-    #seq = [seq.squeeze(0).float().to(device)]
-    #print("seq:", seq[0].shape, sizeSeq)
-    start = 0
-    out = []
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
 
-    while start < sizeSeq:
-        if strict and start + maxSizeSeq > sizeSeq:
-            break
-        end = min(sizeSeq, start + maxSizeSeq)
+    def getDownsamplingFactor(self):
+        return self.sampleRate // self.frameRate
 
-        if len(seq)!=1:
-            raise ValueError
+    def featureLength(self, size, sampleRate=None):
+        r"""
+        Number of frames encoding size samples.
+        """
+        if sampleRate is None:
+            sampleRate = self.sampleRate
+        return size * self.frameRate // sampleRate
 
-        subseq = seq.squeeze()[start:end].unsqueeze(0).to(device)
-        with torch.no_grad():
-            if start<end:
-                if layer != -1:
-                    features = featureMaker(subseq, features_only=True, mask=False, layer=layer)["x"]
-                else:
-                    features = featureMaker(subseq, features_only=True, mask=False)["x"]
-                #print(features.shape)
-                if seqNorm:
-                    features = seqNormalization(features)
-                out.append(features.squeeze(0).detach().cpu())
-        start += maxSizeSeq
+    def truncatedLayer(self, nLayers):
+        r"""
+        Index of the selected layer among the nLayers + 1 hidden states
+        (the input of the first block, then the output of each block), or
+        None if the whole stack has to be run.
+        """
+        if not self.truncate:
+            return None
+        layer = self.layer if self.layer >= 0 else self.layer + nLayers + 1
+        if 0 <= layer < nLayers:
+            return layer
+        return None
 
-    if strict and start < sizeSeq:
-        #subseq = (seq[:, -maxSizeSeq:]).view(1, 1, -1).cuda(device=0)
-        #subseq = seq[0][-maxSizeSeq:]
-        subseq = seq.squeeze()[-maxSizeSeq:].unsqueeze(0).to(device)
-        with torch.no_grad():
-                if layer != -1:
-                    features = featureMaker(subseq, features_only=True, mask=False, layer=layer)["x"]
-                else:
-                    features = featureMaker(subseq, features_only=True, mask=False)["x"]
-                if seqNorm:
-                    features = seqNormalization(features)
-        delta = (sizeSeq - start)*1000 // (sample_rate*20)
-        #delta = sizeSeq - start
-        out.append(features[:, -delta:, :].squeeze(0).detach().cpu())
+    def extract(self, wavs, lengths):
+        raise NotImplementedError
 
-    out = torch.cat(out, dim=0)
-    return out
+    def forward(self, data, lengths=None):
+        r"""
+        Args:
+            - data (tensor or couple): B x T (or B x 1 x T) batch of
+                                       waveforms, or a (batch, label) couple
+                                       as yielded by the AudioBatchData
+                                       loaders
+            - lengths (list): if the batch is padded, the actual length of
+                              each waveform
+        Return:
+            a B x S x D tensor of features
+        """
+        if isinstance(data, (tuple, list)):
+            data = data[0]
+        wavs = data.view(data.size(0), -1).float().to(self.device)
+        if lengths is None:
+            lengths = [wavs.size(1)] * wavs.size(0)
+        return self.extract(wavs, lengths)
+
+
+class StopForward(Exception):
+    pass
+
+
+class FairseqEncoder(EncoderAdapter):
+    # fairseq already stops the transformer stack at the requested layer,
+    # truncate has nothing to add here
+
+    def extract(self, wavs, lengths):
+        padding_mask = None
+        if min(lengths) < wavs.size(1):
+            lengths = torch.tensor(lengths, device=wavs.device)
+            padding_mask = torch.arange(wavs.size(1), device=wavs.device).view(1, -1) \
+                >= lengths.view(-1, 1)
+        if self.layer != -1:
+            return self.model(wavs, padding_mask=padding_mask, features_only=True,
+                              mask=False, layer=self.layer)["x"]
+        return self.model(wavs, padding_mask=padding_mask, features_only=True,
+                          mask=False)["x"]
+
+
+class S3PRLEncoder(EncoderAdapter):
+
+    def extract(self, wavs, lengths):
+        # s3prl upstreams take a list of unpadded waveforms
+        wavs = [wav[:size] for wav, size in zip(wavs, lengths)]
+        encoder = getattr(getattr(self.model, 'model', None), 'encoder', None)
+        blocks = getattr(encoder, 'layers', None)
+        layer = None if blocks is None else self.truncatedLayer(len(blocks))
+        if layer == 0:
+            # The input of the first block is taken after the positional
+            # convolution, not where the upstream takes hidden_states[0]
+            raise ValueError("truncate is not supported with the layer 0 of s3prl upstreams, "
+                             "set truncate to False to extract it")
+        if layer is None:
+            return self.model(wavs)["hidden_states"][self.layer]
+
+        # hidden_states[i] is the input of the i-th transformer layer (T x B x D
+        # in the fairseq-based upstreams), so we grab it there and stop
+        captured = []
+
+        def hook(module, input):
+            captured.append(input[0].transpose(0, 1))
+            raise StopForward
+
+        handle = blocks[layer].register_forward_pre_hook(hook)
+        try:
+            return self.model(wavs)["hidden_states"][self.layer]
+        except StopForward:
+            return captured[0]
+        finally:
+            handle.remove()
+
+
+class WhisperEncoder(EncoderAdapter):
+
+    def featureLength(self, size, sampleRate=None):
+        if sampleRate is None:
+            sampleRate = self.sampleRate
+        return int(size / sampleRate * self.frameRate)
+
+    def extract(self, wavs, lengths):
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(wavs)).to(wavs.device) # B, 80, 3000
+        encoder = self.model.encoder
+        layer = self.truncatedLayer(len(encoder.blocks))
+        if layer is None:
+            features = self.model.embed_audio(mel) # B, 1500, Dim
+        else:
+            x = torch.nn.functional.gelu(encoder.conv1(mel))
+            x = torch.nn.functional.gelu(encoder.conv2(x)).permute(0, 2, 1)
+            features = (x + encoder.positional_embedding).to(x.dtype)
+            for block in encoder.blocks[:layer]:
+                features = block(features)
+        return features[:, :self.featureLength(max(lengths)), :]
 
-def buildWhisperFeature(featureMaker, seqPath, strict=False,
-                 maxSizeSeq=64000, seqNorm=False, layer=-1):
-    
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    featureMaker.eval().to(device)
-    seq, sample_rate = torchaudio.load(seqPath) # (1, seq_length)
-    
-    sizeSeq = seq.shape[1]
-    start = 0
-    out = []
 
-    while start < sizeSeq:
-        if strict and start + maxSizeSeq > sizeSeq:
-            break
-        end = min(sizeSeq, start + maxSizeSeq)
+def loadEncoder(config, device):
+    r"""
+    Load the speech encoder given in the runner section of a config file
+    (cp_path for a fairseq checkpoint, s3prl for an s3prl upstream or whisper
+    for a whisper model) and wrap it in the corresponding EncoderAdapter.
+    """
+    cp_path = config.get('cp_path')
+    s3prl_name = config.get('s3prl')
+    whisper_name = config.get('whisper')
+    assert [cp_path, s3prl_name, whisper_name].count(None) == 2, \
+        "Don't use fairseq model, s3prl model or whisper at once."
+    layer = config.get('layer', -1)
+    truncate = config.get('truncate', False)
+    if cp_path is not None:
+        import fairseq
+        model, cfg, task = fairseq.checkpoint_utils.load_model_ensemble_and_task([cp_path])
+        encoder = FairseqEncoder(model[0], layer, name=cp_path, truncate=truncate)
+    elif s3prl_name is not None:
+        import s3prl.hub as hub
+        encoder = S3PRLEncoder(getattr(hub, s3prl_name)(), layer, name=s3prl_name,
+                               truncate=truncate)
+    else:
+        encoder = WhisperEncoder(whisper.load_model(whisper_name), layer,
+                                 name=f'whisper-{whisper_name}', truncate=truncate)
+    return encoder.to(device).eval()
 
-        if len(seq)!=1:
-            raise ValueError
 
-        subseq = seq.squeeze()[start:end].unsqueeze(0).to(device) # (1, subseq_len)
+def buildEncoderFeature(encoder, seqPath, strict=False,
+                        maxSizeSeq=64000, seqNorm=False, batchSize=8,
+                        pathArchive=None):
+    r"""
+    Apply the encoder to the given file, chunk by chunk. Chunks of the same
+    size are encoded together in batches of batchSize.
+    Arguments:
+        - encoder (EncoderAdapter): encoder to apply
+        - seqPath (string): path of the sequence to load
+        - strict (bool): if True, always work with chunks of the size
+                         maxSizeSeq
+        - maxSizeSeq (int): maximal size of a chunk
+        - seqNorm (bool): if True, normalize the output along the time
+                          dimension to get chunks of mean zero and var 1
+        - batchSize (int): number of chunks encoded at once
+        - pathArchive (string): if not None, a corpus archive the sequence is
+                                read from when it has been archived
+    Return:
+        a torch vector of size Seq_size x Feature_dim
+    """
+    if pathArchive is not None and seqPath in loadArchive(pathArchive):
+        archive = loadArchive(pathArchive)
+        seq, sample_rate = archive.readFloat(seqPath), archive.getSampleRate(seqPath)
+    else:
+        seq, sample_rate = torchaudio.load(seqPath) # (1, seq_length)
+        if seq.size(0) != 1:
+            raise ValueError(f"Expected a single channel audio file, got {seq.size(0)} channels in {seqPath}")
+        seq = seq.view(-1)
+    sizeSeq = seq.size(0)
+    nChunks = sizeSeq // maxSizeSeq
+
+    def encode(subseqs):
         with torch.no_grad():
-            if start<end:
-                subseq_size = subseq.shape[1]
-                subseq = subseq.squeeze()
-                subseq = whisper.pad_or_trim(subseq)
-                mel = whisper.log_mel_spectrogram(subseq).unsqueeze(0).to(device)
-                features = featureMaker.embed_audio(mel) # (1, Frames, Dim)
-
-                feature_len = int(subseq_size / sample_rate * 50)
-                features = features[:, :feature_len, :]
-                if seqNorm:
-                    features = seqNormalization(features)
-                out.append(features.squeeze(0).detach().cpu())
-        start += maxSizeSeq
+            features = encoder(subseqs)
+            if seqNorm:
+                features = seqNormalization(features)
+        return features.detach().cpu()
 
-    if strict and start < sizeSeq:
-        #subseq = (seq[:, -maxSizeSeq:]).view(1, 1, -1).cuda(device=0)
-        #subseq = seq[0][-maxSizeSeq:]
-        subseq = seq.squeeze()[-maxSizeSeq:].unsqueeze(0).to(device)
-        with torch.no_grad():
-                subseq_size = subseq.shape[1]
-                subseq = subseq.squeeze()
-                subseq = whisper.pad_or_trim(subseq)
-                mel = whisper.log_mel_spectrogram(subseq).unsqueeze(0).to(device)
-                features = featureMaker.embed_audio(mel) # (1, Frames, Dim)
-                feature_len = int(subseq_size / sample_rate * 50)
-                features = features[:, :feature_len, :]
-                
-                if seqNorm:
-                    features = seqNormalization(features)
-        delta = (sizeSeq - start)*1000 // (sample_rate*20)
-        #delta = sizeSeq - start
-        out.append(features[:, -delta:, :].squeeze(0).detach().cpu())
+    out = []
+    for start in range(0, nChunks, batchSize):
+        end = min(nChunks, start + batchSize)
+        subseqs = seq[start*maxSizeSeq:end*maxSizeSeq].view(end - start, maxSizeSeq)
+        out.extend(encode(subseqs).unbind(0))
+
+    start = nChunks * maxSizeSeq
+    if start < sizeSeq:
+        if strict:
+            features = encode(seq[-maxSizeSeq:].view(1, -1))
+            delta = encoder.featureLength(sizeSeq - start, sample_rate)
+            if delta > 0:
+                out.append(features[0, -delta:])
+        else:
+            out.append(encode(seq[start:].view(1, -1))[0])
 
     out = torch.cat(out, dim=0)
-    return out
\ No newline at end of file
+    return out
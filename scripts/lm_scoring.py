@@ -3,6 +3,87 @@ from time import time
 from os.path import exists
 
 import torch
+import torch.nn.functional as F
+
+def unit_vocabulary(dictionary):
+    """
+    Indices of the symbols a masked token can be: <unk> and the symbols of the
+    dictionary, without the other special symbols, <mask> and the padding
+    madeupwords.
+    """
+    return torch.tensor([dictionary.unk()] + [i for i in range(dictionary.nspecial, len(dictionary))
+                                              if dictionary.symbols[i] != '<mask>'
+                                              and not dictionary.symbols[i].startswith('madeupword')])
+
+def restricted_lm_head(lm_head, features, vocab_ids):
+    """
+    Output of RobertaLMHead on the given features, projected on vocab_ids only.
+    """
+    x = lm_head.layer_norm(lm_head.activation_fn(lm_head.dense(features)))
+    return F.linear(x, lm_head.weight[vocab_ids]) + lm_head.bias[vocab_ids]
+
+def token_budget_batches(lengths, max_tokens):
+    """
+    Split items of the given lengths (LongTensor) into batches of at most max_tokens tokens once padded,
+    the items being taken from the longest to the shortest (an item longer than max_tokens is alone).
+    Return a list of LongTensors of item indices.
+    """
+    order = torch.sort(lengths, descending=True, stable=True)[1]
+    sorted_lengths = lengths[order].tolist()
+    batches, pos = [], 0
+    while pos < len(order):
+        n_rows = max(1, max_tokens // max(1, sorted_lengths[pos]))
+        batches.append(order[pos:pos + n_rows])
+        pos += n_rows
+    return batches
+
+def pack_rows(lengths, pack_size):
+    """
+    Pack items of the given lengths (LongTensor) into rows of at most pack_size tokens, taking the items from
+    the longest to the shortest and starting a new row when the next one does not fit (an item longer than
+    pack_size gets its own row). Return a list of rows, each one a list of item indices.
+    """
+    order = torch.sort(lengths, descending=True, stable=True)[1].tolist()
+    rows, row_size = [], pack_size + 1
+    for i in order:
+        length = int(lengths[i])
+        if row_size + length > pack_size:
+            rows.append([])
+            row_size = 0
+        rows[-1].append(i)
+        row_size += length
+    return rows
+
+def packed_features(model, tokens, positions, segments):
+    """
+    Features of a RoBERTa encoder (fairseq's TransformerEncoder) for rows holding several sequences: the
+    positions are given for each token (restarting at each sequence) and a block diagonal attention mask
+    keeps apart the tokens of different segments, the padding of a row being a segment of its own.
+    Otherwise the same computation as TransformerEncoder.forward.
+    """
+    encoder = model.encoder.sentence_encoder
+    x = encoder.embed_scale * encoder.embed_tokens(tokens)
+    if encoder.embed_positions is not None:
+        # LearnedPositionalEmbedding refuses explicit positions when it has a padding_idx
+        x = x + F.embedding(positions, encoder.embed_positions.weight)
+    if encoder.layernorm_embedding is not None:
+        x = encoder.layernorm_embedding(x)
+    x = encoder.dropout_module(x)
+    if getattr(encoder, 'quant_noise', None) is not None:
+        x = encoder.quant_noise(x)
+    x = x.transpose(0, 1)
+
+    # (batch * heads, tokens, tokens), 1 where attention is not allowed
+    num_heads = encoder.layers[0].self_attn.num_heads
+    attn_mask = (segments.unsqueeze(2) != segments.unsqueeze(1)).to(x.dtype)
+    attn_mask = attn_mask.repeat_interleave(num_heads, dim=0)
+    for layer in encoder.layers:
+        x = layer(x, encoder_padding_mask=None, attn_mask=attn_mask)
+        if isinstance(x, tuple):
+            x = x[0]
+    if encoder.layer_norm is not None:
+        x = encoder.layer_norm(x)
+    return x.transpose(0, 1)
 
 def compute_proba_BERT_mlm_span(
                             sequences, roberta, tokenized=True,
@@ -11,7 +92,9 @@ def compute_proba_BERT_mlm_span(
                             batchsen_size=32, inner_batch_size = 128,
                             gpu=False, print_tokens=False, verbose=False,
                             print_shape_statistics=False,
-                            save_to=None, file_names=None):
+                            save_to=None, file_names=None,
+                            masked_head=False, unit_vocab_only=False, max_tokens=None,
+                            pack_size=None):
     """
     Compute the pseudo log-proba of a list of sentences with span-masked-language-model-scoring style as
     described in the baseline system of The Zero Resource Speech Benchmark 2021 (see paper for the formula).
@@ -49,6 +132,22 @@ def compute_proba_BERT_mlm_span(
         Path to save the outputs.
     file_names (optional) : list of strings
         If save_to is not None, a list of corresponding file names must be given.
+    masked_head : bool
+        Wether to compute the LM head at the masked positions only (masked_tokens of fairseq's RoBERTa).
+        Same scores up to the rounding of the head. If False (default), the head is computed at every
+        position, as the original scoring, which reproduces existing score files exactly.
+    unit_vocab_only : bool
+        Wether to project the masked positions on the unit vocabulary only (no special symbols), which
+        renormalizes the probabilities over the units. Implies masked_head.
+    max_tokens (optional) : int
+        If given, the outer batches are made of sentences of similar lengths (longest first) and their
+        masked sequences are sorted by length and grouped in inner batches of at most max_tokens padded
+        tokens, instead of inner_batch_size sequences in file order. Scores are still saved in file order.
+    pack_size (optional) : int
+        If given, the masked sequences are packed into rows of at most pack_size tokens, each one attending
+        only to itself (block diagonal attention, positions restarting at each sequence), instead of being
+        padded one per row. inner_batch_size then counts rows (and max_tokens the padded tokens of the
+        rows). Same scores as without packing, up to the rounding of the attention. Implies masked_head.
 
     Return
     -------
@@ -56,6 +155,47 @@ def compute_proba_BERT_mlm_span(
         The pseudo log-probabilities of the input sentences.
 
     """
+    vocab_ids, vocab_index = None, None
+    if unit_vocab_only:
+        dictionary = roberta.task.source_dictionary
+        vocab_ids = unit_vocabulary(dictionary)
+        # dictionary index -> index in vocab_ids
+        vocab_index = torch.full((len(dictionary),), -1, dtype=torch.long)
+        vocab_index[vocab_ids] = torch.arange(len(vocab_ids))
+
+    # Device buffers reused by the inner batches instead of freeing the GPU memory after each of them
+    input_buffers = {}
+
+    def to_device(inputs, name='tokens'):
+        if not gpu:
+            return inputs
+        if name not in input_buffers or input_buffers[name].numel() < inputs.numel():
+            input_buffers[name] = torch.empty(inputs.numel(), dtype=inputs.dtype, device='cuda')
+        return input_buffers[name][:inputs.numel()].view(inputs.shape).copy_(inputs)
+
+    def masked_logproba(inputs_chk, mask, targets, packed=None):
+        # Log-proba of the targets at the masked positions, in the order of mask.nonzero()
+        masked_tokens = mask.to(inputs_chk.device)
+        features = None
+        if packed is not None:
+            features = packed_features(roberta.model, inputs_chk, *packed)
+        if unit_vocab_only:
+            if features is None:
+                features = roberta.model(inputs_chk, features_only=True)[0]
+            masked_outputs = restricted_lm_head(roberta.model.encoder.lm_head, features[masked_tokens],
+                                                vocab_ids.to(inputs_chk.device))
+            targets = vocab_index[targets]
+        elif features is not None:
+            masked_outputs = roberta.model.encoder.lm_head(features, masked_tokens)
+        elif masked_head:
+            masked_outputs = roberta.model(inputs_chk, masked_tokens=masked_tokens)[0]
+        else:
+            masked_outputs = roberta.model(inputs_chk)[0][masked_tokens]
+        del features
+        # Same softmax per masked position as scoring each one separately
+        targets = targets.view(-1, 1).to(masked_outputs.device)
+        return masked_outputs.softmax(-1).gather(-1, targets).view(-1).log().float().cpu()
+
     def compute_proba_batchsen(sentences):
         # Compute the id of the mask
         masked_token =  '<mask>'
@@ -63,8 +203,10 @@ def compute_proba_BERT_mlm_span(
         pad_idx = roberta.task.source_dictionary.pad()
         #device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         # Compute the input sequences of tokens
-        masked_sentence_tokens_list = []
         sequences_list = []         # to retrieve the sentences when computing logproba
+        variant_starts = []         # first masked token (minus one) of each masked variant
+        variant_sentences = []      # sentence of each masked variant
+        span_sizes = []
         for sentence in sentences:
             if tokenized:
                 sentence_tokens = roberta.task.source_dictionary.encode_line("<s> " + sentence, append_eos=True, add_if_not_exist=False)
@@ -89,86 +231,100 @@ def compute_proba_BERT_mlm_span(
             else:
                 step_size  = max(actual_span_size,1)
 
-            # Start masking out tokens
-            for idx in range(0, ln-actual_span_size+1, step_size):
-                masked_sentence_tokens = sentence_tokens.clone().long()
-                masked_sentence_tokens[idx+1:idx+1+actual_span_size] = masked_idx
-                masked_sentence_tokens_list.append(masked_sentence_tokens.clone())
-
-            sequences_list.append(sentence_tokens)
+            # One masked variant per span start
+            starts = torch.arange(0, ln-actual_span_size+1, step_size)
+            variant_starts.append(starts)
+            variant_sentences.append(torch.full((len(starts),), len(sequences_list), dtype=torch.long))
+            span_sizes.append(actual_span_size)
+            sequences_list.append(sentence_tokens.long())
+
+        tokens = torch.nn.utils.rnn.pad_sequence(sequences_list, batch_first = True, padding_value = pad_idx)
+        lengths = torch.tensor([len(x) for x in sequences_list])
+        variant_starts = torch.cat(variant_starts)
+        variant_sentences = torch.cat(variant_sentences)
+        variant_spans = torch.tensor(span_sizes, dtype=torch.long)[variant_sentences]
+        n_variants = len(variant_starts)
+
+        # Compute the output by batch, keeping only the log-proba of the masked tokens:
+        # span_logproba[v, j] is the one of the j-th masked token of variant v
+        span_logproba = torch.zeros(n_variants, max(span_sizes))
+        shape_statistics = ""
+        variant_lengths = lengths[variant_sentences]
 
-        
-        # Divide the sequences into batches
-        if inner_batch_size > 0:
-            inputs_chunks = []
-            n_batch = len(masked_sentence_tokens_list)//inner_batch_size
+        def batches(item_lengths):
+            if max_tokens is not None:
+                return token_budget_batches(item_lengths, max_tokens)
+            elif inner_batch_size > 0:
+                return [torch.arange(i, min(i + inner_batch_size, len(item_lengths))) for i in range(0, len(item_lengths), inner_batch_size)]
+            return [torch.arange(len(item_lengths))]
 
-            for i in range(n_batch):
-                sequences_inputs = torch.nn.utils.rnn.pad_sequence(masked_sentence_tokens_list[i*inner_batch_size : (i+1)*inner_batch_size],
-                                                                    batch_first = False, padding_value = pad_idx).t()
-                inputs_chunks.append(sequences_inputs)
-
-            if len(masked_sentence_tokens_list) % inner_batch_size != 0:
-                sequences_inputs = torch.nn.utils.rnn.pad_sequence(masked_sentence_tokens_list[n_batch*inner_batch_size : ],
-                                                                    batch_first = False, padding_value = pad_idx).t()
-                inputs_chunks.append(sequences_inputs)
-        else:
-            sequences_inputs = torch.nn.utils.rnn.pad_sequence(masked_sentence_tokens_list, batch_first = False, padding_value = pad_idx).t()
-            inputs_chunks = [sequences_inputs]
-        
-        
-        # Compute the output by batch
-        outputs_list = []
-        shape_statistics = ""
-        #print(len(inputs_chunks))
-        for i, inputs_chk in enumerate(inputs_chunks):
-            shape_statistics += "{} - ({}, {}) | ".format(inputs_chk.shape[0] * inputs_chk.shape[1], inputs_chk.shape[0], inputs_chk.shape[1])
+        def log_shape(inputs_chk):
             if verbose:
                 print("{} - ({}, {}) | ".format(inputs_chk.shape[0] * inputs_chk.shape[1], inputs_chk.shape[0], inputs_chk.shape[1]))
-            #print('-'*100)
-            if gpu:
-                inputs_chk = inputs_chk.cuda()
-
-            outputs_chk = roberta.model(inputs_chk)[0]
-            # Release all GPU memory
-            if gpu:
-                # outputs_chk = outputs_chk.cpu()
-                # inputs_chk = inputs_chk.cpu()
-                gc.collect()
-                torch.cuda.empty_cache()
+            return "{} - ({}, {}) | ".format(inputs_chk.shape[0] * inputs_chk.shape[1], inputs_chk.shape[0], inputs_chk.shape[1])
+
+        if pack_size is None:
+            # Divide the masked variants into batches, each one padded to its longest sequence
+            for ids in batches(variant_lengths):
+                width = int(variant_lengths[ids].max())
+                chunk_tokens = tokens[variant_sentences[ids], :width]
+                offsets = torch.arange(width).view(1, -1) - 1 - variant_starts[ids].view(-1, 1)
+                mask = (offsets >= 0) & (offsets < variant_spans[ids].view(-1, 1))
+                inputs_chk = chunk_tokens.masked_fill(mask, masked_idx)
+                shape_statistics += log_shape(inputs_chk)
+
+                rows, cols = mask.nonzero(as_tuple=True)
+                logproba_chk = masked_logproba(to_device(inputs_chk), mask, chunk_tokens[rows, cols])
+                span_logproba[ids[rows], offsets[rows, cols]] = logproba_chk
+        else:
+            # Pack the masked variants into rows, then divide the rows into batches
+            packed_rows = pack_rows(variant_lengths, pack_size)
+            row_widths = torch.tensor([int(variant_lengths[row].sum()) for row in packed_rows])
+            for ids in batches(row_widths):
+                width = int(row_widths[ids].max())
+                row_tokens = torch.full((len(ids), width), pad_idx, dtype=torch.long)
+                positions = torch.full((len(ids), width), pad_idx, dtype=torch.long)
+                row_variants = torch.full((len(ids), width), -1, dtype=torch.long)
+                offsets = torch.full((len(ids), width), -1, dtype=torch.long)
+                for i, r in enumerate(ids.tolist()):
+                    col = 0
+                    for v in packed_rows[r]:
+                        ln = int(variant_lengths[v])
+                        row_tokens[i, col:col+ln] = tokens[variant_sentences[v], :ln]
+                        positions[i, col:col+ln] = pad_idx + 1 + torch.arange(ln)
+                        row_variants[i, col:col+ln] = v
+                        offsets[i, col:col+ln] = torch.arange(ln) - 1 - variant_starts[v]
+                        col += ln
+                mask = (row_variants >= 0) & (offsets >= 0) \
+                    & (offsets < variant_spans[row_variants.clamp(min=0)])
+                inputs_chk = row_tokens.masked_fill(mask, masked_idx)
+                shape_statistics += log_shape(inputs_chk)
+
+                packed = (to_device(positions, 'positions'), to_device(row_variants, 'segments'))
+                logproba_chk = masked_logproba(to_device(inputs_chk), mask, row_tokens[mask], packed)
+                span_logproba[row_variants[mask], offsets[mask]] = logproba_chk
+
+        # Compute log proba, summing in the same order (and precision) as token by token:
+        # the masked tokens of each variant, then the variants of each sentence
+        variant_scores = torch.zeros(n_variants)
+        for j in range(span_logproba.size(1)):
+            variant_scores = variant_scores + span_logproba[:, j]
+        if verbose:
+            for score in variant_scores:
+                print(score)
+
+        n_per_sentence = torch.bincount(variant_sentences, minlength=len(sequences_list))
+        first_variant = torch.cumsum(n_per_sentence, 0) - n_per_sentence
+        sentence_scores = torch.zeros(len(sequences_list), int(n_per_sentence.max()))
+        sentence_scores[variant_sentences, torch.arange(n_variants) - first_variant[variant_sentences]] = variant_scores
+        logproba_all_variants = torch.zeros(len(sequences_list))
+        for k in range(sentence_scores.size(1)):
+            logproba_all_variants = logproba_all_variants + sentence_scores[:, k]
 
-            outputs_list.extend(outputs_chk.unbind())
-        
-        # Compute log proba
         logproba_list = []
-        i = 0
-        for sentence_tokens in sequences_list:
-            ln = len(sentence_tokens) - 2
-
-            # Get actual span size, in case of short sequences
-            actual_span_size = min(decoding_span_size, ln)
-
-            # Overlap ?
-            if span_overlap:
-                step_size = temporal_sliding_size
-            else:
-                step_size  = max(actual_span_size,1)
-
-            logproba = 0.
-            for idx in range(0, ln-actual_span_size+1, step_size):
-                score = 0.
-                for idx_masked in range(idx+1, idx+1+actual_span_size):
-                    #if i < len(outputs_list) and idx_masked < outputs_list[i].shape[0]:
-                    score += outputs_list[i][idx_masked].softmax(0)[sentence_tokens[idx_masked]].log()
-                    #else:
-                    #    break
-                if verbose:
-                    print(score)
-                logproba += score
-                i += 1
-
+        for logproba in logproba_all_variants.tolist():
             if logproba != 0.:
-                logproba_list.append(logproba.data.item())
+                logproba_list.append(logproba)
             else:
                 logproba_list.append(0.)
 
@@ -200,23 +356,34 @@ def compute_proba_BERT_mlm_span(
         print(f"Parameters: decoding_span_size={decoding_span_size}, temporal_sliding_size={temporal_sliding_size}, span_overlap={span_overlap}")
         print("Number of sequences: {}".format(len(sequences)))
         if batchsen_size > 0:
-            logproba_all = []
+            logproba_all = [None] * len(sequences)
             n_batch = len(sequences)//batchsen_size
             if len(sequences) % batchsen_size != 0:
                 n_batch += 1
 
+            # Sentences of similar lengths together with max_tokens, file order otherwise
+            order = list(range(len(sequences)))
+            if max_tokens is not None:
+                order.sort(key=lambda j: -len(sequences[j].split() if tokenized else sequences[j]))
+            n_saved = 0
+
             start_time = time()
             for i in range(n_batch):
-                sequences_batch = sequences[i*batchsen_size : min((i+1)*batchsen_size, len(sequences))]
+                batch_ids = order[i*batchsen_size : min((i+1)*batchsen_size, len(sequences))]
+                sequences_batch = [sequences[j] for j in batch_ids]
                 
                 with torch.no_grad():
                     logproba_batch, shape_statistics = compute_proba_batchsen(sequences_batch)
-                logproba_all.extend(logproba_batch)
+                for j, score in zip(batch_ids, logproba_batch):
+                    logproba_all[j] = score
                 
-                if save_to is not None:
-                    file_names_batch = file_names[i*batchsen_size : min((i+1)*batchsen_size, len(sequences))]
+                # Save the scores once all the previous ones are known
+                n_ready = n_saved
+                while n_ready < len(sequences) and logproba_all[n_ready] is not None:
+                    n_ready += 1
+                if save_to is not None and n_ready > n_saved:
                     outLines = []
-                    for fname, score in zip(file_names_batch, logproba_batch):
+                    for fname, score in zip(file_names[n_saved:n_ready], logproba_all[n_saved:n_ready]):
                         outLines.append(" ".join([fname, str(score)]))
                     outLines = "\n".join(outLines)
                     with open(save_to, 'a') as f:
@@ -226,6 +393,7 @@ def compute_proba_BERT_mlm_span(
                         #    f.write(outLines+'\n')
                         #    addEndLine = True
                         f.write(outLines + '\n')
+                n_saved = n_ready
 
                 if print_shape_statistics:
                     print("Batch {:d}/{:d}. Input shapes: {} Done in {:4f} s.\t\t\t".format(
@@ -260,6 +428,7 @@ def compute_proba_BERT_mlm_span(
         # Release all GPU memory
         if gpu:
             roberta = roberta.cpu()
+            input_buffers.clear()
             gc.collect()
             torch.cuda.empty_cache()
 
@@ -267,6 +436,7 @@ def compute_proba_BERT_mlm_span(
         # Release all GPU memory
         if gpu:
             roberta = roberta.cpu()
+            input_buffers.clear()
             gc.collect()
             torch.cuda.empty_cache()
 
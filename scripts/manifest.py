@@ -0,0 +1,211 @@
+import os
+import time
+import soundfile as sf
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from dir_scanner import listFiles
+
+MANIFEST_NAME = '_manifest.tsv'
+MANIFEST_HEADER = ['path', 'size', 'mtime', 'frames', 'sample_rate',
+                   'speaker', 'language']
+
+ManifestEntry = namedtuple('ManifestEntry', MANIFEST_HEADER)
+
+# A subset is a list of manifest entries with absolute paths, preceded by the
+# hour budget of each language, eg. "# budget mls_french 25"
+SUBSET_EXTENSION = '.tsv'
+
+
+def readManifest(pathManifest):
+    r"""
+    Load a manifest file as a dictionnary path -> ManifestEntry, the paths
+    being relative to the corpus root. Returns an empty dictionnary if the
+    manifest does not exist.
+    """
+    entries = {}
+    if not os.path.exists(pathManifest):
+        return entries
+    with open(pathManifest, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header != MANIFEST_HEADER:
+            print(f'Invalid manifest header in {pathManifest}, ignoring it')
+            return entries
+        for line in f:
+            path, size, mtime, frames, sampleRate, speaker, language = \
+                line.rstrip('\n').split('\t')
+            entries[path] = ManifestEntry(path, int(size), int(mtime),
+                                          int(frames), int(sampleRate),
+                                          speaker, language)
+    return entries
+
+
+def writeManifest(pathManifest, entries):
+    tmpPath = pathManifest + '.tmp'
+    with open(tmpPath, 'w') as f:
+        f.write('\t'.join(MANIFEST_HEADER) + '\n')
+        for entry in entries:
+            f.write('\t'.join(str(x) for x in entry) + '\n')
+    os.replace(tmpPath, pathManifest)
+
+
+def isSubset(path):
+    return str(path).endswith(SUBSET_EXTENSION) and os.path.isfile(path)
+
+
+def readSubset(pathSubset):
+    r"""
+    Load a subset file written by writeSubset.
+    Return:
+        entries, budgets
+
+        entries: the list of ManifestEntry, with absolute paths (relative
+                 ones are taken from the directory of the subset file)
+        budgets: a dictionnary language -> hours
+    """
+    entries, budgets = [], {}
+    root = os.path.dirname(os.path.abspath(pathSubset))
+    with open(pathSubset, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                fields = line[1:].split()
+                if len(fields) == 3 and fields[0] == 'budget':
+                    budgets[fields[1]] = float(fields[2])
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if fields == MANIFEST_HEADER or not line.strip():
+                continue
+            path, size, mtime, frames, sampleRate, speaker, language = fields
+            entries.append(ManifestEntry(os.path.normpath(os.path.join(root, path)),
+                                         int(size), int(mtime), int(frames),
+                                         int(sampleRate), speaker, language))
+    return entries, budgets
+
+
+def writeSubset(pathSubset, entries, budgets):
+    r"""
+    Args:
+        - pathSubset (string): output file, ending with .tsv
+        - entries (list): ManifestEntry of the files of the subset, with
+                          absolute paths
+        - budgets (dictionnary): language -> hours
+    """
+    assert pathSubset.endswith(SUBSET_EXTENSION), \
+        f"A subset file should end with {SUBSET_EXTENSION}"
+    with open(pathSubset, 'w') as f:
+        for language, hours in budgets.items():
+            f.write(f'# budget {language} {hours}\n')
+        f.write('\t'.join(MANIFEST_HEADER) + '\n')
+        for entry in entries:
+            f.write('\t'.join(str(x) for x in entry) + '\n')
+
+
+def probeFile(path):
+    info = sf.info(path)
+    return info.frames, info.samplerate
+
+
+def updateManifest(root,
+                   extension=['.flac', '.wav'],
+                   speaker_level=1,
+                   language=None,
+                   nThreads=16):
+    r"""
+    Refresh the manifest of the corpus root: files whose size and mtime did
+    not change keep their entry, new or modified ones have their header read
+    again and deleted ones are dropped.
+    Args:
+        - root (string): root directory of the corpus
+        - extension (list): extensions of the audio files to list
+        - speaker_level (int): the first speaker_level directories under root
+                               give the speaker label (see findAllSeqs)
+        - language (string): tag of the corpus, root basename by default
+        - nThreads (int): number of threads reading the file headers
+    Return:
+        the list of ManifestEntry, sorted by path
+    """
+    if language is None:
+        language = os.path.basename(os.path.normpath(root))
+    pathManifest = os.path.join(root, MANIFEST_NAME)
+    oldEntries = readManifest(pathManifest)
+
+    entries, toProbe = {}, []
+    for relDir, filename in listFiles(root, extension, nThreads=nThreads):
+        path = os.path.join(relDir, filename)
+        stat = os.stat(os.path.join(root, path))
+        speaker = (os.sep).join(os.path.dirname(path).split(os.sep)[:speaker_level])
+        entry = oldEntries.get(path)
+        if entry is not None and entry.size == stat.st_size \
+                and entry.mtime == stat.st_mtime_ns:
+            entries[path] = entry._replace(speaker=speaker, language=language)
+        else:
+            entries[path] = ManifestEntry(path, stat.st_size, stat.st_mtime_ns,
+                                          0, 0, speaker, language)
+            toProbe.append(path)
+
+    if len(toProbe) > 0:
+        print(f'Reading the headers of {len(toProbe)} new or modified files')
+        with ThreadPool(nThreads) as pool:
+            infos = pool.map(probeFile, [os.path.join(root, x) for x in toProbe],
+                             chunksize=64)
+        for path, (frames, sampleRate) in zip(toProbe, infos):
+            entries[path] = entries[path]._replace(frames=frames,
+                                                   sample_rate=sampleRate)
+
+    entries = [entries[x] for x in sorted(entries)]
+    if len(toProbe) > 0 or len(entries) != len(oldEntries) \
+            or any(oldEntries.get(x.path) != x for x in entries):
+        try:
+            writeManifest(pathManifest, entries)
+            print(f'Saved manifest at {pathManifest}')
+        except OSError as err:
+            print(f'Ran in an error while saving {pathManifest}: {err}')
+    return entries
+
+
+def loadManifests(dirNames,
+                  extension=['.flac', '.wav'],
+                  speaker_level=1,
+                  languages=None,
+                  refresh=True,
+                  nThreads=16):
+    r"""
+    Same output as findAllSeqs_Mix, from the manifests of the given corpora.
+    Args:
+        - dirNames (list): corpus roots, or subset files (see writeSubset)
+        - extension, speaker_level, nThreads: see updateManifest
+        - languages (list): if not None, the tag of each corpus
+        - refresh (bool): if False, an existing manifest is used as it is
+    Return:
+        seqNames, speakers, lengths
+
+        seqNames: a list of (speaker index, absolute path) couples
+        speakers: the speaker labels, speaker indexes being unique across
+                  corpora
+        lengths: a dictionnary absolute path -> number of frames
+    """
+    start_time = time.time()
+    seqNames, speakers, lengths = [], [], {}
+    speakersTarget = {}
+    for index, dirName in enumerate(dirNames):
+        language = None if languages is None else languages[index]
+        pathManifest = os.path.join(dirName, MANIFEST_NAME)
+        if isSubset(dirName):
+            entries = readSubset(dirName)[0]
+        elif refresh or not os.path.exists(pathManifest):
+            entries = updateManifest(dirName, extension=extension,
+                                     speaker_level=speaker_level,
+                                     language=language, nThreads=nThreads)
+        else:
+            entries = list(readManifest(pathManifest).values())
+        for entry in entries:
+            key = (dirName, entry.language, entry.speaker)
+            if key not in speakersTarget:
+                speakersTarget[key] = len(speakersTarget)
+                speakers.append(entry.speaker)
+            fullPath = os.path.normpath(os.path.join(dirName, entry.path))
+            seqNames.append((speakersTarget[key], fullPath))
+            lengths[fullPath] = entry.frames
+    print(f'Loaded the manifests of {len(dirNames)} corpora, {len(seqNames)} '
+          f'files, in {time.time() - start_time:.2f} seconds')
+    return seqNames, speakers, lengths
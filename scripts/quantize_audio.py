@@ -1,7 +1,6 @@
 import faulthandler
 faulthandler.enable()
 import yaml
-import fairseq
 import os
 import sys
 import json
@@ -12,10 +11,12 @@ from random import shuffle
 from time import time
 import torch
 from dataset import findAllSeqs_Mix
-from feature_loader import buildXlsrFeature, buildS3PRLFeature, buildWhisperFeature
-from cpc.criterion.clustering.clustering import kMeanCluster
-import s3prl.hub as hub
-import whisper
+from manifest import loadManifests
+from selection import selectSeqs, parseSplit
+from feature_loader import loadEncoder, buildEncoderFeature
+from cpc.criterion.clustering.clustering import kMeanCluster, selectPrecision
+from cpc.criterion.clustering.dim_reduction import loadDimReduction
+from cpc.criterion.clustering.frame_reduction import loadFrameReduction
 
 def readArgs(pathArgs):
     print(f"Loading args from {pathArgs}")
@@ -28,20 +29,45 @@ def writeArgs(pathArgs, args):
     with open(pathArgs, 'w') as file:
         json.dump(vars(args), file, indent=2)
 
-def loadClusterModule(pathCheckpoint):
+def loadClusterCheckpoint(pathCheckpoint):
     """
-    Load CPC Clustering Module from Clustering checkpoint file.
+    Load the Clustering checkpoint file once, for the loaders below.
+    """
+    return torch.load(pathCheckpoint, map_location=torch.device('cpu'))
+
+def loadClusterModule(state_dict):
+    """
+    Load CPC Clustering Module from the Clustering checkpoint.
     """
-    state_dict = torch.load(pathCheckpoint, map_location=torch.device('cpu'))
     clusterModule = kMeanCluster(torch.zeros(1, state_dict["n_clusters"], state_dict["dim"]))
     clusterModule.load_state_dict(state_dict["state_dict"])
     return clusterModule.eval()
 
-def quantize_file(file_path, cpc_feature_function, clusterModule):
+def loadClusterDimReduction(state_dict):
+    """
+    Load the dimensionality reduction saved with the Clustering checkpoint, if any.
+    """
+    if state_dict.get("dimReduction") is None:
+        return None
+    return loadDimReduction(state_dict["dimReduction"]).eval()
+
+def loadClusterFrameReduction(state_dict):
+    """
+    Load the frame rate reduction saved with the Clustering checkpoint, if any.
+    """
+    if state_dict.get("frameReduction") is None:
+        return None
+    return loadFrameReduction(state_dict["frameReduction"])
+
+def quantize_file(file_path, cpc_feature_function, clusterModule, dimReduction=None, frameReduction=None):
     # Get CPC features
     cFeatures = cpc_feature_function(file_path)
     if clusterModule.Ck.is_cuda:
         cFeatures = cFeatures.cuda()
+    if frameReduction is not None:
+        cFeatures = frameReduction(cFeatures)
+    if dimReduction is not None:
+        cFeatures = dimReduction(cFeatures)
 
     nGroups = cFeatures.size(-1)//clusterModule.Ck.size(-1) # groups information
 
@@ -118,18 +144,9 @@ def main(argv):
     print(f"Quantizing data from {config['data']['pathDB']}")
     print("=============================================================")
 
-    assert (config['runner']['cp_path'] is None and config['runner']['s3prl'] is not None and config['runner']['whisper'] is None) \
-            or (config['runner']['cp_path'] is not None and config['runner']['s3prl'] is None and config['runner']['whisper'] is None) \
-            or (config['runner']['cp_path'] is None and config['runner']['s3prl'] is None and config['runner']['whisper'] is not None), \
-            "Don't use fairseq model, s3prl model or whisper at once."
-
     # Get splits
     if config['data']['split']:
-        assert len(config['data']['split'].split("-"))==2 and int(config['data']['split'].split("-")[1]) >= int(config['data']['split'].split("-")[0]) >= 1, \
-            "SPLIT must be under the form idxSplit-numSplits (numSplits >= idxSplit >= 1), eg. --split 1-20"
-        idx_split, num_splits = config['data']['split'].split("-")
-        idx_split = int(idx_split)
-        num_splits = int(num_splits)
+        idx_split, num_splits = parseSplit(config['data']['split'])
 
     # Find all sequences
     for i in range(len(config['data']['pathDB'])):
@@ -137,38 +154,29 @@ def main(argv):
 
     print("")
     print(f"Looking for all {config['data']['file_extension']} files in {config['data']['pathDB']}")
-    seqNames, _ = findAllSeqs_Mix(config['data']['pathDB'],
-                                 speaker_level=1,
-                                 extension=config['data']['file_extension'],
-                                 loadCache=True)
-    print(f"Done! Found {len(seqNames)} files!")
-    flag = len(seqNames) == 0
-    other_flag = True
-    for ex in config['data']['file_extension']:
-        other_flag = other_flag and (not os.path.splitext(seqNames[0][1])[1].endswith(ex))
-    #if len(seqNames) == 0 or not os.path.splitext(seqNames[0][1])[1].endswith(args.file_extension):
-    if (flag or other_flag):
-        print(f"Seems like the _seq_cache.txt does not contain the correct extension, reload the file list")
+    seqLengths = None
+    manifest = config['data'].get('manifest')
+    if manifest is not None:
+        seqNames, _, seqLengths = loadManifests(config['data']['pathDB'],
+                                       extension=config['data']['file_extension'],
+                                       refresh=manifest == 'refresh')
+    else:
         seqNames, _ = findAllSeqs_Mix(config['data']['pathDB'],
-                                    speaker_level=1,
-                                    extension=config['data']['file_extension'],
-                                    loadCache=False)
+                                     speaker_level=1,
+                                     extension=config['data']['file_extension'],
+                                     loadCache=True)
     print(f"Done! Found {len(seqNames)} files!")
     #assert False==True
     # Filter specific sequences
-    if config['data']['pathSeq']:
+    nSeqs = len(seqNames)
+    seqNames = selectSeqs(seqNames,
+                          include=config['data']['pathSeq'],
+                          exclude=config['data'].get('excludeSeq'),
+                          glob=config['data'].get('glob'),
+                          regex=config['data'].get('regex'),
+                          matchStem=config['data'].get('matchStem', False))
+    if len(seqNames) != nSeqs:
         print("")
-        print(f"Filtering seqs in {config['data']['pathSeq']}")
-        with open(config['data']['pathSeq'], 'r') as f:	
-            seqs = set([x.strip() for x in f])
-
-        filtered = []	
-        for s in seqNames:
-            #if os.path.splitext(s[1].split('/')[-1])[0] in seqs:
-            if s[1] in seqs:	
-                filtered.append(s)	
-        seqNames = filtered
-        #print(seqNames)
         print(f"Done! {len(seqNames)} files filtered!")
         
     #print(seqNames)
@@ -191,14 +199,11 @@ def main(argv):
     
     # Get splits
     if config['data']['split']:
-        startIdx = len(seqNames) // num_splits * (idx_split-1)
-        if idx_split == num_splits:
-            endIdx = len(seqNames)
-        else:
-            endIdx = min(len(seqNames) // num_splits * idx_split, len(seqNames))
-        seqNames = seqNames[startIdx:endIdx]
+        splitMode = config['data'].get('splitMode', 'range')
+        seqNames = selectSeqs(seqNames, split=config['data']['split'],
+                              splitMode=splitMode, seqLengths=seqLengths)
         print("")
-        print(f"Quantizing split {idx_split} out of {num_splits} splits, with {len(seqNames)} files (idx in range({startIdx}, {endIdx})).")
+        print(f"Quantizing split {idx_split} out of {num_splits} splits ({splitMode}), with {len(seqNames)} files.")
 
     # Debug mode
     if config['runner']['debug']:
@@ -250,52 +255,42 @@ def main(argv):
     # Load CluterModule
     print("")
     print(f"Loading ClusterModule at {pathClusteringCheckpoint}")
-    clusterModule = loadClusterModule(pathClusteringCheckpoint).eval()
+    clusterState = loadClusterCheckpoint(pathClusteringCheckpoint)
+    clusterModule = loadClusterModule(clusterState).eval()
+    dimReduction = loadClusterDimReduction(clusterState)
+    if dimReduction is not None:
+        print(f"Applying the {'whitening' if dimReduction.whiten else 'pca'} saved with the clustering "
+              f"({dimReduction.projection.size(0)} -> {dimReduction.projection.size(1)} dims)")
+    frameReduction = loadClusterFrameReduction(clusterState)
+    if frameReduction is not None:
+        print(f"Reducing the frame rate from {frameReduction.inputRate} to {frameReduction.outputRate} Hz "
+              f"({frameReduction.mode}), as for the clustering")
     if not config['runner']['cpu']:
         clusterModule.cuda()
+        if dimReduction is not None:
+            dimReduction.cuda()
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model_name = None
-    flag = None
-    if config['runner']['cp_path'] is not None:
-        cp_path = config['runner']['cp_path']
-        flag = 'fairseq'
-        model_name = cp_path
-        model, cfg, task = fairseq.checkpoint_utils.load_model_ensemble_and_task([cp_path])
-        #featureMaker = torch.nn.DataParallel(model[0]).to(device)
-        featureMaker = model[0].to(device)
+    encoder = loadEncoder(config['runner'], device)
+    print(f'Successfully loaded {encoder.name} on {device}!')
 
-    elif config['runner']['s3prl'] is not None:
-        flag = 's3prl'
-        model_name = config['runner']['s3prl']
-        featureMaker = getattr(hub, config['runner']['s3prl'])().to(device)
-    
-    elif config['runner']['whisper'] is not None:
-        flag = 'whisper'
-        model_name = f'whisper-{config["runner"]["whisper"]}'
-        featureMaker = whisper.load_model(config['runner']['whisper']).to(device)
-    else:
-        print("Please specify the speech encoder in the config file.")
-        raise
+    def feature_function(x):
+            return buildEncoderFeature(encoder, x, seqNorm=False, strict=config['runner']['strict'],
+                                       batchSize=config['data']['batch_size'],
+                                       pathArchive=config['data'].get('pathArchive'))
 
-
-    print(f'Successfully loaded {model_name} on {device}!')
-    #if clustering_args.dimReduction is not None:
-        #dimRed = loadDimReduction(clustering_args.dimReduction, clustering_args.centroidLimits)
-        #featureMaker = torch.nn.Sequential(featureMaker, dimRed)
-    #if not clustering_args.train_mode:
-        #featureMaker.eval()
-    #if not args.cpu:
-    #    featureMaker.cuda()
-
-    def xlsr_feature_function(x):
-            return buildXlsrFeature(featureMaker.eval(), x, seqNorm=False, strict=config['runner']['strict'], layer=config['runner']['layer'])
-    
-    def s3prl_feature_function(x):
-            return buildS3PRLFeature(featureMaker.eval(), x, seqNorm=False, strict=config['runner']['strict'], layer=config['runner']['layer'])
-
-    def whisper_feature_function(x):
-            return buildWhisperFeature(featureMaker.eval(), x, seqNorm=False, strict=config['runner']['strict'], layer=config['runner']['layer'])
+    # Cluster assignment precision
+    precision = config['runner'].get('precision', 'fp32')
+    if precision == 'auto':
+        print("")
+        sample = feature_function(Path(seqNames[0][1])).to(clusterModule.Ck.device)
+        if frameReduction is not None:
+            sample = frameReduction(sample)
+        if dimReduction is not None:
+            sample = dimReduction(sample)
+        precision = selectPrecision(sample.view(-1, clusterModule.Ck.size(-1)), clusterModule.Ck[0],
+                                    minAgreement=config['runner'].get('minAgreement', 0.99))
+    clusterModule.precision = precision
     # Quantization of files
     print("")
     print(f"Quantizing audio files and saving outputs to {outputFile}...")
@@ -310,12 +305,7 @@ def main(argv):
         #file_path = os.path.join(args.pathDB, file_path)
         file_path = Path(file_path)
         # Quantizing
-        if flag == 'fairseq':
-            quantLine = quantize_file(file_path, xlsr_feature_function, clusterModule)
-        elif flag == 's3prl':
-            quantLine = quantize_file(file_path, s3prl_feature_function, clusterModule)
-        elif flag == 'whisper':
-            quantLine = quantize_file(file_path, whisper_feature_function, clusterModule)
+        quantLine = quantize_file(file_path, feature_function, clusterModule, dimReduction, frameReduction)
         #print(quantLine)
         # Save the outputs
         file_name = str(file_path)
@@ -1,15 +1,20 @@
 import os
 import yaml
 import argparse
-import collections
-import soundfile as sf
 
 from pathlib import Path
+from subset_sampling import MATERIALIZE_MODES, get_entries, durations, round_robin_order, select_budget, materialize, write_subsets
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="config/data_config.yaml", help="data configuration")
     parser.add_argument("--split", type=str, default="dev", help="data split")
+    parser.add_argument("--mode", type=str, default="auto", choices=MATERIALIZE_MODES,
+                        help="how to put the sampled files in the output directory (see subset_sampling.materialize)")
+    parser.add_argument("--workers", type=int, default=16, help="threads reading the headers and transcoding processes")
+    parser.add_argument("--subset", type=str, default=None,
+                        help="write the selection to this .tsv subset file, to give as pathDB, instead of "
+                        "putting the files in the output directory")
     args = parser.parse_args()
     with open(args.config, "r") as fp:
         config = yaml.load(fp, Loader=yaml.FullLoader)
@@ -23,43 +28,30 @@ if __name__ == "__main__":
 
     total_seconds_list = [h*3600 for h in hr_list]
     
-    if not os.path.isdir(output_dir):
+    if not os.path.isdir(output_dir) and args.subset is None:
         os.mkdir(output_dir)
 
+    selections = []
+
     for lang, total_seconds, ext in zip(lang_list, total_seconds_list, ext_list):
         data_path = os.path.join(mono_data_root, lang)
         if "mls" in lang:
             data_path = os.path.join(data_path, "{}/audio".format(args.split))
         audio_files = sorted(list(map(str, list(Path(data_path).rglob("*." + ext)))))
         assert len(audio_files) > 0
-        d = collections.defaultdict(list)
-        d_maxidx = collections.defaultdict(int)
-        d_idx = collections.defaultdict(int)
-        key_idx = 0
-        
-        for p in audio_files:
-            k = '_'.join(p.split('/')[-1].split('_')[:2])
-            d[k].append(p)
-            d_maxidx[k] += 1
-        
-        keys = list(d.keys())
-        len_count = 0
-        
-        while (True):
-            k = keys[key_idx]
-        
-            if d_idx[k] < d_maxidx[k]:
-                p = d[k][d_idx[k]]
-                wav, sr = sf.read(p)
-                d_idx[k] += 1
-                len_count += len(wav) / sr
-                output_path = os.path.join(output_dir, lang)
-                if not os.path.exists(output_path):
-                    Path(output_path).mkdir(parents=True, exist_ok=True)
-                sf.write(os.path.join(output_path, os.path.splitext(os.path.basename(p))[0] + '.wav'), wav, sr)
-            if len_count >= total_seconds:
-                break
-            key_idx = (key_idx + 1) % len(keys)
-            
+
+        # Round robin over the speakers (first two fields of the file name)
+        keys = ['_'.join(p.split('/')[-1].split('_')[:2]) for p in audio_files]
+        entries = get_entries(audio_files, keys, lang, root=data_path, workers=args.workers)
+        selected, len_count = select_budget(round_robin_order(keys), durations(entries), total_seconds)
+
+        if args.subset is not None:
+            selections.append((lang, total_seconds / 3600, [entries[i] for i in selected]))
+        else:
+            materialize([audio_files[i] for i in selected], os.path.join(output_dir, lang),
+                        mode=args.mode, workers=args.workers)
         print(len_count)
+
+    if args.subset is not None:
+        write_subsets(args.subset, selections)
     
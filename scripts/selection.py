@@ -0,0 +1,156 @@
+import os
+import re
+import heapq
+import fnmatch
+import hashlib
+
+
+def readSeqList(pathTxt):
+    r"""
+    Set of the non empty lines of the given file.
+    """
+    with open(pathTxt, 'r') as f:
+        return set(x.strip() for x in f if x.strip())
+
+
+def seqKeys(path, matchStem=False):
+    path = str(path)
+    if not matchStem:
+        return path,
+    return path, os.path.splitext(os.path.basename(path))[0]
+
+
+def includeSeqs(seqNames, keys, matchStem=False):
+    r"""
+    Keep the (speaker, path) couples whose full path is in keys (a set).
+    With matchStem, a file name without extension in keys also keeps every
+    file of that name, whatever its directory.
+    """
+    return [x for x in seqNames if any(k in keys for k in seqKeys(x[1], matchStem))]
+
+
+def excludeSeqs(seqNames, keys, matchStem=False):
+    return [x for x in seqNames if not any(k in keys for k in seqKeys(x[1], matchStem))]
+
+
+def matchSeqs(seqNames, pattern, regex=False):
+    r"""
+    Keep the couples whose path matches the given glob pattern (or regular
+    expression if regex is True, searched anywhere in the path).
+    """
+    if regex:
+        compiled = re.compile(pattern)
+    else:
+        compiled = re.compile(fnmatch.translate(pattern))
+    match = compiled.search if regex else compiled.match
+    return [x for x in seqNames if match(str(x[1]))]
+
+
+def parseSplit(split):
+    r"""
+    Parse a split given as idxSplit-numSplits (numSplits >= idxSplit >= 1).
+    """
+    assert len(split.split("-")) == 2 and int(split.split("-")[1]) >= int(split.split("-")[0]) >= 1, \
+        "SPLIT must be under the form idxSplit-numSplits (numSplits >= idxSplit >= 1), eg. --split 1-20"
+    idxSplit, numSplits = split.split("-")
+    return int(idxSplit), int(numSplits)
+
+
+def rangeSplit(seqNames, idxSplit, numSplits):
+    r"""
+    Contiguous split of the list, the last one getting the remainder.
+    """
+    startIdx = len(seqNames) // numSplits * (idxSplit - 1)
+    if idxSplit == numSplits:
+        endIdx = len(seqNames)
+    else:
+        endIdx = min(len(seqNames) // numSplits * idxSplit, len(seqNames))
+    return seqNames[startIdx:endIdx]
+
+
+def hashShard(seqNames, idxSplit, numSplits):
+    r"""
+    Stable sharding by hash of the path: a sequence always lands in the
+    same shard whatever the other sequences of the list.
+    """
+    def shard(path):
+        digest = hashlib.md5(str(path).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'little') % numSplits
+
+    return [x for x in seqNames if shard(x[1]) == idxSplit - 1]
+
+
+def durationSplit(seqNames, idxSplit, numSplits, seqLengths=None):
+    r"""
+    Splits of (nearly) equal total duration: the longest sequences are
+    assigned first, each one to the split with the smallest total so far.
+    Without seqLengths (path -> number of frames), the file sizes are used
+    instead of the durations.
+    Order of seqNames is kept inside a split.
+    """
+    def length(path):
+        if seqLengths is not None and str(path) in seqLengths:
+            return seqLengths[str(path)]
+        return os.path.getsize(path)
+
+    lengths = [length(x[1]) for x in seqNames]
+    order = sorted(range(len(seqNames)), key=lambda i: (-lengths[i], str(seqNames[i][1])))
+    heap = [(0, i) for i in range(numSplits)]
+    assigned = [0] * len(seqNames)
+    for i in order:
+        total, split = heapq.heappop(heap)
+        assigned[i] = split
+        heapq.heappush(heap, (total + lengths[i], split))
+    return [x for x, split in zip(seqNames, assigned) if split == idxSplit - 1]
+
+
+SPLIT_MODES = {'range': rangeSplit,
+               'hash': hashShard,
+               'duration': durationSplit}
+
+
+def selectSeqs(seqNames,
+               include=None,
+               exclude=None,
+               glob=None,
+               regex=None,
+               split=None,
+               splitMode='range',
+               seqLengths=None,
+               matchStem=False):
+    r"""
+    Apply all the given selections to a list of (speaker, path) couples.
+    Args:
+        - seqNames (list): (speaker, path) couples
+        - include (string): path of a file listing the sequences to keep
+                            (full paths)
+        - exclude (string): path of a file listing the sequences to drop
+        - glob (string): glob pattern the paths should match
+        - regex (string): regular expression the paths should contain
+        - split (string): idxSplit-numSplits, keep only the given split
+        - splitMode (string): how to split, 'range' for contiguous splits,
+                              'hash' for a stable sharding by path hash or
+                              'duration' for splits of equal duration
+        - seqLengths (dictionnary): number of frames of the sequences, for
+                                    the 'duration' mode
+        - matchStem (bool): if True, the include and exclude lists may also
+                            give file names without extension, matching the
+                            files of that name in any directory
+    """
+    if include is not None:
+        seqNames = includeSeqs(seqNames, readSeqList(include), matchStem)
+    if exclude is not None:
+        seqNames = excludeSeqs(seqNames, readSeqList(exclude), matchStem)
+    if glob is not None:
+        seqNames = matchSeqs(seqNames, glob)
+    if regex is not None:
+        seqNames = matchSeqs(seqNames, regex, regex=True)
+    if split is not None:
+        if splitMode not in SPLIT_MODES:
+            raise ValueError(f"Unknown split mode {splitMode}")
+        idxSplit, numSplits = parseSplit(split)
+        if splitMode == 'duration':
+            seqNames = durationSplit(seqNames, idxSplit, numSplits, seqLengths)
+        else:
+            seqNames = SPLIT_MODES[splitMode](seqNames, idxSplit, numSplits)
+    return seqNames
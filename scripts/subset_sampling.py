@@ -0,0 +1,120 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile as sf
+
+from manifest import MANIFEST_NAME, ManifestEntry, readManifest, probeFile, writeSubset
+
+MATERIALIZE_MODES = ['auto', 'hardlink', 'symlink', 'copy', 'transcode']
+
+def get_entries(paths, speakers, language, root=None, workers=16):
+    r"""
+    Manifest entries (absolute paths) of the given audio files, taken from
+    the _manifest.tsv of root when it has an up to date entry (see
+    manifest.py), the file headers being read otherwise (in a pool of
+    threads).
+    """
+    cached = readManifest(os.path.join(root, MANIFEST_NAME)) if root is not None else {}
+    entries, missing = [], []
+    for i, (path, speaker) in enumerate(zip(paths, speakers)):
+        stat = os.stat(path)
+        entry = cached.get(os.path.relpath(path, root)) if cached else None
+        if entry is None or entry.size != stat.st_size or entry.mtime != stat.st_mtime_ns:
+            entry = ManifestEntry(path, stat.st_size, stat.st_mtime_ns, 0, 0, speaker, language)
+            missing.append(i)
+        entries.append(entry._replace(path=os.path.abspath(path), speaker=speaker, language=language))
+    if missing:
+        with ThreadPoolExecutor(workers) as pool:
+            infos = pool.map(probeFile, [paths[i] for i in missing])
+            for i, (frames, sample_rate) in zip(missing, infos):
+                entries[i] = entries[i]._replace(frames=frames, sample_rate=sample_rate)
+    return entries
+
+def durations(entries):
+    return np.array([x.frames / x.sample_rate for x in entries])
+
+def round_robin_order(keys):
+    r"""
+    Order in which a round robin over the groups takes the items: the first
+    item of each group (groups in order of first appearance), then the second
+    ones, etc. keys gives the group of each item, items keeping their order
+    inside a group.
+    """
+    _, first, group = np.unique(np.asarray(keys), return_index=True, return_inverse=True)
+    group_order = np.argsort(np.argsort(first))[group.reshape(-1)]
+    # Rank of each item inside its group
+    by_group = np.argsort(group_order, kind='stable')
+    counts = np.bincount(group_order)
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[by_group] = np.arange(len(keys)) - starts[group_order[by_group]]
+    return np.lexsort((group_order, rank))
+
+def select_budget(order, durations, total_seconds):
+    r"""
+    Take the items in the given order until their total duration reaches
+    total_seconds, the item crossing the budget included.
+    Return:
+        the selected indices and their total duration
+    """
+    cumulated = np.cumsum(durations[order])
+    n = min(int(np.searchsorted(cumulated, total_seconds, side='left')) + 1, len(order))
+    if n > 0 and cumulated[n - 1] < total_seconds:
+        print(f'Only {cumulated[n - 1]:.1f} seconds available out of {total_seconds}')
+    return order[:n], float(cumulated[n - 1]) if n > 0 else 0.
+
+def transcode(job):
+    src, dst = job
+    wav, sr = sf.read(src)
+    sf.write(dst, wav, sr)
+
+def materialize(files, output_dir, mode='auto', workers=16):
+    r"""
+    Put the given audio files in output_dir.
+    Args:
+        - files (list): paths of the files
+        - output_dir (string): output directory
+        - mode (string): 'hardlink', 'symlink' or 'copy' keep the files as
+                         they are, 'transcode' rewrites them as wav in a
+                         pool of processes, 'auto' links (or copies, across
+                         file systems) the wav files and transcodes the others
+        - workers (int): number of transcoding processes
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(f'Unknown mode {mode}')
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for src in files:
+        name, ext = os.path.splitext(os.path.basename(src))
+        if mode == 'transcode' or (mode == 'auto' and ext.lower() != '.wav'):
+            jobs.append((src, os.path.join(output_dir, name + '.wav')))
+            continue
+        dst = os.path.join(output_dir, name + ext)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        elif mode == 'copy':
+            shutil.copyfile(src, dst)
+        else:
+            try:
+                os.link(src, dst)
+            except OSError:
+                if mode == 'hardlink':
+                    raise
+                shutil.copyfile(src, dst)
+    if jobs:
+        with Pool(workers) as pool:
+            pool.map(transcode, jobs, chunksize=16)
+
+def write_subsets(path_subset, selections):
+    r"""
+    Write the selected files as a subset (see manifest.writeSubset) instead
+    of materializing them. selections is a list of (language, hours, entries).
+    """
+    writeSubset(path_subset, [x for _, _, entries in selections for x in entries],
+                {language: hours for language, hours, _ in selections})
+    print(f'Wrote {path_subset}')
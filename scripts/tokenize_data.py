@@ -1,72 +1,141 @@
-import fairseq
-from fairseq.models.roberta.model_xlmr import XLMRModel
+from fairseq.data import Dictionary, indexed_dataset
+import sentencepiece as spm
+import torch
 import argparse
 import csv
+from collections import deque
+from itertools import chain, islice
+from multiprocessing import Pool
 from tqdm import tqdm
 from pathlib import Path
 import os
+import shutil
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--input', type=str, help='The input senetences that are going to tokenize.')
 parser.add_argument('--output', type=str, help='Output tokenized sentences dir.')
 parser.add_argument('--model', type=str, default='/work/b08202033/multilingual_zero_resource_challenge/xlmr.base/',
-                    help='The pretrained multilingual language model that provides tokenizer.')
+                    help='The pretrained multilingual language model that provides tokenizer '
+                    '(directory with sentencepiece.bpe.model and dict.txt).')
 parser.add_argument('--only_correct', action='store_true', help='Activated if only tokenizing the correct text.')
 parser.add_argument('--mono', action='store_true', help='Activated if only tokenizing the monolingual text.')
-args = parser.parse_args()
+parser.add_argument('--workers', type=int, default=1, help='Number of tokenization processes.')
+parser.add_argument('--chunk_size', type=int, default=1000, help='Number of sentences sent to a worker at once.')
+parser.add_argument('--destdir', type=str, default=None,
+                    help='If given, also write the tokenized sentences as a fairseq mmap dataset '
+                    '(destdir/split_name.bin/.idx and dict.txt), as fairseq-preprocess --only-source would.')
+parser.add_argument('--split_name', type=str, default='train', help='Name of the binarized dataset.')
 
-flag_mono = False
-with open(args.input, 'r', encoding='utf-16') as f:
+_sp = None
+_dictionary = None
+
+def load_tokenizer(model_dir):
+    # Same pieces and ids as XLMRModel.from_pretrained(model_dir).bpe / source_dictionary,
+    # without loading the model weights
+    sp = spm.SentencePieceProcessor()
+    sp.Load(os.path.join(model_dir, 'sentencepiece.bpe.model'))
+    dictionary = Dictionary.load(os.path.join(model_dir, 'dict.txt'))
+    dictionary.add_symbol('<mask>')
+    return sp, dictionary
+
+def init_worker(model_dir):
+    global _sp, _dictionary
+    _sp, _dictionary = load_tokenizer(model_dir)
+
+def tokenize_chunk(sentences):
+    out = []
+    for s in sentences:
+        bpe_sentence = ' '.join(_sp.EncodeAsPieces(s.lower()))
+        out.append(_dictionary.encode_line(bpe_sentence, append_eos=False, add_if_not_exist=False).tolist())
+    return out
+
+def read_rows(path):
+    # Header, then the rows of the UTF-16 csv one at a time
+    f = open(path, 'r', encoding='utf-16')
     rows = csv.reader(f)
-    rows = [x for x in rows]
-    if not ('correct' in rows[0] or 'wrong' in rows[0]):
-        assert args.mono, "Activate --mono if you want to tokenize monolingual data."
-    else:
-        assert not args.mono, "Don' activate --mono if you want to tokenize code-switched data"
-    assert len(rows)>=2, 'There is no sentence in this file.'
-    rows = rows[1:]
+    header = next(rows, None)
+    return header, f, rows
 
-if args.mono:
-    sentences = [x[0] for x in rows]
+def read_column(path, columns):
+    header, f, rows = read_rows(path)
+    with f:
+        for row in rows:
+            yield tuple(row[c] if c is not None else None for c in columns)
 
-elif args.only_correct:
-    sentences = [x[0] for x in rows]
-    filenames = [x[2] for x in rows]
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
 
-else:
-    correct_sentence = [x[0] for x in rows]
-    correct_filenames = [x[2] for x in rows]
-    wrong_sentence = [x[1] for x in rows]
-    wrong_filenames = [x[3] for x in rows]
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-    sentences = correct_sentence + wrong_sentence
-    filenames = correct_filenames + wrong_filenames
+    header, f, rows = read_rows(args.input)
+    assert header is not None and next(rows, None) is not None, 'There is no sentence in this file.'
+    f.close()
+    if not ('correct' in header or 'wrong' in header):
+        assert args.mono, "Activate --mono if you want to tokenize monolingual data."
+    else:
+        assert not args.mono, "Don' activate --mono if you want to tokenize code-switched data"
 
-#sentences = [rows[i][0] for i in range(20)]
+    # (sentence, file name) couples, read lazily; the correct sentences come before the wrong ones
+    if args.mono:
+        items = read_column(args.input, [0, None])
+    elif args.only_correct:
+        items = read_column(args.input, [0, 2])
+    else:
+        items = chain(read_column(args.input, [0, 2]), read_column(args.input, [1, 3]))
 
-tokenized_sentences = []
-tokenized_sentences_converted = []
-cp_path = args.model
-model = XLMRModel.from_pretrained(cp_path)
-for _, s in enumerate(tqdm(sentences)):
-    s = s.lower()
-    #bpe_sentence = '<s> ' + model.bpe.encode(s) + ' </s>'
-    bpe_sentence = model.bpe.encode(s)
-    sentence_tokens = model.task.source_dictionary.encode_line(bpe_sentence, append_eos=False, add_if_not_exist=False)
-    tokenized_sentences_converted.append(" ".join([model.task.source_dictionary.symbols[tok] for tok in sentence_tokens]))
-    tokenized_sentences.append(",".join([model.task.source_dictionary.symbols[tok] for tok in sentence_tokens]))
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    _, dictionary = load_tokenizer(args.model)
+    if args.mono:
+        outputs = {'converted': open(os.path.join(args.output, 'tokenized_mono.txt'), 'w')}
+    else:
+        outputs = {'named': open(os.path.join(args.output, 'tokenized_not_converted.txt'), 'w'),
+                   'converted': open(os.path.join(args.output, 'tokenized_converted.txt'), 'w')}
+    builder = None
+    if args.destdir is not None:
+        Path(args.destdir).mkdir(parents=True, exist_ok=True)
+        out_prefix = os.path.join(args.destdir, args.split_name)
+        builder = indexed_dataset.make_builder(indexed_dataset.data_file_path(out_prefix),
+                                               impl='mmap', vocab_size=len(dictionary))
+        shutil.copy(os.path.join(args.model, 'dict.txt'), os.path.join(args.destdir, 'dict.txt'))
 
-Path(args.output).mkdir(parents=True, exist_ok=True)
+    def tokenized_chunks(pool, max_pending):
+        # At most max_pending chunks are read ahead of the writer (pool.imap would queue the whole csv),
+        # the results coming back in file order with the file names of their sentences
+        pending = deque()
+        for chunk in chunks(items, args.chunk_size):
+            if len(pending) >= max_pending:
+                names, result = pending.popleft()
+                yield names, result.get()
+            pending.append(([fn for _, fn in chunk],
+                            pool.apply_async(tokenize_chunk, ([s for s, _ in chunk],))))
+        while pending:
+            names, result = pending.popleft()
+            yield names, result.get()
 
-if args.mono:
-    with open(os.path.join(args.output, 'tokenized_mono.txt'), 'w') as f:
-        for s in tokenized_sentences_converted:
-            f.write(s + '\n')
-else:
-    with open(os.path.join(args.output, 'tokenized_not_converted.txt'), 'w') as f:
-        for fn, s in zip(filenames, tokenized_sentences):
-            f.write(fn +'\t' + s + '\n')
+    n_sentences = 0
+    workers = max(1, args.workers)
+    with Pool(workers, initializer=init_worker, initargs=(args.model,)) as pool:
+        bar = tqdm()
+        for names, tokenized in tokenized_chunks(pool, 2 * workers):
+            for fn, tokens in zip(names, tokenized):
+                symbols = [dictionary.symbols[tok] for tok in tokens]
+                outputs['converted'].write(" ".join(symbols) + '\n')
+                if 'named' in outputs:
+                    outputs['named'].write(fn + '\t' + ",".join(symbols) + '\n')
+                if builder is not None:
+                    builder.add_item(torch.IntTensor(tokens + [dictionary.eos()]))
+            n_sentences += len(tokenized)
+            bar.update(len(tokenized))
+        bar.close()
 
-    with open(os.path.join(args.output, 'tokenized_converted.txt'), 'w') as f:
-        for s in tokenized_sentences_converted:
-            f.write(s + '\n')
+    for f in outputs.values():
+        f.close()
+    if builder is not None:
+        builder.finalize(indexed_dataset.index_file_path(out_prefix))
+    print(f"Tokenized {n_sentences} sentences to {args.output}")
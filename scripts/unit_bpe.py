@@ -0,0 +1,217 @@
+import argparse
+import heapq
+from collections import defaultdict
+from multiprocessing import Pool
+
+# A merged token is the sequence of its units joined by SEP, so that it can
+# always be mapped back to units without the merge table (eg. 12_5_7)
+SEP = '_'
+HEADER = '#unit_bpe v1'
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Byte pair encoding over deduplicated unit sequences.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    learn = subparsers.add_parser('learn', help='learn the merge table on a unit corpus')
+    learn.add_argument('--input', required=True)
+    learn.add_argument('--merges', required=True, help='output merge table')
+    learn.add_argument('--num_merges', type=int, default=10000)
+    learn.add_argument('--min_frequency', type=int, default=2,
+                       help='stop when the most frequent pair is less frequent than this')
+    learn.add_argument('--max_lines', type=int, default=None,
+                       help='learn on the first lines of the input only')
+
+    for name in ['encode', 'decode']:
+        sub = subparsers.add_parser(name, help=f'{name} a unit corpus')
+        sub.add_argument('--input', required=True)
+        sub.add_argument('--output', required=True)
+        if name == 'encode':
+            sub.add_argument('--merges', required=True)
+            sub.add_argument('--workers', type=int, default=1)
+
+    for sub in subparsers.choices.values():
+        sub.add_argument('--input_format', default='converted', choices=['converted', 'named'],
+                         help='converted: space separated units (dedup_converted.txt), '
+                         'named: name<tab>comma separated units (dedup_not_converted.txt)')
+    return parser.parse_args()
+
+def read_lines(file_name, input_format, max_lines=None):
+    # Yield (name, units), name being None for the converted format
+    with open(file_name, 'r') as f:
+        for i, line in enumerate(f):
+            if max_lines is not None and i >= max_lines:
+                break
+            if input_format == 'converted':
+                yield None, line.split()
+            elif line.strip():
+                name, units = line.rstrip('\n').split('\t')[:2]
+                yield name, units.strip().split(',')
+
+def format_line(name, tokens):
+    if name is None:
+        return ' '.join(tokens) + '\n'
+    return name + '\t' + ','.join(tokens) + '\n'
+
+def learn_merges(sequences, num_merges, min_frequency=2):
+    r"""
+    Learn the BPE merges of the given unit sequences. The corpus is kept as
+    one doubly linked list, with the positions of every pair of adjacent
+    symbols, so that a merge only updates the neighbours of its occurrences.
+    The most frequent pair is taken from a heap whose stale counts are
+    refreshed when popped.
+    Return:
+        the list of merged (left, right) symbol couples, in order
+    """
+    symbols, ids = [], {}
+    sym, nxt, prv = [], [], []
+    for units in sequences:
+        start = len(sym)
+        for unit in units:
+            if unit not in ids:
+                ids[unit] = len(symbols)
+                symbols.append(unit)
+            sym.append(ids[unit])
+        end = len(sym)
+        nxt.extend(range(start + 1, end + 1))
+        prv.extend(range(start - 1, end - 1))
+        if end > start:
+            nxt[-1] = -1
+            prv[start] = -1
+
+    positions = defaultdict(set)
+    for i in range(len(sym)):
+        if nxt[i] >= 0:
+            positions[(sym[i], sym[nxt[i]])].add(i)
+    heap = [(-len(pos), pair) for pair, pos in positions.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < num_merges:
+        count, pair = heapq.heappop(heap)
+        current = len(positions.get(pair, ()))
+        if -count != current:
+            if current > 0:
+                heapq.heappush(heap, (-current, pair))
+            continue
+        if current < min_frequency:
+            break
+        a, b = pair
+        c = len(symbols)
+        symbols.append(symbols[a] + SEP + symbols[b])
+        merges.append((symbols[a], symbols[b]))
+        touched = set()
+        for i in sorted(positions.pop(pair)):
+            j = nxt[i]
+            # Already consumed by an overlapping occurrence (eg. x x x)
+            if sym[i] != a or j < 0 or sym[j] != b:
+                continue
+            p, n = prv[i], nxt[j]
+            if p >= 0:
+                positions[(sym[p], a)].discard(p)
+            if n >= 0:
+                positions[(b, sym[n])].discard(j)
+            sym[i], sym[j] = c, -1
+            nxt[i] = n
+            if n >= 0:
+                prv[n] = i
+            if p >= 0:
+                positions[(sym[p], c)].add(p)
+                touched.add((sym[p], c))
+            if n >= 0:
+                positions[(c, sym[n])].add(i)
+                touched.add((c, sym[n]))
+        for new_pair in touched:
+            if positions[new_pair]:
+                heapq.heappush(heap, (-len(positions[new_pair]), new_pair))
+    return merges
+
+def save_merges(path, merges):
+    with open(path, 'w') as f:
+        f.write(HEADER + '\n')
+        for a, b in merges:
+            f.write(f'{a} {b}\n')
+
+def load_merges(path):
+    r"""
+    Return:
+        a dictionnary (left, right) -> (rank, merged symbol)
+    """
+    with open(path, 'r') as f:
+        lines = [x.split() for x in f if x.strip() and not x.startswith('#')]
+    return {(a, b): (rank, a + SEP + b) for rank, (a, b) in enumerate(lines)}
+
+def encode(units, merges):
+    r"""
+    Apply the merges to a unit sequence, lowest rank first, each merge being
+    done left to right as when learning.
+    """
+    syms = list(units)
+    nxt = list(range(1, len(syms) + 1))
+    prv = list(range(-1, len(syms) - 1))
+    if syms:
+        nxt[-1] = -1
+    heap = [(merges[(syms[i], syms[i + 1])][0], i, syms[i], syms[i + 1])
+            for i in range(len(syms) - 1) if (syms[i], syms[i + 1]) in merges]
+    heapq.heapify(heap)
+    while heap:
+        _, i, a, b = heapq.heappop(heap)
+        j = nxt[i]
+        if syms[i] != a or j < 0 or syms[j] != b:
+            continue
+        syms[i], syms[j] = merges[(a, b)][1], None
+        nxt[i] = nxt[j]
+        if nxt[j] >= 0:
+            prv[nxt[j]] = i
+        for left in [prv[i], i]:
+            right = nxt[left] if left >= 0 else -1
+            if left >= 0 and right >= 0 and (syms[left], syms[right]) in merges:
+                heapq.heappush(heap, (merges[(syms[left], syms[right])][0], left,
+                                      syms[left], syms[right]))
+    return [x for x in syms if x is not None]
+
+def decode(tokens):
+    return [unit for token in tokens for unit in token.split(SEP)]
+
+_merges = None
+
+def _init_worker(path):
+    global _merges
+    _merges = load_merges(path)
+
+def _encode_line(item):
+    name, units = item
+    return name, len(units), encode(units, _merges)
+
+def run_encode(args):
+    n_units, n_tokens = 0, 0
+    lines = read_lines(args.input, args.input_format)
+    with Pool(max(1, args.workers), initializer=_init_worker, initargs=(args.merges,)) as pool, \
+            open(args.output, 'w') as out:
+        for name, length, tokens in pool.imap(_encode_line, lines, chunksize=256):
+            out.write(format_line(name, tokens))
+            n_units += length
+            n_tokens += len(tokens)
+    print(f"{args.input}: {n_units} units -> {n_tokens} tokens, "
+          f"compression ratio {n_units / max(1, n_tokens):.3f}")
+
+def run_decode(args):
+    with open(args.output, 'w') as out:
+        for name, tokens in read_lines(args.input, args.input_format):
+            out.write(format_line(name, decode(tokens)))
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'learn':
+        sequences = [units for _, units in read_lines(args.input, args.input_format, args.max_lines)]
+        merges = learn_merges(sequences, args.num_merges, args.min_frequency)
+        save_merges(args.merges, merges)
+        n_units = sum(len(x) for x in sequences)
+        merge_table = load_merges(args.merges)
+        n_tokens = sum(len(encode(x, merge_table)) for x in sequences)
+        print(f"Learned {len(merges)} merges on {len(sequences)} sequences, saved to {args.merges}")
+        print(f"{n_units} units -> {n_tokens} tokens, compression ratio {n_units / max(1, n_tokens):.3f}")
+    elif args.command == 'encode':
+        run_encode(args)
+    else:
+        run_decode(args)
@@ -4,6 +4,7 @@ max_update=25000
 total_num_update=25000
 warmup_update=1000
 max_positions=6144
+# with a windowed train set (deduplicate.py --split_long), max_positions can be the window size
 max_tokens=20480
 num_workers=16
 update_freq=32